@@ -16,6 +16,9 @@ from astropy.coordinates import get_moon, get_sun, SkyCoord, AltAz
 import numpy as np
 import time
 
+from custom_code.visibility import get_24hr_airmass_series
+from custom_code.spectra import read_spectrum
+
 register = template.Library()
 
 
@@ -42,68 +45,14 @@ def airmass_plot(context):
 
 def get_24hr_airmass(target, interval, airmass_limit):
 
-    plot_data = []
-    
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
-    time_plot = time_range.datetime
-    
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
-
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
+    time_plot, labels, names, airmass = get_24hr_airmass_series(
+        target, interval, airmass_limit, sun_alt_limit=-18.0 #between astro twilights
     )
 
-    for observing_facility in facility.get_service_classes():
-
-        if observing_facility != 'LCO':
-            continue
-
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -18*u.deg)  #between astro twilights
-            )
-
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
-
-            label = '({facility}) {site}'.format(
-                facility = observing_facility, site = site
-            )
-
-            plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, )
-            )
+    plot_data = [
+        go.Scatter(x=time_plot, y=airmass[i], mode='lines', name=label, )
+        for i, label in enumerate(labels)
+    ]
 
     return plot_data
 
@@ -173,13 +122,8 @@ def spectra_plot(target, dataproduct=None):
     if dataproduct:
         spectral_dataproducts = DataProduct.objects.get(dataproduct=dataproduct)
     for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        for key, value in datum.items():
-            wavelength.append(value['wavelength'])
-            flux.append(float(value['flux']))
+        wavelength, flux = read_spectrum(spectrum.value)
         spectra.append((wavelength, flux, name))
     plot_data = [
         go.Scatter(
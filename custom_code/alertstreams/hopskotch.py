@@ -13,6 +13,8 @@ from hop.io import Metadata, StartPosition, list_topics
 import re
 import uuid
 
+from gw.alert_queue import start_stream_worker
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -91,6 +93,8 @@ class CustomHopskotchAlertStream(AlertStream):
 
     def listen(self):
         super().listen()
+        ### Process GW alerts left in the queue by the previous stream process
+        start_stream_worker(self.topic_handlers.values())
         # TODO: alternatively, WARN upon OPTIONS['topics'] extries that don't have
         # handlers in the alert_handler. (i.e they've configured a topic subscription
         # without providing a handler for the topic. So, warn them).
@@ -9,6 +9,8 @@ from rest_framework.mixins import CreateModelMixin
 from tom_dataproducts.models import DataProduct, ReducedDatum
 from tom_targets.models import Target, TargetName
 from custom_code.models import ReducedDatumExtra, Papers
+from custom_code.photometry import invalidate_lightcurve
+from custom_code.target_summary import update_target_summary
 from tom_common.hooks import run_hook
 from .processors.data_processor import run_custom_data_processor
 import json
@@ -102,6 +104,9 @@ class CustomDataProductViewSet(DataProductViewSet):
                         assign_perm('tom_dataproducts.view_dataproduct', group, dp)
                         assign_perm('tom_dataproducts.delete_dataproduct', group, dp)
                         assign_perm('tom_dataproducts.view_reduceddatum', group, reduced_data)
+                if dp_type == 'photometry':
+                    invalidate_lightcurve(targetid)
+                update_target_summary(targetid)
                 # Make the ReducedDatumExtra row corresponding to this dp
                 upload_extras['data_product_id'] = dp.id
                 reduced_datum_extra = ReducedDatumExtra(
@@ -269,6 +274,7 @@ class CustomObservationRecordViewSet(ObservationRecordViewSet):
                          wrapped_session=db_session)
 
             db_session.commit()
+            db_session.close()
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
@@ -3,3 +3,15 @@ from django.apps import AppConfig
 
 class CustomPlotsConfig(AppConfig):
     name = 'custom_code'
+
+    def ready(self):
+        ### Connects the signals that keep the stored light curves up to date
+        import custom_code.photometry
+
+        ### And the stored target summaries
+        import custom_code.target_summary
+
+        ### Opt-in timing of template tags, hooks and views
+        from custom_code.instrumentation import INSTRUMENTATION_ENABLED, install
+        if INSTRUMENTATION_ENABLED:
+            install()
@@ -0,0 +1,90 @@
+"""
+NumPy binning and decimation of spectra for plotting.
+
+Spectra are binned by averaging blocks of pixels with a reshape, and then
+decimated to a fixed pixel budget by keeping the minimum and maximum flux of
+each block of pixels, so narrow emission and absorption lines still show up
+in the plots while long spectra send only a few thousand points to the browser.
+"""
+import numpy as np
+from django.conf import settings
+
+SPECTRUM_PIXEL_BUDGET = getattr(settings, 'SPECTRUM_PIXEL_BUDGET', 2000) # points per spectrum
+SPECTRA_PIXEL_BUDGET = getattr(settings, 'SPECTRA_PIXEL_BUDGET', 40000) # points per plot
+MIN_SPECTRUM_PIXELS = 500
+
+
+def _as_arrays(wavelength, flux):
+    wavelength = np.asarray(wavelength, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    return wavelength, flux
+
+
+def bin_spectrum(wavelength, flux, factor):
+    """
+    Averages every factor consecutive pixels. A trailing partial bin is
+    dropped, as are bins with nonpositive wavelengths.
+    """
+    wavelength, flux = _as_arrays(wavelength, flux)
+    factor = max(int(factor or 1), 1)
+    if factor > 1:
+        nbins = len(flux) // factor
+        wavelength = wavelength[:nbins*factor].reshape(nbins, factor).mean(axis=1)
+        flux = flux[:nbins*factor].reshape(nbins, factor).mean(axis=1)
+
+    good = wavelength > 0
+    return wavelength[good], flux[good]
+
+
+def envelope_decimate(wavelength, flux, npoints=SPECTRUM_PIXEL_BUDGET):
+    """
+    Reduces a spectrum to about npoints by keeping only the pixels with the
+    lowest and highest flux in each block, in wavelength order
+    """
+    wavelength, flux = _as_arrays(wavelength, flux)
+    n = len(flux)
+    nblocks = max(int(npoints) // 2, 1)
+    if n <= max(int(npoints), 2):
+        return wavelength, flux
+
+    size = int(np.ceil(n / nblocks))
+    nblocks = int(np.ceil(n / size))
+    padded = np.full(nblocks*size, np.nan)
+    padded[:n] = flux
+    blocks = padded.reshape(nblocks, size)
+
+    start = np.arange(nblocks) * size
+    lo = start + np.argmin(np.where(np.isnan(blocks), np.inf, blocks), axis=1)
+    hi = start + np.argmax(np.where(np.isnan(blocks), -np.inf, blocks), axis=1)
+
+    index = np.sort(np.stack([lo, hi], axis=1), axis=1).ravel()
+    index = index[np.concatenate([[True], np.diff(index) > 0])]
+    return wavelength[index], flux[index]
+
+
+def resample_spectrum(wavelength, flux, npixels=SPECTRUM_PIXEL_BUDGET):
+    """
+    Averages pixels down to at most npixels, for when a smooth
+    spectrum matters more than keeping narrow features
+    """
+    wavelength, flux = _as_arrays(wavelength, flux)
+    factor = int(np.ceil(len(flux) / max(int(npixels), 1)))
+    return bin_spectrum(wavelength, flux, factor)
+
+
+def pixel_budget(nspectra):
+    """
+    Points per spectrum when nspectra are drawn on the same plot
+    """
+    if not nspectra:
+        return SPECTRUM_PIXEL_BUDGET
+    return max(MIN_SPECTRUM_PIXELS, min(SPECTRUM_PIXEL_BUDGET, SPECTRA_PIXEL_BUDGET // nspectra))
+
+
+def prepare_spectrum(wavelength, flux, factor=1, npoints=SPECTRUM_PIXEL_BUDGET):
+    """
+    Bins a spectrum by factor and decimates the result to npoints,
+    returning the wavelength and flux arrays to plot
+    """
+    wavelength, flux = bin_spectrum(wavelength, flux, factor)
+    return envelope_decimate(wavelength, flux, npoints)
@@ -10,6 +10,7 @@ from tom_dataproducts.models import ReducedDatum
 from tom_targets.templatetags.targets_extras import target_extra_field
 from tom_targets.models import Target
 from custom_code.models import ReducedDatumExtra, Papers
+from custom_code.photometry import get_photometry
 import logging
 from django.templatetags.static import static
 from datetime import datetime, timedelta, timezone
@@ -291,12 +292,9 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
         'up': 'u', 'u': 'u', 'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
         'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2',
         'UVW1': 'UVW1'}
-    photometry_data = {}
-    subtracted_photometry_data = {}
     target = Target.objects.get(id=target_id)
     datumextras = ReducedDatumExtra.objects.filter(target_id=target_id, key='upload_extras', data_type='photometry')
-    
-    datums = []
+    photometry = get_photometry(target_id)
     
     ### Check if this is a final reduction or not
     if 'Final' in final_reduction_value:
@@ -314,9 +312,10 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
     
     ### Get the data for the selected telescope
     if not selected_telescope:
-        datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', value__has_key='filter'))
+        selected = photometry.has_filter.copy()
     
     else:
+        selected_data_products = []
         for de in datumextras:
             de_value = json.loads(de.value)
 
@@ -327,57 +326,47 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
                     de_value.get('reducer_group', '') in selected_groups,
                     (not selected_paper or de_value.get('used_in', '')==selected_paper or de_value.get('used_in', '') in papers_for_target)]):
                 dp_id = de_value.get('data_product_id', '')
-                datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id=dp_id, value__has_key='filter'))
+                try:
+                    selected_data_products.append(int(dp_id))
+                except (TypeError, ValueError):
+                    continue
+        selected = np.isin(photometry.data_product_id, selected_data_products)
         
         ### Finally, get the data that was automatically uploaded from snex1 db
         if 'LCO' in selected_telescope and not final_reduction:
-            datums.append(ReducedDatum.objects.filter(target_id=target_id, data_type='photometry', data_product_id__isnull=True, value__has_key='filter'))
+            selected |= photometry.data_product_id < 0
+        
+        selected &= photometry.has_filter
     
     ### Plot the data
-    if not datums:
+    if not selected.any():
         return 'No photometry yet'
     
     spec = ReducedDatum.objects.filter(target_id=target_id, data_type='spectroscopy')
 
-    for data in datums:
-        for rd in data:
-            value = rd.value
-            if not value:
-                continue
-            if isinstance(value, str):
-                value = json.loads(value)
-
-            ### Check if the value contains a magnitude (may not if the entry is 9999 in snex1)
-            if not value.get('magnitude', ''):
-                continue
-
-            ### Get subtracted or unsubtracted data
-            if value.get('background_subtracted', '') == True:
-                if value.get('subtraction_algorithm', '') in selected_algorithm and value.get('template_source', '') in selected_template and reduction_type == 'manual':
-                    
-                    subtracted_filt = filter_translate.get(value.get('filter', ''), '')
-
-                    subtracted_photometry_data.setdefault(subtracted_filt, {})
-                    subtracted_photometry_data[subtracted_filt].setdefault('time', []).append(rd.timestamp)
-                    subtracted_photometry_data[subtracted_filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-                    subtracted_photometry_data[subtracted_filt].setdefault('error', []).append(value.get('error', None))
-            elif value.get('reduction_type', '') == reduction_type or reduction_type == 'all':
+    ### Check if the value contains a magnitude (may not if the entry is 9999 in snex1)
+    selected &= photometry.has_magnitude
 
-                filt = filter_translate.get(value.get('filter', ''), '')
-
-                photometry_data.setdefault(filt, {})
-                photometry_data[filt].setdefault('time', []).append(rd.timestamp)
-                photometry_data[filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-                photometry_data[filt].setdefault('error', []).append(value.get('error', None))
+    ### Get subtracted or unsubtracted data
+    if subtracted_value == 'Subtracted':
+        if reduction_type == 'manual':
+            selected &= (photometry.background_subtracted
+                         & np.isin(photometry.subtraction_algorithm, selected_algorithm)
+                         & np.isin(photometry.template_source, selected_template))
+        else:
+            selected[:] = False
+    else:
+        selected &= ~photometry.background_subtracted
+        if reduction_type != 'all':
+            selected &= photometry.reduction_type == reduction_type
 
-    if subtracted_value == 'Unsubtracted':
-        selected_photometry = photometry_data
-    elif subtracted_value == 'Subtracted':
-        selected_photometry = subtracted_photometry_data
+    selected_photometry = photometry.select(selected)
+    photometry_data = selected_photometry.by_filter(filter_translate)
+    days_ago = Time(datetime.now(timezone.utc)).mjd - selected_photometry.mjd
 
     plot_data = [
         go.Scatter(
-            x=[(datetime.now(timezone.utc) - t.replace(tzinfo=timezone.utc)).total_seconds()/(24*3600) for t in filter_values['time']],
+            x=days_ago[filter_values['index']],
             y=filter_values['magnitude'], 
             mode='markers',
             marker=dict(color=get_color(filter_name, filter_translate),
@@ -390,19 +379,19 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
                 visible=True,
                 color=get_color(filter_name, filter_translate)
             ),
-            text=['{} (MJD {})'.format(t.strftime('%m/%d/%Y'), str(round(Time(t).mjd, 2))) for t in filter_values['time']],
-        ) for filter_name, filter_values in selected_photometry.items()]
+            text=['{} (MJD {})'.format(t.strftime('%m/%d/%Y'), str(round(mjd, 2))) for t, mjd in zip(filter_values['time'], selected_photometry.mjd[filter_values['index']])],
+        ) for filter_name, filter_values in photometry_data.items()]
 
     if target_extra_field(target, 'redshift') is not None and float(target_extra_field(target, 'redshift')) > 0.01:
         ydata = []
-        for filter_name, filter_values in selected_photometry.items():
+        for filter_name, filter_values in photometry_data.items():
             if filter_name is not None:
                 ydata.append(np.asarray(filter_values['magnitude']) + np.asarray(filter_values['error']))
                 ydata.append(np.asarray(filter_values['magnitude']) - np.asarray(filter_values['error']))
         if ydata:
             ydata = np.concatenate(ydata)
-            ymin = np.min(ydata)
-            ymax = np.max(ydata)
+            ymin = np.nanmin(ydata)
+            ymax = np.nanmax(ydata)
             ymin_view = ymin - 0.05 * (ymax-ymin)
             ymax_view = ymax + 0.05 * (ymax-ymin)
         else:
@@ -450,10 +439,8 @@ def update_graph(selected_telescope, subtracted_value, selected_algorithm, selec
     )
 
     ### Set the minimum x-axis range to one day
-    min_xs = [min(filter_values['time']) for filter_values in selected_photometry.values()]
-
-    if len(min_xs) > 0:# and len(max_xs) > 0:
-        layout['xaxis']['range'] = [(datetime.now(timezone.utc) - min(min_xs).replace(tzinfo=timezone.utc)).total_seconds()/(24*3600)*1.06, 0]
+    if len(selected_photometry) > 0:
+        layout['xaxis']['range'] = [days_ago.max()*1.06, 0]
         layout['xaxis']['autorange'] = False
         layout['xaxis']['title'] = 'Days Ago'
 
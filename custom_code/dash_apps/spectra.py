@@ -13,7 +13,8 @@ import json
 
 from django_plotly_dash import DjangoDash
 from tom_dataproducts.models import ReducedDatum
-from custom_code.templatetags.custom_code_tags import bin_spectra
+from custom_code.binning import prepare_spectrum, pixel_budget
+from custom_code.spectra import read_spectrum
 from django.templatetags.static import static
 import matplotlib.pyplot as plt
 
@@ -343,24 +344,13 @@ def display_output(selected_rows,
             b=int(color[2]*255),
         ) for color in colors]
         all_data = []
+        budget = pixel_budget(len(spectral_dataproducts))
         for i in range(len(spectral_dataproducts)):
             spectrum = spectral_dataproducts[i]
-            datum = spectrum.value
-            wavelength = []
-            flux = []
             name = str(spectrum.timestamp).split(' ')[0]
-            if datum.get('photon_flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('photon_flux')
-            elif datum.get('flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('flux')
-            else:
-                for key, value in datum.items():
-                    wavelength.append(float(value['wavelength']))
-                    flux.append(float(value['flux']))
+            wavelength, flux = read_spectrum(spectrum.value)
             
-            binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
+            binned_wavelength, binned_flux = prepare_spectrum(wavelength, flux, 5, npoints=budget)
             scatter_obj = go.Scatter(
                 x=binned_wavelength,
                 y=binned_flux,
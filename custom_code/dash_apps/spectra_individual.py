@@ -7,7 +7,6 @@ import dash_html_components as html
 import plotly.graph_objs as go
 import numpy as np
 import json
-from statistics import median
 
 ### Jamie's Dash spectra plotting, currently a WIP
 ### Jamie: "lots of help from https://community.plot.ly/t/django-and-dash-eads-method/7717"
@@ -15,7 +14,8 @@ from statistics import median
 from django_plotly_dash import DjangoDash
 from tom_dataproducts.models import ReducedDatum
 from tom_targets.models import Target, TargetExtra
-from custom_code.templatetags.custom_code_tags import bin_spectra
+from custom_code.binning import prepare_spectrum, pixel_budget
+from custom_code.spectra import read_spectrum
 from django.db.models import Q
 from django.templatetags.static import static
 import matplotlib.pyplot as plt
@@ -464,27 +464,15 @@ def display_output(selected_rows,
             if not spectrum:
                 return 'No spectra yet'
                 
-            datum = spectrum.value
-            wavelength = []
-            flux = []
             name = str(spectrum.timestamp).split(' ')[0]
-            if datum.get('photon_flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('photon_flux')
-            elif datum.get('flux'):
-                wavelength = datum.get('wavelength')
-                flux = datum.get('flux')
-            else:
-                for key, value in datum.items():
-                    wavelength.append(float(value['wavelength']))
-                    flux.append(float(value['flux']))
+            wavelength, flux = read_spectrum(spectrum.value)
                     
-            median_flux = [f / median(flux) for f in flux]
+            median_flux = flux / np.median(flux)
             if max(median_flux) > max_flux: max_flux = max(median_flux)
 
             if not bin_factor:
                 bin_factor = 1
-            binned_wavelength, binned_flux = bin_spectra(wavelength, median_flux, int(bin_factor))
+            binned_wavelength, binned_flux = prepare_spectrum(wavelength, median_flux, int(bin_factor))
             
             scatter_obj = go.Scatter(
                 x=binned_wavelength,
@@ -503,28 +491,17 @@ def display_output(selected_rows,
                 compare_z = float(compare_z_query.value)
 
             spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
+            budget = pixel_budget(len(spectral_dataproducts) + 1)
             for spectrum in spectral_dataproducts:
-                datum = spectrum.value
-                wavelength = []
-                flux = []
                 name = target.name + ' --- ' +  str(spectrum.timestamp).split(' ')[0]
-                if datum.get('photon_flux'):
-                    wavelength = datum.get('wavelength')
-                    flux = datum.get('photon_flux')
-                elif datum.get('flux'):
-                    wavelength = datum.get('wavelength')
-                    flux = datum.get('flux')
-                else:
-                    for key, value in datum.items():
-                        wavelength.append(float(value['wavelength']))
-                        flux.append(float(value['flux']))
-                shifted_wavelength = [w * (1+object_z) / (1+compare_z) for w in wavelength]
-                median_flux = [f / median(flux) for f in flux]
+                wavelength, flux = read_spectrum(spectrum.value)
+                shifted_wavelength = wavelength * (1+object_z) / (1+compare_z)
+                median_flux = flux / np.median(flux)
                 if max(median_flux) > max_flux: max_flux = max(median_flux)
                 
                 if not bin_factor:
                     bin_factor = 1
-                binned_wavelength, binned_flux = bin_spectra(shifted_wavelength, median_flux, int(bin_factor))
+                binned_wavelength, binned_flux = prepare_spectrum(shifted_wavelength, median_flux, int(bin_factor), npoints=budget)
                 
                 scatter_obj = go.Scatter(
                     x=binned_wavelength,
@@ -547,24 +524,12 @@ def display_output(selected_rows,
         if not spectrum:
             return 'No spectra yet'
             
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = read_spectrum(spectrum.value)
         
         if not bin_factor:
             bin_factor = 1
-        binned_wavelength, binned_flux = bin_spectra(wavelength, flux, int(bin_factor))
+        binned_wavelength, binned_flux = prepare_spectrum(wavelength, flux, int(bin_factor))
         scatter_obj = go.Scatter(
             x=binned_wavelength,
             y=binned_flux,
@@ -585,20 +550,8 @@ def display_output(selected_rows,
         if not spectrum:
             return 'No spectra yet'
 
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = read_spectrum(spectrum.value)
 
         if 'mask' in mask_value:
             object_z_query = TargetExtra.objects.filter(target_id=spectrum.target_id,key='redshift').first()
@@ -617,7 +570,7 @@ def display_output(selected_rows,
 
         if not bin_factor:
             bin_factor = 1
-        binned_wavelength, binned_flux = bin_spectra(wavelength, flux, int(bin_factor))
+        binned_wavelength, binned_flux = prepare_spectrum(wavelength, flux, int(bin_factor))
         scatter_obj = go.Scatter(
             x=binned_wavelength,
             y=binned_flux,
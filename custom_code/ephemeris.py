@@ -0,0 +1,154 @@
+"""
+Process-wide sun and moon ephemeris tables.
+
+Sun and moon positions do not depend on the target, so they are computed
+once per time grid and shared by every visibility and moon calculation in
+the process. Grids are aligned to fixed boundaries so that all the targets
+rendered within the same interval reuse the same table, and the per-site
+sun altitudes are memoized on the table itself. Targets then only need
+cheap NumPy separation and altitude math against the stored arrays.
+"""
+import datetime
+import threading
+from collections import OrderedDict
+from functools import cached_property
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord, FK5, get_sun, get_moon
+from astropy.time import Time
+from astroplan import moon_illumination
+
+EPHEMERIS_CACHE_SIZE = 32
+
+
+def align_time(when, minutes):
+    """
+    Rounds a datetime down to a multiple of minutes since midnight
+    """
+    when = when.replace(second=0, microsecond=0, tzinfo=None)
+    midnight = when.replace(hour=0, minute=0)
+    offset = int((when - midnight).total_seconds() // 60)
+    return midnight + datetime.timedelta(minutes=offset - offset % minutes)
+
+
+def altitude(ra, dec, lst, lats):
+    """
+    Altitude in degrees of a position of date (scalars or arrays matching
+    the time axis) from a (site, time) local sidereal time array in degrees
+    """
+    ha = np.radians(lst - ra)
+    dec = np.radians(dec)
+    lats = np.radians(np.asarray(lats, dtype=float))[:, None]
+    sinalt = np.sin(dec)*np.sin(lats) + np.cos(dec)*np.cos(lats)*np.cos(ha)
+    return np.degrees(np.arcsin(np.clip(sinalt, -1.0, 1.0)))
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Vincenty angular separation in degrees, vectorized over any of the inputs
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(x) for x in (ra1, dec1, ra2, dec2))
+    dra = ra2 - ra1
+    num1 = np.cos(dec2)*np.sin(dra)
+    num2 = np.cos(dec1)*np.sin(dec2) - np.sin(dec1)*np.cos(dec2)*np.cos(dra)
+    denom = np.sin(dec1)*np.sin(dec2) + np.cos(dec1)*np.cos(dec2)*np.cos(dra)
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denom))
+
+
+class EphemerisTable:
+    """
+    Sun and moon ephemerides on one time grid, stored as NumPy arrays.
+    Positions are equatorial of the equinox at the middle of the grid.
+    Each quantity is computed the first time it is needed.
+    """
+
+    def __init__(self, start, npoints, interval):
+        self.start = start
+        self.interval = interval
+        self.times = Time(start) + np.arange(npoints)*interval*u.minute
+        self.equinox = self.times[npoints // 2]
+        self._lock = threading.Lock()
+        self._sun_alt = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def to_date(self, coord):
+        if coord.frame.name == 'gcrs':
+            ### get_sun and get_body come with a distance, which would make
+            ### the transform move them from the geocentre to the barycentre
+            coord = SkyCoord(coord.ra, coord.dec, frame='gcrs', obstime=coord.obstime)
+        coord = coord.transform_to(FK5(equinox=self.equinox))
+        return coord.ra.deg, coord.dec.deg
+
+    @cached_property
+    def datetimes(self):
+        return self.times.datetime
+
+    @cached_property
+    def gst(self):
+        return np.asarray(self.times.sidereal_time('apparent', 'greenwich').deg)
+
+    @cached_property
+    def sun(self):
+        return self.to_date(get_sun(self.times))
+
+    @cached_property
+    def moon(self):
+        return self.to_date(get_moon(self.times))
+
+    @cached_property
+    def moon_illumination(self):
+        return np.asarray(moon_illumination(self.times))
+
+    def lst(self, lons):
+        return self.gst[None, :] + np.asarray(lons, dtype=float)[:, None]
+
+    def sun_alt(self, lats, lons):
+        """
+        (site, time) sun altitudes, memoized per set of sites
+        """
+        key = (tuple(lats), tuple(lons))
+        with self._lock:
+            if key not in self._sun_alt:
+                self._sun_alt[key] = altitude(self.sun[0], self.sun[1], self.lst(lons), lats)
+            return self._sun_alt[key]
+
+    def moon_separation(self, ra, dec):
+        """
+        Distance in degrees between the moon and a J2000 position at each time
+        """
+        obj_ra, obj_dec = self.to_date(SkyCoord(ra, dec, unit='deg'))
+        return angular_separation(self.moon[0], self.moon[1], obj_ra, obj_dec)
+
+
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def get_ephemeris(start, end, interval, align=None):
+    """
+    Returns the shared ephemeris table covering start to end with a spacing
+    of interval minutes. start is rounded down to a multiple of align minutes
+    (the interval by default), so nearby requests share one table.
+    """
+    if isinstance(start, Time):
+        start = start.datetime
+    if isinstance(end, Time):
+        end = end.datetime
+    aligned = align_time(start, align or interval)
+    npoints = int(np.ceil((end.replace(tzinfo=None) - aligned).total_seconds() / (60.0*interval)))
+    key = (aligned, npoints, interval)
+
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is not None:
+            _tables.move_to_end(key)
+            return table
+
+        table = EphemerisTable(aligned, npoints, interval)
+        _tables[key] = table
+        while len(_tables) > EPHEMERIS_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return table
@@ -8,7 +8,8 @@ from math import radians
 from django.db.models.functions.math import ACos, Cos, Radians, Pi, Sin
 from django.db.models.functions import Lower
 from astropy.time import Time
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.utils import timezone
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit, Layout, Div, HTML
@@ -88,6 +89,37 @@ class CustomTargetFilter(TargetFilter):
     def filter_sciencetags(self, queryset, name, value):
         return queryset.filter(targettags__tag=value).distinct()
 
+    ### Filters and sorting on the denormalized TargetSummary table
+    active_cadence = django_filters.BooleanFilter(field_name='summary__active_cadence', label='Active Cadence')
+    brighter_than = django_filters.NumberFilter(field_name='summary__latest_magnitude', lookup_expr='lte', label='Latest Magnitude Brighter Than')
+    photometry_within = django_filters.NumberFilter(label='Photometry in Last N Days', method='filter_photometry_within')
+
+    order = django_filters.OrderingFilter(
+        fields=(
+            ('name', 'name'),
+            ('created', 'created'),
+            ('modified', 'modified'),
+            ('summary__latest_magnitude', 'latest_magnitude'),
+            ('summary__last_photometry', 'last_photometry'),
+            ('summary__num_spectra', 'num_spectra'),
+            ('summary__redshift', 'redshift'),
+            ('summary__interest_count', 'interest_count'),
+        ),
+        field_labels={
+            'name': 'Name',
+            'created': 'Creation Date',
+            'modified': 'Last Update',
+            'summary__latest_magnitude': 'Latest Magnitude',
+            'summary__last_photometry': 'Last Photometry',
+            'summary__num_spectra': 'Number of Spectra',
+            'summary__redshift': 'Redshift',
+            'summary__interest_count': 'Interest Count',
+        }
+    )
+
+    def filter_photometry_within(self, queryset, name, value):
+        return queryset.filter(summary__last_photometry__gte=timezone.now() - timedelta(days=value))
+
     class Meta:
         model = Target
         fields = ['name', 'cone_search', 'targetlist__name', 'sciencetags']
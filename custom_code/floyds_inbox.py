@@ -0,0 +1,63 @@
+"""
+Cached list of unreduced FLOYDS spectra for the FLOYDS inbox.
+
+Finding the unreduced spectra takes a call to the LCO API and a query against
+SNEx1, so the list is kept in the Django cache and rebuilt when it expires or
+when the refresh_floyds_inbox command runs (from cron). The preview plots
+mirror the SNEx1 tree under FLOYDS_SNEX1_ROOT in FLOYDS_PREVIEW_ROOT; they are
+linked by their path relative to both and served by floyds_preview_view, so
+the page never reads them.
+"""
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+
+from custom_code.hooks import get_unreduced_spectra
+
+logger = logging.getLogger(__name__)
+
+FLOYDS_INBOX_CACHE_KEY = 'floyds_inbox_rows'
+FLOYDS_INBOX_CACHE_TIMEOUT = getattr(settings, 'FLOYDS_INBOX_CACHE_TIMEOUT', 15*60) # seconds
+FLOYDS_SNEX1_ROOT = getattr(settings, 'FLOYDS_SNEX1_ROOT', '/supernova/data/floyds')
+FLOYDS_PREVIEW_ROOT = getattr(settings, 'FLOYDS_PREVIEW_ROOT', os.path.join(settings.MEDIA_ROOT, 'floyds'))
+
+
+def preview_path(filepath, filename):
+    """
+    Path of the preview plot of a raw spectrum relative to FLOYDS_PREVIEW_ROOT,
+    or None if the spectrum isn't under FLOYDS_SNEX1_ROOT
+    """
+    imgpath = os.path.normpath(os.path.join(filepath, filename.replace('.fits', '.png')))
+    path = os.path.relpath(imgpath, FLOYDS_SNEX1_ROOT)
+    if path.startswith(os.pardir) or os.path.isabs(path):
+        return None
+    return path
+
+
+def refresh_floyds_inbox():
+    """
+    Rebuilds the cached inbox rows and returns them
+    """
+    targetids, propids, dateobs, paths, filenames = get_unreduced_spectra()
+    rows = [{'targetid': targetids[i],
+             'propid': propids[i],
+             'dateobs': dateobs[i],
+             'path': paths[i],
+             'filename': filenames[i],
+             'img': preview_path(paths[i], filenames[i])}
+            for i in range(len(targetids))]
+    cache.set(FLOYDS_INBOX_CACHE_KEY, rows, FLOYDS_INBOX_CACHE_TIMEOUT)
+    logger.info('Found {} unreduced FLOYDS spectra'.format(len(rows)))
+    return rows
+
+
+def get_floyds_inbox():
+    """
+    Cached inbox rows, rebuilt if they have expired
+    """
+    rows = cache.get(FLOYDS_INBOX_CACHE_KEY)
+    if rows is None:
+        rows = refresh_floyds_inbox()
+    return rows
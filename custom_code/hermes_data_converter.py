@@ -1,19 +1,15 @@
 import json
 
 from tom_dataproducts.alertstreams.hermes import HermesDataConverter
-from custom_code.models import ReducedDatumExtra
+from custom_code.models import ReducedDatumExtra, SNEx1Mapping
 
 
 class SNEx2HermesDataConverter(HermesDataConverter):
     def get_hermes_spectroscopy(self, datum):
         spectroscopy_row = super().get_hermes_spectroscopy(datum)
         # Add in SNEx specific ReducedDatumExtras here
-        snex1_id_row = ReducedDatumExtra.objects.filter(
-            data_type='spectroscopy',
-            target_id=datum.target.id,
-            key='snex_id', value__icontains='"snex2_id": {}'.format(datum.id)).first()
-        if snex1_id_row:
-            snex1_id = json.loads(snex1_id_row.value).get('snex_id')
+        snex1_id = SNEx1Mapping.objects.filter(
+            table='spec', reduced_datum_id=datum.id).values_list('snex1_id', flat=True).first()
         if snex1_id:
             reduced_datum_extra = ReducedDatumExtra.objects.filter(
                 data_type='spectroscopy', key='spec_extras',
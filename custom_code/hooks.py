@@ -7,6 +7,9 @@ import json
 from tom_targets.templatetags.targets_extras import target_extra_field
 from tom_targets.models import TargetExtra
 from custom_code.management.commands.ingest_ztf_data import get_ztf_data
+from custom_code.plot_cache import invalidate_target_plots
+from custom_code.snex1_db import get_session, new_session, load_table
+from custom_code.target_summary import update_target_summary
 from requests_oauthlib import OAuth1
 from astropy.coordinates import SkyCoord
 from astropy import units as u
@@ -14,11 +17,10 @@ from datetime import datetime, date, timedelta
 import numpy as np
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
 
-from sqlalchemy import create_engine, pool, and_, or_, not_
-from sqlalchemy.orm import sessionmaker, aliased
-from sqlalchemy.ext.automap import automap_base
-from contextlib import contextmanager
+from sqlalchemy import and_, or_, not_, exists
+from sqlalchemy.orm import aliased
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
@@ -35,45 +37,11 @@ priority_dict = {'NORMAL': 'normal',
                     'TIME_CRITICAL': 'time_critical',
                     'RAPID_RESPONSE': 'immediate_too'}
 
-@contextmanager
-def _get_session(db_address):
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.metadata.bind = engine
+### The SNEx1 sessions and tables come from the shared pooled engine
+_get_session = get_session
+_return_session = new_session
+_load_table = load_table
 
-    db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
-    session = db_session()
-
-    try:
-        yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
-
-def _return_session(db_address=settings.SNEX1_DB_URL):
-    ### This one is not run within a with loop, must be closed manually
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.metadata.bind = engine
-
-    db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
-    session = db_session()
-
-    return session
-
-
-def _load_table(tablename, db_address):
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.prepare(engine, reflect=True)
-
-    table = getattr(Base.classes, tablename)
-    return(table)
- 
 
 def _str_to_timestamp(datestring):
     """
@@ -172,6 +140,10 @@ def _get_tns_params(target):
 def target_post_save(target, created, group_names=None, wrapped_session=None):
  
     logger.info('Target post save hook: %s created: %s', target, created)
+
+    ### Drop any cached visibility plots in case the coordinates changed
+    invalidate_target_plots(target.id)
+    update_target_summary(target.id)
     
     if not created:
         ### Add the last nondetection and first detection from TNS, if it exists
@@ -310,6 +282,8 @@ def targetextra_post_save(targetextra, created):
             elif targetextra.key == 'redshift': # Now update the targets table with the redshift info
                 db_session.query(Targets).filter(Targets.id==targetextra.target_id).update({'redshift': targetextra.float_value})
             db_session.commit()
+    if targetextra.key in ('classification', 'redshift'):
+        update_target_summary(targetextra.target_id)
     logger.info('targetextra post save hook: %s created: %s', targetextra, created)
 
 
@@ -326,6 +300,7 @@ def targetname_post_save(targetname, created):
             if created:
                db_session.add(Names(targetid=targetid, name=name, datecreated=datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')))
                db_session.commit()
+    update_target_summary(targetname.target_id)
     logger.info('targetname post save hook: %s created: %s', targetname, created)
 
 
@@ -734,6 +709,7 @@ def change_interest_in_snex1(targetid, username, status):
 
         db_session.commit()
     
+    update_target_summary(targetid)
     logger.info('Synced {} interested in target {} with SNEx1'.format(username, targetid))
 
 
@@ -815,16 +791,25 @@ def sync_comment_with_snex1(comment, tablename, userid, targetid, snex1_rowid, w
     logger.info('Synced comment for table {} from user {}'.format(tablename, userid)) 
 
 
-def get_unreduced_spectra(allspec=True):
+def get_active_proposals():
     '''
-    Hook to find unreduced spectra for FLOYDS inbox
+    Ids of the active LCO proposals, cached for an hour
     '''
-    token = os.environ['LCO_APIKEY']
+    proposals = cache.get('active_lco_proposals')
+    if proposals is None:
+        token = os.environ['LCO_APIKEY']
+        response = requests.get('https://observe.lco.global/api/proposals?active=True&limit=50/',
+                                 headers={'Authorization': 'Token ' + token}).json()
+        proposals = [prop['id'] for prop in response['results']]
+        cache.set('active_lco_proposals', proposals, 3600)
+    return proposals
 
-    response = requests.get('https://observe.lco.global/api/proposals?active=True&limit=50/',
-                             headers={'Authorization': 'Token ' + token}).json()
 
-    proposals = [prop['id'] for prop in response['results']]
+def get_unreduced_spectra(allspec=True):
+    '''
+    Hook to find unreduced spectra for FLOYDS inbox
+    '''
+    proposals = get_active_proposals()
     
     with _get_session(db_address=settings.SNEX1_DB_URL) as db_session:
         speclcoraw = _load_table('speclcoraw', db_address=settings.SNEX1_DB_URL)
@@ -833,17 +818,21 @@ def get_unreduced_spectra(allspec=True):
         classifications = _load_table('classifications', db_address=settings.SNEX1_DB_URL)
         spec = _load_table('spec', db_address=settings.SNEX1_DB_URL)
 
-        original_filenames = [s.original for s in db_session.query(spec).filter(and_(spec.original!='None', spec.original!=None))]
+        ### Raw spectra with no reduced spectrum pointing back at them (anti-join),
+        ### for targets with at least one non-test name
+        reduced = exists().where(spec.original==speclcoraw.filename)
+        named = exists().where(and_(targetnames.targetid==speclcoraw.targetid, not_(targetnames.name.contains('test_'))))
 
-        unreduced_spectra = db_session.query(speclcoraw).join(
-                targets, speclcoraw.targetid==targets.id
+        unreduced_spectra = db_session.query(
+                speclcoraw.targetid, speclcoraw.propid, speclcoraw.dateobs, speclcoraw.filepath, speclcoraw.filename
         ).join(
-                targetnames, speclcoraw.targetid==targetnames.targetid
+                targets, speclcoraw.targetid==targets.id
         ).join(
                 classifications, targets.classificationid==classifications.id, isouter=True
         ).filter(
             and_(
-                not_(speclcoraw.filename.in_(original_filenames)), 
+                not_(reduced),
+                named,
                 speclcoraw.propid.in_(proposals),
                 speclcoraw.filename.contains('e00.fits'),
                 or_(
@@ -857,18 +846,17 @@ def get_unreduced_spectra(allspec=True):
                     ), 
                 speclcoraw.type == None
             ), 
-            not_(speclcoraw.filepath.contains('bad')), 
-            not_(targetnames.name.contains('test_'))
+            not_(speclcoraw.filepath.contains('bad'))
             )
-        )
+        ).order_by(speclcoraw.dateobs.desc()).all()
+
         targetids = [s.targetid for s in unreduced_spectra]
         propids = [s.propid for s in unreduced_spectra]
         dateobs = [s.dateobs for s in unreduced_spectra]
         paths = [s.filepath for s in unreduced_spectra]
         filenames = [s.filename for s in unreduced_spectra]
-        imgpaths = [s.filepath.replace('/supernova/data/floyds', '/snex2/data/floyds') + s.filename.replace('.fits', '.png') for s in unreduced_spectra]
 
-    return targetids, propids, dateobs, paths, filenames, imgpaths
+    return targetids, propids, dateobs, paths, filenames
 
 
 def get_standards_from_snex1(target_id):
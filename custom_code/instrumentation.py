@@ -0,0 +1,209 @@
+"""
+Opt-in timing of template tags, hooks and views.
+
+With INSTRUMENTATION_ENABLED, install() (run when the app is ready) wraps the
+render of every tag in TAG_LIBRARIES and every function in settings.HOOKS, and
+InstrumentationMiddleware times each request by view name. Each call records
+its wall time and the number and time of the SQL queries it made, both to the
+SNEx2 database through Django and to the SNEx1 database through SQLAlchemy.
+Times include nested calls, so a tag that runs a hook is charged for it too.
+
+The totals are kept per process and shown to staff on the instrumentation
+page. Calls slower than INSTRUMENTATION_LOG_MS are also logged with the
+measurements as structured tags.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTATION_ENABLED = getattr(settings, 'INSTRUMENTATION_ENABLED', False)
+INSTRUMENTATION_LOG_MS = getattr(settings, 'INSTRUMENTATION_LOG_MS', 250)
+
+TAG_LIBRARIES = [
+    'custom_code.templatetags.custom_code_tags',
+    'gw.templatetags.gw_tags',
+]
+
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+_started = timezone.now()
+_installed = False
+
+
+def _frames():
+    frames = getattr(_local, 'frames', None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+def _record_query(db, duration):
+    for frame in _frames():
+        frame[db + '_queries'] += 1
+        frame[db + '_time'] += duration
+
+
+def _django_wrapper(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        _record_query('sql', time.perf_counter() - start)
+
+
+def _before_snex1_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('instrumentation_start', []).append(time.perf_counter())
+
+
+def _after_snex1_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('instrumentation_start')
+    if starts:
+        _record_query('snex1', time.perf_counter() - starts.pop())
+
+
+def _record(kind, frame, elapsed):
+    key = (kind, frame['name'])
+    with _lock:
+        entry = _stats.get(key)
+        if entry is None:
+            entry = _stats[key] = {'kind': kind, 'name': frame['name'], 'calls': 0, 'time': 0.0, 'max_time': 0.0,
+                                   'sql_queries': 0, 'sql_time': 0.0, 'snex1_queries': 0, 'snex1_time': 0.0}
+        entry['calls'] += 1
+        entry['time'] += elapsed
+        entry['max_time'] = max(entry['max_time'], elapsed)
+        for field in ['sql_queries', 'sql_time', 'snex1_queries', 'snex1_time']:
+            entry[field] += frame[field]
+
+    if elapsed * 1000 >= INSTRUMENTATION_LOG_MS:
+        logger.info('{} {} took {:.0f} ms'.format(kind, frame['name'], elapsed * 1000), extra={'tags': {
+            'instrumentation': kind,
+            'name': frame['name'],
+            'time_ms': round(elapsed * 1000, 1),
+            'sql_queries': frame['sql_queries'],
+            'sql_time_ms': round(frame['sql_time'] * 1000, 1),
+            'snex1_queries': frame['snex1_queries'],
+            'snex1_time_ms': round(frame['snex1_time'] * 1000, 1)
+        }})
+
+
+@contextmanager
+def measure(kind, name):
+    """
+    Times the block and the queries made in it. Yields the measurement,
+    whose name can be changed before the block ends.
+    """
+    frames = _frames()
+    frame = {'name': name, 'sql_queries': 0, 'sql_time': 0.0, 'snex1_queries': 0, 'snex1_time': 0.0}
+    frames.append(frame)
+    start = time.perf_counter()
+    try:
+        if len(frames) == 1:
+            ### Only the outermost measurement needs to see the queries
+            with connection.execute_wrapper(_django_wrapper):
+                yield frame
+        else:
+            yield frame
+    finally:
+        elapsed = time.perf_counter() - start
+        frames.remove(frame)
+        _record(kind, frame, elapsed)
+
+
+def _timed(kind, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with measure(kind, name):
+            return func(*args, **kwargs)
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _timed_tag(name, compile_function):
+    @functools.wraps(compile_function)
+    def compile_tag(parser, token):
+        node = compile_function(parser, token)
+        node.render = _timed('tag', name, node.render)
+        return node
+    compile_tag._instrumented = True
+    return compile_tag
+
+
+def instrument_library(library, prefix):
+    """
+    Times the rendering of every tag registered in a template library
+    """
+    for name, compile_function in list(library.tags.items()):
+        if not getattr(compile_function, '_instrumented', False):
+            library.tags[name] = _timed_tag('{}.{}'.format(prefix, name), compile_function)
+
+
+def instrument_hooks():
+    """
+    Replaces each function in settings.HOOKS with a timed version,
+    which run_hook then finds by its dotted path
+    """
+    for name, path in getattr(settings, 'HOOKS', {}).items():
+        module_path, function_name = path.rsplit('.', 1)
+        try:
+            module = import_module(module_path)
+            function = getattr(module, function_name)
+        except (ImportError, AttributeError) as e:
+            logger.warning('Could not instrument hook {}: {}'.format(name, e))
+            continue
+        if not getattr(function, '_instrumented', False):
+            setattr(module, function_name, _timed('hook', name, function))
+
+
+def install():
+    """
+    Instruments the template tags, hooks and SNEx1 queries
+    """
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, 'before_cursor_execute', _before_snex1_query)
+    event.listen(Engine, 'after_cursor_execute', _after_snex1_query)
+
+    instrument_hooks()
+    for module_path in TAG_LIBRARIES:
+        instrument_library(import_module(module_path).register, module_path.rsplit('.', 1)[-1])
+    logger.info('Instrumentation enabled')
+
+
+def get_stats():
+    """
+    Totals for this process, slowest first, with times in ms
+    """
+    with _lock:
+        entries = [dict(entry) for entry in _stats.values()]
+
+    for entry in entries:
+        for field in ['time', 'max_time', 'sql_time', 'snex1_time']:
+            entry[field + '_ms'] = round(entry.pop(field) * 1000, 1)
+        entry['mean_time_ms'] = round(entry['time_ms'] / entry['calls'], 1)
+        entry['mean_queries'] = round((entry['sql_queries'] + entry['snex1_queries']) / entry['calls'], 1)
+    return {'pid': os.getpid(), 'since': _started, 'enabled': _installed,
+            'entries': sorted(entries, key=lambda e: e['time_ms'], reverse=True)}
+
+
+def reset_stats():
+    global _started
+    with _lock:
+        _stats.clear()
+        _started = timezone.now()
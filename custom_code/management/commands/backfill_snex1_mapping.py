@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from tom_dataproducts.models import ReducedDatum
+import json
+import logging
+
+from custom_code.models import ReducedDatumExtra, SNEx1Mapping
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Fills the SNEx1 to SNEx2 id mapping table from the snex_ids stored with the synced photometry and spectra'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=5000, help='Number of mapping rows to insert at once')
+
+    def handle(self, *args, **options):
+
+        batch_size = options['batch_size']
+
+        ### Photometry stores the SNEx1 photlco id in its value
+        photometry = ReducedDatum.objects.filter(data_type='photometry', value__has_key='snex_id').values_list('id', 'value__snex_id')
+        mappings = []
+        for datum_id, snex_id in photometry.iterator(chunk_size=batch_size):
+            self.add_mapping(mappings, datum_id, snex_id)
+
+        ### Older rows have the value stored as a JSON string instead of an object
+        legacy = ReducedDatum.objects.filter(data_type='photometry', value__icontains='snex_id').exclude(
+            value__has_key='snex_id'
+        ).values_list('id', 'value')
+        for datum_id, value in legacy.iterator(chunk_size=batch_size):
+            try:
+                while isinstance(value, str):
+                    value = json.loads(value)
+                snex_id = value.get('snex_id')
+            except (AttributeError, ValueError):
+                snex_id = None
+            self.add_mapping(mappings, datum_id, snex_id)
+
+        SNEx1Mapping.objects.bulk_create(mappings, batch_size=batch_size, ignore_conflicts=True)
+        self.stdout.write('Mapped {} photometry points'.format(len(mappings)))
+
+        ### Spectra have a ReducedDatumExtra with both ids
+        spectra = {}
+        for value in ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id').values_list('value', flat=True):
+            value = json.loads(value)
+            if value.get('snex_id') and value.get('snex2_id'):
+                spectra[int(value['snex2_id'])] = int(value['snex_id'])
+
+        data_products = dict(ReducedDatum.objects.filter(id__in=spectra.keys()).values_list('id', 'data_product_id'))
+        mappings = [SNEx1Mapping(table='spec', snex1_id=snex_id, reduced_datum_id=datum_id, data_product_id=data_products.get(datum_id))
+                    for datum_id, snex_id in spectra.items() if datum_id in data_products]
+        SNEx1Mapping.objects.bulk_create(mappings, batch_size=batch_size, ignore_conflicts=True)
+        self.stdout.write('Mapped {} spectra'.format(len(mappings)))
+
+        ### The sync only finds photometry through the mapping, so any synced
+        ### point left without one would stop getting SNEx1 updates and deletes
+        unmapped = ReducedDatum.objects.filter(data_type='photometry', value__icontains='snex_id').exclude(
+            id__in=SNEx1Mapping.objects.filter(table='photlco').values('reduced_datum_id')
+        )
+        unmapped_count = unmapped.count()
+        if unmapped_count:
+            raise CommandError('{} photometry points with a snex_id have no mapping, e.g. ReducedDatum ids {}'.format(
+                unmapped_count, list(unmapped.values_list('id', flat=True)[:10])
+            ))
+
+    def add_mapping(self, mappings, datum_id, snex_id):
+        try:
+            mappings.append(SNEx1Mapping(table='photlco', snex1_id=int(snex_id), reduced_datum_id=datum_id))
+        except (TypeError, ValueError):
+            logger.warning('Skipping photometry {} with snex_id {}'.format(datum_id, snex_id))
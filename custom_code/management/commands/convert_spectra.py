@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from tom_dataproducts.models import ReducedDatum
+import logging
+
+from custom_code.spectra import is_legacy_spectrum, convert_legacy_spectrum
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Rewrites spectra stored as one dict per pixel as parallel wavelength and flux arrays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target_id', help='Only convert the spectra of this target')
+        parser.add_argument('--batch_size', type=int, default=200, help='Number of spectra to save at once')
+        parser.add_argument('--dry_run', action='store_true', help='Count the spectra to convert without saving them')
+
+    def handle(self, *args, **options):
+
+        spectra = ReducedDatum.objects.filter(data_type='spectroscopy').order_by('id')
+        if options.get('target_id'):
+            spectra = spectra.filter(target_id=int(options['target_id']))
+
+        batch_size = options['batch_size']
+        batch = []
+        converted = 0
+        for spectrum in spectra.only('id', 'value').iterator(chunk_size=batch_size):
+            try:
+                if not is_legacy_spectrum(spectrum.value):
+                    continue
+                spectrum.value = convert_legacy_spectrum(spectrum.value)
+            except Exception as e:
+                logger.warning('Could not convert spectrum {}: {}'.format(spectrum.id, e))
+                continue
+
+            converted += 1
+            if options['dry_run']:
+                continue
+            batch.append(spectrum)
+            if len(batch) >= batch_size:
+                ReducedDatum.objects.bulk_update(batch, ['value'])
+                batch = []
+
+        if batch:
+            ReducedDatum.objects.bulk_update(batch, ['value'])
+
+        if options['dry_run']:
+            self.stdout.write('{} spectra would be converted'.format(converted))
+        else:
+            self.stdout.write('Converted {} spectra'.format(converted))
@@ -17,12 +17,10 @@ from custom_code.management.commands.ingest_observations import get_session, loa
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from guardian.shortcuts import assign_perm
-from custom_code.models import ReducedDatumExtra
+from custom_code.models import ReducedDatumExtra, SNEx1Mapping
 from django.conf import settings
 
 
-engine1 = create_engine(settings.SNEX1_DB_URL)
-
 def get_comments(targetid, tablename, notes, users, days_ago):
     
     content_dict = {'targets': ContentType.objects.get(model='basetarget').id,
@@ -78,13 +76,8 @@ def get_comments(targetid, tablename, notes, users, days_ago):
                     newcomment.save()
 
             elif tablename == 'spec':
-                # Need to get reduceddatum id from the reduceddatumextra table
-                rdes = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', target_id=int(comment.targetid))
-                snex2_id = False
-                for rde in rdes:
-                    if int(comment.tableid) == json.loads(rde.value)['snex_id']:
-                        snex2_id = json.loads(rde.value)['snex2_id']
-                        break
+                # Need to get reduceddatum id from the SNEx1 mapping table
+                snex2_id = SNEx1Mapping.objects.filter(table='spec', snex1_id=int(comment.tableid)).values_list('reduced_datum_id', flat=True).first()
                 if snex2_id:
                     # Check if it already exists in SNEx2
                     old_comment = Comment.objects.filter(object_pk=snex2_id, comment=comment.note, content_type_id=content_dict[tablename]).first()
@@ -18,9 +18,6 @@ from django.contrib.auth.models import User
 from django.conf import settings
 
 
-engine1 = create_engine(settings.SNEX1_DB_URL)
-
-
 class Command(BaseCommand):
 
     help = 'Ingests interested people from SNEx1 to SNEx2'
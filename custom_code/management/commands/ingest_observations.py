@@ -18,57 +18,7 @@ from tom_targets.models import Target
 from django.contrib.auth.models import Group
 from guardian.shortcuts import assign_perm
 from django.conf import settings
-
-
-engine1 = create_engine(settings.SNEX1_DB_URL)
-
-@contextmanager
-def get_session(db_address=settings.SNEX1_DB_URL):
-    """
-    Get a connection to a database
-
-    Returns
-    ----------
-    session: SQLAlchemy database session
-    """
-    Base = automap_base()
-    if db_address==settings.SNEX1_DB_URL:
-        Base.metadata.bind = engine1
-        db_session = sessionmaker(bind=engine1, autoflush=False, expire_on_commit=False)
-
-    session = db_session()
-
-    try:
-        yield session
-        session.commit()
-
-    except:
-        session.rollback()
-        raise
-
-    finally:
-        session.close()
-
-
-def load_table(tablename, db_address=settings.SNEX1_DB_URL):
-    """
-    Load a table with its data from a database
-
-    Parameters
-    ----------
-    tablename: str, the name of the table to load
-    db_address: str, sqlalchemy address to the table being loaded
-
-    Returns
-    ----------
-    table: sqlalchemy table object
-    """
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.prepare(engine, reflect=True)
-
-    table = getattr(Base.classes, tablename)
-    return table
+from custom_code.snex1_db import get_session, load_table
 
 
 def update_permissions(groupid, obs, snex1_groups):
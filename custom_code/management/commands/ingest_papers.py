@@ -15,8 +15,6 @@ from custom_code.management.commands.ingest_observations import get_session, loa
 from custom_code.models import Papers
 from django.conf import settings
 
-engine1 = create_engine(settings.SNEX1_DB_URL)
-
 
 class Command(BaseCommand):
 
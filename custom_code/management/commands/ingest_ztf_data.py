@@ -6,6 +6,7 @@ from astropy.time import Time, TimezoneInfo
 from tom_dataproducts.models import ReducedDatum, DataProduct
 from tom_targets.models import Target
 from custom_code.models import ReducedDatumExtra
+from custom_code.target_summary import deferred_target_summaries
 
 logger = logging.getLogger(__name__)
 
@@ -103,12 +104,14 @@ class Command(BaseCommand):
         if options['target_id']:
             target = Target.objects.get(id=int(options['target_id']))
             
-            if options['delete']:
-                delete_ztf_data(target)
+            with deferred_target_summaries():
+                if options['delete']:
+                    delete_ztf_data(target)
             
-            get_ztf_data(target)
+                get_ztf_data(target)
         
         else:
             target_query = Target.objects.all()
             for target in target_query:
-                get_ztf_data(target)
+                with deferred_target_summaries():
+                    get_ztf_data(target)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connections
+from sqlalchemy import and_
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import os
+
+from custom_code.snex1_db import get_session, load_table
+from custom_code.thumbnail_cache import pregenerate_thumbnail, evict_thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Renders the default thumbnails of recent SNEx1 photlco images into the thumbnail cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=1.0, help='Render images taken within this many days')
+        parser.add_argument('--target_id', type=int, help='Only render the images of this target')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of worker processes')
+
+    def handle(self, *args, **options):
+
+        since = datetime.utcnow() - timedelta(days=options['days'])
+
+        with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
+            Photlco = load_table('photlco', db_address=settings.SNEX1_DB_URL)
+            query = db_session.query(Photlco.filepath, Photlco.filename, Photlco.psfx, Photlco.psfy).filter(
+                and_(Photlco.filetype==1, Photlco.dateobs>=since.date()))
+            if options.get('target_id'):
+                query = query.filter(Photlco.targetid==options['target_id'])
+
+            ### Same paths as the find_images_from_snex1 hook
+            jobs = []
+            for filepath, filename, psfx, psfy in query:
+                filepath = filepath.replace('/supernova/data/lsc/', '').replace('/supernova/data/', '')
+                jobs.append(('data/fits/'+filepath+filename.replace('.fits', '')+'.fits',
+                             int(round(psfx or 9999)), int(round(psfy or 9999))))
+
+        self.stdout.write('Rendering thumbnails for {} images'.format(len(jobs)))
+
+        ### Don't share database connections with the forked workers
+        connections.close_all()
+
+        rendered = 0
+        with ProcessPoolExecutor(max_workers=max(options['processes'] or 1, 1)) as pool:
+            for filename, key in pool.map(pregenerate_thumbnail, jobs, chunksize=8):
+                if key:
+                    rendered += 1
+
+        evict_thumbnails()
+        self.stdout.write('Rendered {} of {} thumbnails'.format(rendered, len(jobs)))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+import logging
+
+from gw.galaxy_catalog import build_galaxy_catalog, catalog_paths, default_preprocessed_path
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Writes the memory-mapped copy of the galaxy catalog used to rank galaxies for GW events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filename', help='Preprocess this catalog instead of CATALOG_PATH in gw_config.ini')
+        parser.add_argument('--outdir', help='Write the copy under this directory instead of PREPROCESSED_CATALOG_PATH')
+
+    def handle(self, *args, **options):
+
+        if options.get('filename'):
+            catalog_path = options['filename']
+            preprocessed_path = default_preprocessed_path(catalog_path)
+        else:
+            catalog_path, preprocessed_path = catalog_paths()
+        if options.get('outdir'):
+            preprocessed_path = options['outdir']
+
+        outdir = build_galaxy_catalog(catalog_path, preprocessed_path)
+        self.stdout.write('Preprocessed galaxy catalog is in {}'.format(outdir))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import time
+
+from gw.alert_queue import latency_summary, requeue_stale_jobs, run_pending_jobs, GW_ALERT_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Processes queued GW alerts (for GW_ALERT_QUEUE_BACKEND = "database")'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the pending alerts and exit instead of polling')
+        parser.add_argument('--stats', type=float, nargs='?', const=7, help='Print the job counts and latencies of the last N days (default 7) and exit')
+
+    def handle(self, *args, **options):
+
+        if options.get('stats') is not None:
+            summary = latency_summary(since=timezone.now() - timedelta(days=options['stats']))
+            for key, value in summary.items():
+                self.stdout.write('{}: {}'.format(key, value))
+            return
+
+        requeue_stale_jobs()
+        while True:
+            count = run_pending_jobs()
+            if count:
+                self.stdout.write('Processed {} GW alerts'.format(count))
+            close_old_connections()
+            if options['once']:
+                break
+            time.sleep(GW_ALERT_POLL_INTERVAL)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+import logging
+
+from custom_code.target_summary import rebuild_target_summaries, update_target_summaries
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Recomputes the denormalized TargetSummary rows of all targets, or of the given targets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target_id', type=int, nargs='*', help='Only rebuild the summaries of these targets')
+        parser.add_argument('--batch_size', type=int, default=500, help='Number of targets summarized at once')
+
+    def handle(self, *args, **options):
+
+        if options.get('target_id'):
+            update_target_summaries(options['target_id'], batch_size=options['batch_size'])
+            self.stdout.write('Rebuilt the summaries of {} targets'.format(len(options['target_id'])))
+        else:
+            count = rebuild_target_summaries(batch_size=options['batch_size'])
+            self.stdout.write('Rebuilt the summaries of {} targets'.format(count))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+import logging
+
+from custom_code.floyds_inbox import refresh_floyds_inbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the cached list of unreduced spectra shown in the FLOYDS inbox'
+
+    def handle(self, *args, **options):
+
+        rows = refresh_floyds_inbox()
+        self.stdout.write('Cached {} unreduced spectra'.format(len(rows)))
@@ -23,8 +23,6 @@ from guardian.shortcuts import assign_perm
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 
-engine1 = create_engine(settings.SNEX1_DB_URL)
-
 
 def create_new_sequence(requestsid, created, modified, snex2_param, users, notes, db_session, active=True):
 
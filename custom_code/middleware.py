@@ -0,0 +1,69 @@
+import threading
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from custom_code.instrumentation import INSTRUMENTATION_ENABLED, measure
+
+_local = threading.local()
+
+
+def get_request_cache():
+    """
+    Returns the dictionary used to memoize data for the current request,
+    or None when running outside of a request (management commands,
+    scripts), in which case nothing should be memoized
+    """
+    return getattr(_local, 'cache', None)
+
+
+class RequestCacheMiddleware:
+    """
+    Gives every request its own memoization dictionary, so that template
+    tags rendered on the same page can share data loaded from the database
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.cache = {}
+        try:
+            return self.get_response(request)
+        finally:
+            _local.cache = None
+
+
+class TargetSummaryMiddleware:
+    """
+    Updates the summaries of the targets whose data changed during
+    a request once, when the request is done
+    """
+
+    def __init__(self, get_response):
+        ### target_summary needs the template tags, which need this module
+        from custom_code.target_summary import deferred_target_summaries
+        self.deferred_target_summaries = deferred_target_summaries
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with self.deferred_target_summaries():
+            return self.get_response(request)
+
+
+class InstrumentationMiddleware:
+    """
+    Times each request and its queries under the name of the view
+    it resolved to, when INSTRUMENTATION_ENABLED is set
+    """
+
+    def __init__(self, get_response):
+        if not INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure('view', '<unresolved>') as frame:
+            response = self.get_response(request)
+            if request.resolver_match is not None:
+                frame['name'] = request.resolver_match.view_name
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('custom_code', '0012_merge_0010_timeused_0011_nedlvscatalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LightcurveCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_key', models.CharField(help_text='Sorted ids of the groups the light curve was built for, or all', max_length=255, verbose_name='Group Key')),
+                ('data', models.BinaryField(help_text='Photometry columns stored as a compressed npz file', verbose_name='Data')),
+                ('last_datum_id', models.IntegerField(default=0, help_text='Highest ReducedDatum id included in the stored photometry', verbose_name='Last Datum ID')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tom_targets.target')),
+            ],
+            options={
+                'unique_together': {('target', 'group_key')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_code', '0013_lightcurvecache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SNEx1Mapping',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(help_text='Name of the SNEx1 table, i.e. photlco or spec', max_length=50, verbose_name='SNEx1 Table')),
+                ('snex1_id', models.IntegerField(help_text='ID of the row in the SNEx1 table', verbose_name='SNEx1 ID')),
+                ('reduced_datum_id', models.IntegerField(db_index=True, help_text='ID of the ReducedDatum synced from this row', verbose_name='ReducedDatum ID')),
+                ('data_product_id', models.IntegerField(blank=True, help_text='ID of the DataProduct synced from this row, if any', null=True, verbose_name='DataProduct ID')),
+            ],
+            options={
+                'unique_together': {('table', 'snex1_id')},
+            },
+        ),
+    ]
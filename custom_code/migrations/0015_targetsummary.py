@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-18 16:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_auto_20200714_1832'),
+        ('custom_code', '0014_snex1mapping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('best_name', models.CharField(default='', help_text='SN or AT designation if there is one, otherwise the target name', max_length=100, verbose_name='Best Name')),
+                ('classification', models.CharField(blank=True, default='', help_text='Classification target extra', max_length=100, verbose_name='Classification')),
+                ('redshift', models.FloatField(blank=True, help_text='Redshift target extra', null=True, verbose_name='Redshift')),
+                ('latest_magnitude', models.FloatField(blank=True, db_index=True, help_text='Magnitude of the most recent photometry point', null=True, verbose_name='Latest Magnitude')),
+                ('latest_filter', models.CharField(blank=True, default='', help_text='Filter of the most recent photometry point', max_length=20, verbose_name='Latest Filter')),
+                ('last_photometry', models.DateTimeField(blank=True, db_index=True, help_text='Time of the most recent photometry point', null=True, verbose_name='Last Photometry')),
+                ('num_spectra', models.IntegerField(default=0, help_text='Number of spectra of this target', verbose_name='Number of Spectra')),
+                ('active_cadence', models.BooleanField(db_index=True, default=False, help_text='Whether the target has an active dynamic cadence', verbose_name='Active Cadence')),
+                ('interest_count', models.IntegerField(default=0, help_text='Number of users interested in this target', verbose_name='Interest Count')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('target', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='tom_targets.target')),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_code', '0015_targetsummary'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='lightcurvecache',
+            name='last_datum_id',
+        ),
+        migrations.AlterField(
+            model_name='lightcurvecache',
+            name='data',
+            field=models.BinaryField(help_text='Photometry columns stored as a compressed npz file, empty while it is being built', verbose_name='Data'),
+        ),
+    ]
@@ -539,3 +539,86 @@ class TimeUsed(models.Model):
 
     class Meta:
         unique_together = ['semester_name', 'telescope_class']
+
+
+class LightcurveCache(models.Model):
+    target = models.ForeignKey(Target, on_delete=models.CASCADE)
+
+    group_key = models.CharField(
+        max_length=255, verbose_name='Group Key',
+        help_text='Sorted ids of the groups the light curve was built for, or all'
+    )
+
+    data = models.BinaryField(
+        verbose_name='Data', help_text='Photometry columns stored as a compressed npz file, empty while it is being built'
+    )
+
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['target', 'group_key']
+
+
+class SNEx1Mapping(models.Model):
+    table = models.CharField(
+        max_length=50, verbose_name='SNEx1 Table', help_text='Name of the SNEx1 table, i.e. photlco or spec'
+    )
+
+    snex1_id = models.IntegerField(
+        verbose_name='SNEx1 ID', help_text='ID of the row in the SNEx1 table'
+    )
+
+    reduced_datum_id = models.IntegerField(
+        verbose_name='ReducedDatum ID', help_text='ID of the ReducedDatum synced from this row', db_index=True
+    )
+
+    data_product_id = models.IntegerField(
+        verbose_name='DataProduct ID', help_text='ID of the DataProduct synced from this row, if any', null=True, blank=True
+    )
+
+    class Meta:
+        unique_together = ['table', 'snex1_id']
+
+
+class TargetSummary(models.Model):
+    target = models.OneToOneField(
+        Target, on_delete=models.CASCADE, related_name='summary', db_constraint=False
+    )
+
+    best_name = models.CharField(
+        max_length=100, default='', verbose_name='Best Name', help_text='SN or AT designation if there is one, otherwise the target name'
+    )
+
+    classification = models.CharField(
+        max_length=100, default='', blank=True, verbose_name='Classification', help_text='Classification target extra'
+    )
+
+    redshift = models.FloatField(
+        null=True, blank=True, verbose_name='Redshift', help_text='Redshift target extra'
+    )
+
+    latest_magnitude = models.FloatField(
+        null=True, blank=True, db_index=True, verbose_name='Latest Magnitude', help_text='Magnitude of the most recent photometry point'
+    )
+
+    latest_filter = models.CharField(
+        max_length=20, default='', blank=True, verbose_name='Latest Filter', help_text='Filter of the most recent photometry point'
+    )
+
+    last_photometry = models.DateTimeField(
+        null=True, blank=True, db_index=True, verbose_name='Last Photometry', help_text='Time of the most recent photometry point'
+    )
+
+    num_spectra = models.IntegerField(
+        default=0, verbose_name='Number of Spectra', help_text='Number of spectra of this target'
+    )
+
+    active_cadence = models.BooleanField(
+        default=False, db_index=True, verbose_name='Active Cadence', help_text='Whether the target has an active dynamic cadence'
+    )
+
+    interest_count = models.IntegerField(
+        default=0, verbose_name='Interest Count', help_text='Number of users interested in this target'
+    )
+
+    modified = models.DateTimeField(auto_now=True)
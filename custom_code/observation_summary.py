@@ -0,0 +1,58 @@
+"""
+Bulk loading of observation groups for the observation_summary template tag.
+
+load_observation_groups fetches the records and comments of a list of
+observation groups, and the names of the comment authors, in a constant number
+of queries, and picks out the records the summary is built from: the pending
+and template requests and the first and latest records of each group.
+"""
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
+from django_comments.models import Comment
+from tom_observations.models import ObservationGroup, ObservationRecord
+
+
+def load_observation_groups(group_ids):
+    """
+    Returns a dictionary keyed by group id with the pending, template,
+    first and latest records of each group and its comments
+    """
+    group_ids = list(group_ids)
+    groups = {group_id: {'pending': None, 'template': None, 'first': None, 'latest': None, 'comments': []}
+              for group_id in group_ids}
+    if not group_ids:
+        return groups
+
+    ### All records of the groups, in the order .first() would use
+    records = ObservationRecord.objects.filter(observationgroup__in=group_ids).annotate(
+        group_id=F('observationgroup')
+    ).order_by(*(ObservationRecord._meta.ordering or ['pk']))
+
+    for record in records:
+        group = groups[record.group_id]
+        if record.observation_id == 'template pending' and group['pending'] is None:
+            group['pending'] = record
+        if record.observation_id == 'template' and group['template'] is None:
+            group['template'] = record
+        if group['first'] is None or record.id < group['first'].id:
+            group['first'] = record
+        if group['latest'] is None or record.id > group['latest'].id:
+            group['latest'] = record
+
+    ### Comments on the groups and the names of their authors
+    content_type = ContentType.objects.get_for_model(ObservationGroup)
+    comments = list(Comment.objects.filter(
+        content_type=content_type, object_pk__in=[str(group_id) for group_id in group_ids]
+    ).order_by('id'))
+    first_names = dict(User.objects.filter(
+        username__in=set(comment.user_name for comment in comments)
+    ).values_list('username', 'first_name'))
+
+    for comment in comments:
+        group = groups.get(int(comment.object_pk))
+        if group is not None:
+            group['comments'].append('{}: {}'.format(first_names.get(comment.user_name, comment.user_name), comment.comment))
+
+    return groups
+
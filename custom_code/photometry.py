@@ -0,0 +1,286 @@
+"""
+Columnar photometry access shared by the light curve plots, the photometry
+table, the photometry download and the Dash light curve app.
+
+A target's permitted photometry is fetched with a single .values_list()
+query, decoded once into NumPy columns, and memoized for the rest of the
+request, so each page only hits the database once per light curve.
+
+The decoded columns are also stored per target and permission group set in
+the LightcurveCache table. The stored columns are dropped whenever a target's
+photometry is added, changed or deleted, or who can see it changes, and are
+rebuilt the next time the light curve is read.
+"""
+import datetime
+import io
+import json
+import logging
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from guardian.shortcuts import get_objects_for_user
+from tom_dataproducts.models import ReducedDatum
+
+from custom_code.middleware import get_request_cache
+from custom_code.models import LightcurveCache
+
+logger = logging.getLogger(__name__)
+
+FILTER_TRANSLATE = {'U': 'U', 'B': 'B', 'V': 'V',
+    'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
+    'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2',
+    'UVW1': 'UVW1'}
+
+PHOTOMETRY_FIELDS = ('id', 'timestamp', 'value', 'data_product_id', 'source_name')
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_mjd(timestamps):
+    seconds = np.array([t.timestamp() for t in timestamps], dtype=float)
+    return seconds / 86400.0 + 40587.0
+
+
+class Photometry:
+    """
+    Photometry of one target stored as parallel NumPy columns.
+
+    Numeric columns (magnitude, error, limit) use NaN for missing values,
+    data_product_id uses -1 for data not attached to a data product, and
+    the string columns are object arrays with '' for missing values.
+    """
+
+    COLUMNS = ('id', 'timestamp', 'magnitude', 'error', 'limit', 'filter',
+               'telescope', 'source_name', 'data_product_id', 'has_value', 'has_filter',
+               'has_magnitude', 'background_subtracted', 'subtraction_algorithm',
+               'template_source', 'reduction_type')
+
+    def __init__(self, columns):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self._mjd = columns.get('_mjd')
+
+    @classmethod
+    def from_rows(cls, rows):
+        n = len(rows)
+        columns = {
+            'id': np.empty(n, dtype=np.int64),
+            'timestamp': np.empty(n, dtype=object),
+            'magnitude': np.full(n, np.nan),
+            'error': np.full(n, np.nan),
+            'limit': np.full(n, np.nan),
+            'filter': np.full(n, '', dtype=object),
+            'telescope': np.full(n, '', dtype=object),
+            'source_name': np.full(n, '', dtype=object),
+            'data_product_id': np.full(n, -1, dtype=np.int64),
+            'has_value': np.zeros(n, dtype=bool),
+            'has_filter': np.zeros(n, dtype=bool),
+            'has_magnitude': np.zeros(n, dtype=bool),
+            'background_subtracted': np.zeros(n, dtype=bool),
+            'subtraction_algorithm': np.full(n, '', dtype=object),
+            'template_source': np.full(n, '', dtype=object),
+            'reduction_type': np.full(n, '', dtype=object),
+        }
+        for i, (pk, timestamp, value, data_product_id, source_name) in enumerate(rows):
+            columns['id'][i] = pk
+            columns['timestamp'][i] = timestamp
+            columns['source_name'][i] = source_name or ''
+            if data_product_id is not None:
+                columns['data_product_id'][i] = data_product_id
+
+            if not value:
+                continue
+            if isinstance(value, str):
+                value = json.loads(value)
+
+            columns['has_value'][i] = True
+            columns['magnitude'][i] = _to_float(value.get('magnitude'))
+            columns['error'][i] = _to_float(value.get('error', value.get('magnitude_error')))
+            columns['limit'][i] = _to_float(value.get('limit'))
+            columns['filter'][i] = value.get('filter', '')
+            columns['telescope'][i] = value.get('telescope', '')
+            columns['has_filter'][i] = 'filter' in value
+            columns['has_magnitude'][i] = bool(value.get('magnitude', ''))
+            columns['background_subtracted'][i] = value.get('background_subtracted', '') == True
+            columns['subtraction_algorithm'][i] = value.get('subtraction_algorithm', '')
+            columns['template_source'][i] = value.get('template_source', '')
+            columns['reduction_type'][i] = value.get('reduction_type', '')
+
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.id)
+
+    @property
+    def mjd(self):
+        if self._mjd is None:
+            self._mjd = _to_mjd(self.timestamp)
+        return self._mjd
+
+    def select(self, mask):
+        """
+        Returns a new Photometry with only the rows selected by a boolean mask
+        """
+        columns = {name: getattr(self, name)[mask] for name in self.COLUMNS}
+        if self._mjd is not None:
+            columns['_mjd'] = self._mjd[mask]
+        return Photometry(columns)
+
+    def append(self, other):
+        """
+        Returns a new Photometry with the rows of both, ordered by time
+        """
+        mjd = np.concatenate([self.mjd, other.mjd])
+        order = np.argsort(mjd, kind='stable')
+        columns = {name: np.concatenate([getattr(self, name), getattr(other, name)])[order]
+                   for name in self.COLUMNS}
+        columns['_mjd'] = mjd[order]
+        return Photometry(columns)
+
+    def to_bytes(self):
+        """
+        Serializes the columns to a compressed .npz blob. Timestamps are
+        stored as integer microseconds and strings as fixed width unicode, so the blob
+        can be read back without pickle.
+        """
+        columns = {name: getattr(self, name) for name in self.COLUMNS if name != 'timestamp'}
+        for name, column in columns.items():
+            if column.dtype == object:
+                columns[name] = column.astype(str)
+        columns['mjd'] = self.mjd
+        columns['epoch_us'] = np.array([round(t.timestamp()*1e6) for t in self.timestamp], dtype=np.int64)
+
+        buf = io.BytesIO()
+        np.savez_compressed(buf, **columns)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        with np.load(io.BytesIO(bytes(blob)), allow_pickle=False) as stored:
+            columns = {name: stored[name] for name in stored.files}
+        for name, column in columns.items():
+            if column.dtype.kind == 'U':
+                columns[name] = column.astype(object)
+
+        columns['_mjd'] = columns.pop('mjd')
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        columns['timestamp'] = np.array([epoch + datetime.timedelta(microseconds=int(us)) for us in columns.pop('epoch_us')],
+                                        dtype=object)
+        return cls(columns)
+
+    def by_filter(self, filter_translate=FILTER_TRANSLATE):
+        """
+        Groups the rows with a value by translated filter name, in order of
+        first appearance, as {filter: {'time', 'magnitude', 'error', 'limit', 'index'}}
+        """
+        translated = np.array([filter_translate.get(f, '') for f in self.filter], dtype=object)
+        grouped = {}
+        for filt in dict.fromkeys(translated[self.has_value]):
+            index = np.flatnonzero((translated == filt) & self.has_value)
+            grouped[filt] = {'time': self.timestamp[index],
+                             'magnitude': self.magnitude[index],
+                             'error': self.error[index],
+                             'limit': self.limit[index],
+                             'index': index}
+        return grouped
+
+
+def photometry_queryset(target_id, user=None):
+    datums = ReducedDatum.objects.filter(target_id=target_id, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
+    if user is not None and not settings.TARGET_PERMISSIONS_ONLY:
+        datums = get_objects_for_user(user,
+                                      'tom_dataproducts.view_reduceddatum',
+                                      klass=datums)
+    return datums
+
+
+def load_photometry(target_id, user=None):
+    """
+    Runs the single query for a target's photometry, ordered by time
+    """
+    rows = list(photometry_queryset(target_id, user).order_by('timestamp').values_list(*PHOTOMETRY_FIELDS))
+    return Photometry.from_rows(rows)
+
+
+def permission_group_key(user):
+    """
+    Key of the stored light curve shared by every user with the same groups.
+    Superusers, and everything run without a user, see all the photometry.
+    """
+    if user is None or settings.TARGET_PERMISSIONS_ONLY or user.is_superuser:
+        return 'all'
+    group_ids = sorted(user.groups.values_list('id', flat=True))
+    return ','.join(str(g) for g in group_ids)
+
+
+def get_cached_photometry(target_id, user=None):
+    """
+    Returns the stored Photometry for this target and the user's groups,
+    or builds and stores it if there is none
+    """
+    group_key = permission_group_key(user)
+    entry = LightcurveCache.objects.filter(target_id=target_id, group_key=group_key).first()
+
+    if entry is not None and entry.data:
+        try:
+            return Photometry.from_bytes(entry.data)
+        except Exception as e:
+            logger.warning('Could not read stored light curve for target {}: {}'.format(target_id, e))
+
+    ### Reserve the row before reading the photometry, so that if it is
+    ### invalidated while the light curve is built the row is gone and
+    ### the stale columns are not stored
+    if entry is None:
+        entry, _ = LightcurveCache.objects.get_or_create(target_id=target_id, group_key=group_key, defaults={'data': b''})
+    photometry = load_photometry(target_id, user)
+    LightcurveCache.objects.filter(id=entry.id).update(data=photometry.to_bytes())
+    return photometry
+
+
+def invalidate_lightcurve(target_id):
+    """
+    Drops the stored light curves of a target, for when its photometry
+    (or who can see it) changes. Inside a transaction this waits until it
+    commits, so the light curve is not rebuilt from the old rows.
+    """
+    transaction.on_commit(lambda: LightcurveCache.objects.filter(target_id=target_id).delete())
+
+
+@receiver(post_save, sender=ReducedDatum)
+def _reduced_datum_saved(sender, instance, created, **kwargs):
+    if instance.data_type == settings.DATA_PRODUCT_TYPES['photometry'][0]:
+        invalidate_lightcurve(instance.target_id)
+
+
+@receiver(post_delete, sender=ReducedDatum)
+def _reduced_datum_deleted(sender, instance, **kwargs):
+    if instance.data_type == settings.DATA_PRODUCT_TYPES['photometry'][0]:
+        invalidate_lightcurve(instance.target_id)
+
+
+def get_photometry(target, user=None):
+    """
+    Returns the Photometry for a target (or target id) visible to user,
+    or all of it if user is None. The result comes from the stored light
+    curve and is memoized for the rest of the current request.
+    """
+    target_id = getattr(target, 'id', target)
+    user_id = getattr(user, 'id', None) if user is not None else None
+    key = ('photometry', int(target_id), user is not None, user_id)
+
+    cache = get_request_cache()
+    if cache is not None and key in cache:
+        return cache[key]
+
+    photometry = get_cached_photometry(int(target_id), user)
+    if cache is not None:
+        cache[key] = photometry
+    return photometry
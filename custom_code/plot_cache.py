@@ -0,0 +1,94 @@
+"""
+Time-bucketed cache for the visibility and moon plots on the target pages.
+
+The plots only change on the scale of minutes, so the numeric series and the
+rendered Plotly div are stored together in the configured Django cache, keyed
+by the target coordinates, the plot parameters and the current time bucket.
+Each target also has a version number in the cache that is bumped when its
+coordinates change, which drops every plot cached for the old position.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PLOT_CACHE_BUCKET = getattr(settings, 'PLOT_CACHE_BUCKET', 600) # seconds
+PLOT_CACHE_STATS_KEY = 'plot_cache_stats:{}'
+
+
+def time_bucket(bucket_seconds=PLOT_CACHE_BUCKET, now=None):
+    if now is None:
+        now = time.time()
+    return int(now // bucket_seconds)
+
+
+def _target_version(target_id):
+    return cache.get_or_set('plot_cache_version:{}'.format(target_id), 1, timeout=None)
+
+
+def invalidate_target_plots(target_id):
+    """
+    Bumps the cache version for this target, so plots cached
+    for its previous coordinates are never served again
+    """
+    key = 'plot_cache_version:{}'.format(target_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, timeout=None)
+
+
+def _record(result):
+    key = PLOT_CACHE_STATS_KEY.format(result)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def get_cache_stats():
+    """
+    Returns the number of hits and misses and the hit rate of the plot cache
+    """
+    hits = cache.get(PLOT_CACHE_STATS_KEY.format('hit'), 0)
+    misses = cache.get(PLOT_CACHE_STATS_KEY.format('miss'), 0)
+    total = hits + misses
+    return {'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0}
+
+
+def make_plot_key(name, target, *params, bucket_seconds=PLOT_CACHE_BUCKET):
+    parts = [name, target.id, _target_version(target.id),
+             round(float(target.ra), 6), round(float(target.dec), 6)]
+    parts.extend(params)
+    parts.append(time_bucket(bucket_seconds))
+    return 'plot_cache:' + ':'.join(str(p) for p in parts)
+
+
+def get_or_build_plot(name, target, params, builder, bucket_seconds=PLOT_CACHE_BUCKET):
+    """
+    Returns the cached {'data': ..., 'figure': ...} entry for this plot,
+    calling builder() to compute and store it on a miss.
+
+    builder must return a (data, figure) tuple, where data holds the
+    numeric series used to make the plot and figure is the rendered div.
+    """
+    key = make_plot_key(name, target, *params, bucket_seconds=bucket_seconds)
+    entry = cache.get(key)
+    if entry is not None:
+        _record('hit')
+        return entry
+
+    _record('miss')
+    data, figure = builder()
+    entry = {'data': data, 'figure': figure}
+    cache.set(key, entry, timeout=bucket_seconds)
+
+    stats = get_cache_stats()
+    logger.info('Plot cache miss for {} of target {} (hit rate {:.2f} over {} lookups)'.format(
+        name, target.id, stats['hit_rate'], stats['hits'] + stats['misses']))
+    return entry
@@ -6,69 +6,19 @@ from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.sql import func
 
 import json
+import numpy as np
 from contextlib import contextmanager
 import os
 import datetime
 from django.conf import settings
 from tom_dataproducts.models import DataProduct, data_product_path
+from custom_code.photometry import invalidate_lightcurve
+from custom_code.target_summary import update_target_summaries
+from custom_code.spectra import encode_spectrum
+from custom_code.snex1_db import get_session, load_table
 
 _SNEX2_DB = 'postgresql://{}:{}@supernova.science.lco.global:5435/snex2'.format(os.environ.get('SNEX2_DB_USER'), os.environ.get('SNEX2_DB_PASSWORD'))
 
-engine1 = create_engine(settings.SNEX1_DB_URL)
-engine2 = create_engine(_SNEX2_DB)
-
-@contextmanager
-def get_session(db_address=settings.SNEX1_DB_URL):
-    """
-    Get a connection to a database
-
-    Returns
-    ----------
-    session: SQLAlchemy database session
-    """
-    Base = automap_base()
-    if db_address==settings.SNEX1_DB_URL:
-        Base.metadata.bind = engine1
-        db_session = sessionmaker(bind=engine1, autoflush=False, expire_on_commit=False)
-    else:
-        Base.metadata.bind = engine2
-        db_session = sessionmaker(bind=engine2, autoflush=False, expire_on_commit=False)
-
-    session = db_session()
-
-    try:
-        yield session
-        session.commit()
-
-    except:
-        session.rollback()
-        raise
-
-    finally:
-        session.close()
-
-
-def load_table(tablename, db_address=settings.SNEX1_DB_URL):
-    """
-    Load a table with its data from a database
-
-    Parameters
-    ----------
-    tablename: str, the name of the table to load
-    db_address: str, sqlalchemy address to the table being loaded
-
-    Returns
-    ----------
-    table: sqlalchemy table object
-    """
-    Base = automap_base()
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.prepare(autoload_with=engine)
-
-    table = getattr(Base.classes, tablename)
-    return table
-
-
 ### Define our SNex1 db tables as Classes
 Db_Changes = load_table('db_changes', db_address=settings.SNEX1_DB_URL)
 Photlco = load_table('photlco', db_address=settings.SNEX1_DB_URL)
@@ -87,6 +37,11 @@ Targetname = load_table('tom_targets_targetname', db_address=_SNEX2_DB)
 Auth_Group = load_table('auth_group', db_address=_SNEX2_DB)
 Group_Perm = load_table('guardian_groupobjectpermission', db_address=_SNEX2_DB)
 Datum_Extra = load_table('custom_code_reduceddatumextra', db_address=_SNEX2_DB)
+Snex1_Mapping = load_table('custom_code_snex1mapping', db_address=_SNEX2_DB)
+Target_Summary = load_table('custom_code_targetsummary', db_address=_SNEX2_DB)
+
+### Targets whose TargetSummary rows are refreshed at the end of the run
+summary_targets = set()
 
 ### Make a dictionary of the groups in the SNex1 db
 with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
@@ -143,6 +98,42 @@ def delete_row(table, id_, db_address=settings.SNEX1_DB_URL):
         db_session.query(table).filter(criteria).delete()
         db_session.commit()
 
+def get_mapped_ids(db_session, table, snex1_ids):
+    """
+    Returns the SNex1 to SNex2 id mapping rows for these SNex1 rows, keyed by SNex1 id
+
+    Parameters
+    ----------
+    db_session: SQLAlchemy session to the SNex2 db
+    table: str, the SNex1 table, i.e. 'photlco' or 'spec'
+    snex1_ids: iterable, ids of the rows in the SNex1 table
+    """
+    snex1_ids = [int(i) for i in snex1_ids]
+    if not snex1_ids:
+        return {}
+    criteria = and_(Snex1_Mapping.table==table, Snex1_Mapping.snex1_id.in_(snex1_ids))
+    return {row.snex1_id: row for row in db_session.query(Snex1_Mapping).filter(criteria)}
+
+
+def add_mapping(db_session, table, snex1_id, reduced_datum_id, data_product_id=None):
+    db_session.add(Snex1_Mapping(table=table, snex1_id=int(snex1_id), reduced_datum_id=int(reduced_datum_id), data_product_id=data_product_id))
+
+
+def delete_mappings(db_session, table, snex1_ids):
+    criteria = and_(Snex1_Mapping.table==table, Snex1_Mapping.snex1_id.in_([int(i) for i in snex1_ids]))
+    db_session.query(Snex1_Mapping).filter(criteria).delete(synchronize_session=False)
+
+
+def powers_of_two(num):
+    powers = []
+    i = 1
+    while i <= num:
+        if i & num:
+            powers.append(i)
+        i <<= 1
+    return powers
+
+
 def update_permissions(groupid, permissionid, objectid, contentid):
     """
     Updates permissions of a specific group for a certain target
@@ -155,14 +146,6 @@ def update_permissions(groupid, permissionid, objectid, contentid):
     objectid: int, the row id of the object
     contentid: int, the content id in the SNex2 db for this object
     """
-    def powers_of_two(num):
-        powers = []
-        i = 1
-        while i <= num:
-            if i & num:
-                powers.append(i)
-            i <<= 1
-        return powers
     target_groups = powers_of_two(groupid)
     
     with get_session(db_address=_SNEX2_DB) as db_session:
@@ -173,6 +156,46 @@ def update_permissions(groupid, permissionid, objectid, contentid):
     db_session.commit()
 
 
+def phot_time(phot_row):
+    """
+    Returns the timestamp of a row in the photlco table as a string
+    """
+    dobs = phot_row.dateobs
+    tobs = phot_row.ut
+    if tobs is None:
+        tobs = '00:00:00'
+    if dobs is None:
+        dobs = datetime.datetime.today().strftime('%Y-%m-%d')
+    return '{} {}'.format(dobs, tobs)
+
+
+def phot_value(phot_row):
+    """
+    Returns the ReducedDatum value for a row in the photlco table
+    """
+    id_ = phot_row.id
+    if int(phot_row.mag) != 9999:
+        if int(phot_row.filetype) == 1:
+            phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': False, 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
+        elif int(phot_row.filetype) == 3 and phot_row.difftype is not None:
+            if int(phot_row.difftype) == 0:
+                subtraction_algorithm = 'Hotpants'
+            elif int(phot_row.difftype) == 1:
+                subtraction_algorithm = 'PyZOGY'
+            filename = phot_row.filename
+            if 'SDSS' in filename:
+                template_source = 'SDSS'
+            else:
+                template_source = 'LCO'
+            phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': True, 'subtraction_algorithm': subtraction_algorithm, 'template_source': template_source, 'reduction_type': 'manual', 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
+        
+        else:
+            phot = {'snex_id': int(id_)}
+    else:
+        phot = {'snex_id': int(id_)}
+    return phot
+
+
 def update_phot(action, db_address=_SNEX2_DB):
     """
     Queries the ReducedDatum table in the SNex2 db with any changes made to the Photlco table in the SNex1 db
@@ -202,11 +225,16 @@ def update_phot(action, db_address=_SNEX2_DB):
                     #     if id_ == value.get('snex_id', ''):
                     #         db_session.delete(snex2_row)
                     #         break
-                    snex2_id_query = db_session.query(Datum).filter(
-                        Datum.value['snex_id'].astext == str(id_)
-                    ).first()
+                    mapping = get_mapped_ids(db_session, 'photlco', [id_]).get(int(id_))
+                    snex2_id_query = None
+                    if mapping is not None:
+                        snex2_id_query = db_session.query(Datum).filter(Datum.id==mapping.reduced_datum_id).first()
+                        delete_mappings(db_session, 'photlco', [id_])
                     if snex2_id_query is not None:
+                        deleted_target_id = snex2_id_query.target_id
                         db_session.delete(snex2_id_query)
+                    else:
+                        deleted_target_id = None
                     db_session.commit()
 
                     #snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.snex_id==id_, Datum_Extra.data_type=='photometry')).first()
@@ -216,6 +244,10 @@ def update_phot(action, db_address=_SNEX2_DB):
                         #db_session.delete(datum)
                     #db_session.commit()
 
+                if deleted_target_id is not None:
+                    invalidate_lightcurve(deleted_target_id)
+                    summary_targets.add(deleted_target_id)
+
                 #Delete all other rows corresponding to this dataproduct in the db_changes table
                 with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
                     all_other_rows = db_session.query(Db_Changes).filter(and_(Db_Changes.tablename=='photlco', Db_Changes.rowid==id_))
@@ -226,33 +258,8 @@ def update_phot(action, db_address=_SNEX2_DB):
             else:
 
                 targetid = phot_row.targetid
-                dobs = phot_row.dateobs
-                tobs = phot_row.ut
-                if tobs is None:
-                    tobs = '00:00:00'
-                if dobs is None:
-                    dobs = datetime.datetime.today().strftime('%Y-%m-%d')
-                time = '{} {}'.format(dobs, tobs) 
-                
-                if int(phot_row.mag) != 9999:
-                    if int(phot_row.filetype) == 1:
-                        phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': False, 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
-                    elif int(phot_row.filetype) == 3 and phot_row.difftype is not None:
-                        if int(phot_row.difftype) == 0:
-                            subtraction_algorithm = 'Hotpants'
-                        elif int(phot_row.difftype) == 1:
-                            subtraction_algorithm = 'PyZOGY'
-                        filename = phot_row.filename
-                        if 'SDSS' in filename:
-                            template_source = 'SDSS'
-                        else:
-                            template_source = 'LCO'
-                        phot = {'magnitude': float(phot_row.mag), 'filter': phot_row.filter, 'error': float(phot_row.dmag), 'snex_id': int(id_), 'background_subtracted': True, 'subtraction_algorithm': subtraction_algorithm, 'template_source': template_source, 'reduction_type': 'manual', 'telescope': phot_row.telescope, 'instrument': phot_row.instrument}
-                    
-                    else:
-                        phot = {'snex_id': int(id_)}
-                else:
-                    phot = {'snex_id': int(id_)}
+                time = phot_time(phot_row)
+                phot = phot_value(phot_row)
     
                 phot_groupid = phot_row.groupidcode
     
@@ -267,20 +274,16 @@ def update_phot(action, db_address=_SNEX2_DB):
                             ##if snex2_id_query is not None:
                             #snex2_id = snex2_id_query.reduced_datum_id
                             
-                            snex2_id_query = db_session.query(Datum).filter(and_(Datum.target_id==targetid, Datum.data_type=='photometry')).all()
-                            for snex2_row in snex2_id_query:
-                                value = snex2_row.value
-                                if type(value) == str: #Some rows are still strings for some reason
-                                    value = json.loads(snex2_row.value)
-                                if int(id_) == value.get('snex_id', ''):
-                                    snex2_id = snex2_row.id
-                                    db_session.query(Datum).filter(Datum.id==snex2_id).update({'target_id': targetid, 'timestamp': time, 'value': phot, 'data_type': 'photometry', 'source_name': '', 'source_location': ''})
-                                    break
+                            mapping = get_mapped_ids(db_session, 'photlco', [id_]).get(int(id_))
+                            if mapping is not None:
+                                old_targetid = db_session.query(Datum.target_id).filter(Datum.id==mapping.reduced_datum_id).scalar()
+                                db_session.query(Datum).filter(Datum.id==mapping.reduced_datum_id).update({'target_id': targetid, 'timestamp': time, 'value': phot, 'data_type': 'photometry', 'source_name': '', 'source_location': ''})
 
                         elif action=='insert':
                             newphot = Datum(target_id=targetid, timestamp=time, value=phot, data_type='photometry', source_name='', source_location='')
                             db_session.add(newphot)
                             db_session.flush()
+                            add_mapping(db_session, 'photlco', id_, newphot.id)
     
                             if phot_groupid is not None:
                                 update_permissions(int(phot_groupid), 77, newphot.id, 19) #View reduceddatum
@@ -289,6 +292,12 @@ def update_phot(action, db_address=_SNEX2_DB):
                             #db_session.add(newphot_extra)
 
                         db_session.commit()
+                    invalidate_lightcurve(targetid)
+                    if action=='update':
+                        if mapping is not None and old_targetid not in (None, targetid):
+                            invalidate_lightcurve(old_targetid)
+                            summary_targets.add(old_targetid)
+                    summary_targets.add(targetid)
                 delete_row(Db_Changes, result.id, db_address=settings.SNEX1_DB_URL)
 
         except:
@@ -297,16 +306,15 @@ def update_phot(action, db_address=_SNEX2_DB):
 
 def read_spec(filename):
     """
-    Read an ascii spectrum file and return a JSON dump-s of the wavelengths and fluxes
+    Read an ascii spectrum file and return the wavelengths and fluxes
+    as a columnar spectrum value
 
     Parameters
     ----------
     filename: str, the filepath+filename of the ascii file to read
     """
-    spec_file = open(filename, 'r')
-    lines = [x.split() for x in spec_file.readlines()]
-    data = {"{}".format(i): {"wavelength": float(lines[i][0]), "flux": float(lines[i][1])} for i in range(len(lines)) if lines[i][1] != 'nan'}
-    return(data)
+    data = np.loadtxt(filename, usecols=(0, 1), ndmin=2)
+    return encode_spectrum(data[:, 0], data[:, 1])
 
 
 def update_spec(action, db_address=_SNEX2_DB):
@@ -335,20 +343,20 @@ def update_spec(action, db_address=_SNEX2_DB):
                     #        break
                     #db_session.commit()
 
-                    snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.data_type=='spectroscopy', Datum_Extra.key=='snex_id')).all()
-                    for snex2_row in snex2_id_query:
-                        value = json.loads(snex2_row.value)
-                        if id_ == value.get('snex_id', ''):
-                            snex2_id = value.get('snex2_id', '')
-                            spec = db_session.query(Datum).filter(and_(Datum.data_type=='spectroscopy', Datum.id==snex2_id)).first()
-                            if not spec.data_product_id:
-                                db_session.delete(spec)
-                            else: # Delete the associated DataProduct with the spectrum
-                                data_product_id = spec.data_product_id
-                                db_session.delete(spec)
-                                db_session.query(Data_Product).filter(Data_Product.id == data_product_id).delete()
-                            
-                            break
+                    mapping = get_mapped_ids(db_session, 'spec', [id_]).get(int(id_))
+                    if mapping is not None:
+                        spec = db_session.query(Datum).filter(and_(Datum.data_type=='spectroscopy', Datum.id==mapping.reduced_datum_id)).first()
+                        if spec is not None:
+                            summary_targets.add(spec.target_id)
+                        if spec is None:
+                            pass
+                        elif not spec.data_product_id:
+                            db_session.delete(spec)
+                        else: # Delete the associated DataProduct with the spectrum
+                            data_product_id = spec.data_product_id
+                            db_session.delete(spec)
+                            db_session.query(Data_Product).filter(Data_Product.id == data_product_id).delete()
+                        delete_mappings(db_session, 'spec', [id_])
                     db_session.commit()
 
             else:
@@ -378,13 +386,9 @@ def update_spec(action, db_address=_SNEX2_DB):
                             #        snex2_row.update({'target_id': targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
                             #        break
                             
-                            snex2_id_query = db_session.query(Datum_Extra).filter(and_(Datum_Extra.target_id==targetid, Datum_Extra.key=='snex_id', Datum_Extra.data_type=='spectroscopy')).all()
-                            for snex2_row in snex2_id_query:
-                                value = json.loads(snex2_row.value)
-                                if id_ == value.get('snex_id', ''):
-                                    snex2_id = value.get('snex2_id', '')
-                                    db_session.query(Datum).filter(Datum.id==snex2_id).update({'target_id': targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
-                                    break
+                            mapping = get_mapped_ids(db_session, 'spec', [id_]).get(int(id_))
+                            if mapping is not None:
+                                db_session.query(Datum).filter(Datum.id==mapping.reduced_datum_id).update({'target_id': targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
 
                         elif action=='insert':
                             # First create the dataproduct for this spectra linking to the ascii file
@@ -405,6 +409,7 @@ def update_spec(action, db_address=_SNEX2_DB):
                             #newspec = Datum(target_id=targetid, timestamp=time, value=spec, data_type='spectroscopy', source_name='', source_location='')
                             db_session.add(newspec)
                             db_session.flush()
+                            add_mapping(db_session, 'spec', id_, newspec.id, data_product_id=newdp.id)
 
                             if spec_groupid is not None:
                                 update_permissions(int(spec_groupid), 77, newspec.id, 19) #View reduceddatum
@@ -425,6 +430,7 @@ def update_spec(action, db_address=_SNEX2_DB):
                             db_session.add(spec_extras_row)
 
                         db_session.commit()
+                        summary_targets.add(targetid)
                         if action == 'insert':
                             # Finally update the newly created dataproduct using the Django path
                             # This is normally done automatically using the Django ORM,
@@ -439,7 +445,7 @@ def update_spec(action, db_address=_SNEX2_DB):
             raise #continue
 
 
-def update_target(action, db_address=_SNEX2_DB):
+def update_target(action, db_address=_SNEX2_DB, standard_ids=None):
     """
     Queries the Target table in the SNex2 db with any changes made to the Targets and Targetnames tables in the SNex1 db
 
@@ -447,6 +453,7 @@ def update_target(action, db_address=_SNEX2_DB):
     ----------
     action: str, one of 'update', 'insert', or 'delete'
     db_address: str, sqlalchemy address to the SNex2 db
+    standard_ids: set, ids of the SNex1 standard star targets, queried for each name if not given
     """
     target_result = query_db_changes('targets', action, db_address=settings.SNEX1_DB_URL)
     name_result = query_db_changes('targetnames', action, db_address=settings.SNEX1_DB_URL)
@@ -490,9 +497,11 @@ def update_target(action, db_address=_SNEX2_DB):
                         update_permissions(t_groupid, 49, target_id, 12) #View target
 
                 elif action=='delete':
+                    db_session.query(Target_Summary).filter(Target_Summary.target_id==target_id).delete()
                     db_session.query(Target).filter(criteria).delete()
 
                 db_session.commit()
+            summary_targets.add(target_id)
             #delete_row(Db_Changes, tresult.id, db_address=_SNEX1_DB)
 
         except:
@@ -507,9 +516,8 @@ def update_target(action, db_address=_SNEX2_DB):
                 n_id = name_row.targetid
                 t_name = name_row.name
                 
-                with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
-                    standard_list = db_session.query(Targets).filter(Targets.classificationid==1)
-                    standard_ids = [x.id for x in standard_list]
+                if standard_ids is None:
+                    standard_ids = get_standard_ids()
 
                 if n_id not in standard_ids:
 
@@ -529,6 +537,7 @@ def update_target(action, db_address=_SNEX2_DB):
                                 db_session.add(Targetname(name=t_name, target_id=n_id, created=datetime.datetime.utcnow(), modified=datetime.datetime.utcnow()))
 
                     db_session.commit()
+                    summary_targets.add(n_id)
             
             #TODO: Delete currently doesn't work because targetname_criteria doesn't work
             #      need to figure out how to find the name that was deleted from SNEx1
@@ -600,20 +609,288 @@ def update_target_extra(action, db_address=_SNEX2_DB):
                         db_session.query(Target_Extra).filter(c_criteria).delete()
 
                     db_session.commit()
+            summary_targets.add(target_id)
             delete_row(Db_Changes, tresult.id, db_address=settings.SNEX1_DB_URL)
 
         except:
             raise #continue
 
 
-def run():
+SYNC_PAGE_SIZE = 500
+
+
+def get_standard_ids():
+    """
+    Returns the set of ids of the SNex1 targets that are standard stars
+    """
+    with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
+        return {x.id for x in db_session.query(Targets.id).filter(Targets.classificationid==1)}
+
+
+def get_snex2_group_ids(db_address=_SNEX2_DB):
+    """
+    Returns a dictionary of the SNex2 group ids keyed by group name
+    """
+    with get_session(db_address=db_address) as db_session:
+        return {x.name: x.id for x in db_session.query(Auth_Group.id, Auth_Group.name)}
+
+
+def permission_rows(groupid, permissionid, objectid, contentid, snex2_group_ids):
+    """
+    Same as update_permissions, but returns the guardian rows to be inserted
+    in bulk instead of adding them one at a time
+    """
+    target_groups = powers_of_two(groupid)
+    return [{'object_pk': str(objectid), 'content_type_id': contentid, 'group_id': snex2_group_ids[g_name], 'permission_id': permissionid}
+            for g_name, g_id in snex1_groups.items() if g_id in target_groups and g_name in snex2_group_ids]
+
+
+def iter_db_changes(table, action, page_size=SYNC_PAGE_SIZE):
+    """
+    Yields the rows of the db_changes table for this table and action in
+    pages of (id, rowid) tuples, ordered by id
+
+    Parameters
+    ----------
+    table: str, table that was modified
+    action: str, one of 'update', 'insert', or 'delete'
+    page_size: int, number of changes in each page
+    """
+    last_id = 0
+    while True:
+        with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
+            criteria = and_(Db_Changes.tablename==table, Db_Changes.action==action, Db_Changes.id > last_id)
+            page = db_session.query(Db_Changes.id, Db_Changes.rowid).filter(criteria).order_by(Db_Changes.id).limit(page_size).all()
+        if not page:
+            return
+        last_id = page[-1].id
+        yield page
+
+
+def get_current_rows(table, ids, db_address=settings.SNEX1_DB_URL):
+    """
+    Get the rows that were modified with a single IN query, keyed by id
+    """
+    if not ids:
+        return {}
+    with get_session(db_address=db_address) as db_session:
+        return {row.id: row for row in db_session.query(table).filter(table.id.in_(list(ids)))}
+
+
+def delete_changes(page, table, action):
+    """
+    Deletes a page of rows from the db_changes table in one statement. For
+    deletes, all other changes recorded for the deleted rows go too.
+    """
+    with get_session(db_address=settings.SNEX1_DB_URL) as db_session:
+        db_session.query(Db_Changes).filter(Db_Changes.id.in_([c.id for c in page])).delete(synchronize_session=False)
+        if action == 'delete':
+            criteria = and_(Db_Changes.tablename==table, Db_Changes.rowid.in_([c.rowid for c in page]))
+            db_session.query(Db_Changes).filter(criteria).delete(synchronize_session=False)
+
+
+def batch_update_phot(action, standard_ids, snex2_group_ids, page_size=SYNC_PAGE_SIZE, db_address=_SNEX2_DB):
+    """
+    Batched version of update_phot: each page of changes is applied to the
+    SNex2 db with bulk statements in a single transaction
+
+    Parameters
+    ----------
+    action: str, one of 'update', 'insert', or 'delete'
+    standard_ids: set, ids of the SNex1 standard star targets
+    snex2_group_ids: dict, SNex2 group ids keyed by name
+    page_size: int, number of changes to apply at once
+    db_address: str, sqlalchemy address to the SNex2 db
+    """
+    for page in iter_db_changes('photlco', action, page_size=page_size):
+        rowids = {c.rowid for c in page}
+        phot_rows = get_current_rows(Photlco, rowids) if action != 'delete' else {}
+        changed_targets = set()
+
+        with get_session(db_address=db_address) as db_session:
+            mappings = get_mapped_ids(db_session, 'photlco', rowids)
+            existing = {}
+            if mappings:
+                datum_targets = dict(db_session.query(Datum.id, Datum.target_id).filter(Datum.id.in_([m.reduced_datum_id for m in mappings.values()])))
+                existing = {snex1_id: (m.reduced_datum_id, datum_targets.get(m.reduced_datum_id)) for snex1_id, m in mappings.items()}
+
+            if action == 'delete':
+                if existing:
+                    datum_ids = [datum_id for datum_id, _ in existing.values()]
+                    db_session.query(Datum).filter(Datum.id.in_(datum_ids)).delete(synchronize_session=False)
+                    delete_mappings(db_session, 'photlco', existing.keys())
+                    changed_targets.update(target_id for _, target_id in existing.values() if target_id is not None)
+
+            else:
+                updates = []
+                inserts = []
+                for id_ in sorted(rowids):
+                    phot_row = phot_rows.get(id_)
+                    if phot_row is None or phot_row.targetid in standard_ids or int(phot_row.filetype) not in (1,3):
+                        continue
+                    fields = {'target_id': phot_row.targetid, 'timestamp': phot_time(phot_row), 'value': phot_value(phot_row), 'data_type': 'photometry', 'source_name': '', 'source_location': ''}
+
+                    if action == 'update' and id_ in existing:
+                        updates.append(dict(id=existing[id_][0], **fields))
+                        changed_targets.update((existing[id_][1], phot_row.targetid))
+                    elif action == 'insert' and id_ not in existing:
+                        inserts.append((Datum(**fields), phot_row.groupidcode, id_))
+                        changed_targets.add(phot_row.targetid)
+
+                if updates:
+                    db_session.bulk_update_mappings(Datum, updates)
+
+                if inserts:
+                    db_session.add_all([datum for datum, _, _ in inserts])
+                    db_session.flush()
+                    perms = []
+                    for datum, groupid, _ in inserts:
+                        if groupid is not None:
+                            perms.extend(permission_rows(int(groupid), 77, datum.id, 19, snex2_group_ids)) #View reduceddatum
+                    if perms:
+                        db_session.bulk_insert_mappings(Group_Perm, perms)
+                    db_session.bulk_insert_mappings(Snex1_Mapping, [{'table': 'photlco', 'snex1_id': int(id_), 'reduced_datum_id': int(datum.id)}
+                                                                    for datum, _, id_ in inserts])
+
+        delete_changes(page, 'photlco', action)
+        for target_id in changed_targets:
+            invalidate_lightcurve(target_id)
+        summary_targets.update(changed_targets)
+
+
+def spec_extras_value(spec_row):
+    spec_extras = {}
+    for key in ['telescope', 'instrument', 'exptime', 'slit', 'airmass', 'reducer']:
+        if getattr(spec_row, key):
+            spec_extras[key] = getattr(spec_row, key)
+    spec_extras['snex_id'] = int(spec_row.id)
+    return spec_extras
+
+
+def batch_update_spec(action, standard_ids, snex2_group_ids, page_size=SYNC_PAGE_SIZE, db_address=_SNEX2_DB):
+    """
+    Batched version of update_spec: each page of changes is applied to the
+    SNex2 db in a single transaction. The spectrum files still have to be
+    read one at a time.
+
+    Parameters
+    ----------
+    action: str, one of 'update', 'insert', or 'delete'
+    standard_ids: set, ids of the SNex1 standard star targets
+    snex2_group_ids: dict, SNex2 group ids keyed by name
+    page_size: int, number of changes to apply at once
+    db_address: str, sqlalchemy address to the SNex2 db
+    """
+    for page in iter_db_changes('spec', action, page_size=page_size):
+        rowids = {c.rowid for c in page}
+        spec_rows = get_current_rows(Spec, rowids) if action != 'delete' else {}
+        new_data_products = []
+
+        with get_session(db_address=db_address) as db_session:
+            spectrum_ids = {snex1_id: m.reduced_datum_id for snex1_id, m in get_mapped_ids(db_session, 'spec', rowids).items()}
+            if action == 'delete':
+                datum_ids = [spectrum_ids[id_] for id_ in rowids if id_ in spectrum_ids]
+                if datum_ids:
+                    deleted = db_session.query(Datum.target_id, Datum.data_product_id).filter(Datum.id.in_(datum_ids)).all()
+                    summary_targets.update(x.target_id for x in deleted)
+                    data_product_ids = [x.data_product_id for x in deleted if x.data_product_id]
+                    db_session.query(Datum).filter(and_(Datum.data_type=='spectroscopy', Datum.id.in_(datum_ids))).delete(synchronize_session=False)
+                    if data_product_ids:
+                        db_session.query(Data_Product).filter(Data_Product.id.in_(data_product_ids)).delete(synchronize_session=False)
+                    delete_mappings(db_session, 'spec', spectrum_ids.keys())
+
+            else:
+                updates = []
+                inserts = []
+                for id_ in sorted(rowids):
+                    spec_row = spec_rows.get(id_)
+                    if spec_row is None or spec_row.targetid in standard_ids:
+                        continue
+                    if action == 'update' and id_ not in spectrum_ids:
+                        continue
+                    if action == 'insert' and id_ in spectrum_ids:
+                        continue
+
+                    time = '{} {}'.format(spec_row.dateobs, spec_row.ut)
+                    spec_filename = spec_row.filepath.replace('/supernova/', '/snex2/') + spec_row.filename.replace('.fits', '.ascii')
+                    spec = read_spec(spec_filename)
+                    summary_targets.add(spec_row.targetid)
+                    if action == 'update':
+                        updates.append({'id': spectrum_ids[id_], 'target_id': spec_row.targetid, 'timestamp': time, 'value': spec, 'data_type': 'spectroscopy', 'source_name': '', 'source_location': ''})
+                    else:
+                        newdp = Data_Product(
+                            target_id=spec_row.targetid,
+                            product_id=spec_row.filename.replace('.fits', '.ascii'),
+                            data_product_type='spectroscopy',
+                            data=spec_row.filename.replace('.fits', '.ascii'),
+                            extra_data='',
+                            created=time,
+                            modified=time,
+                            featured=False)
+                        inserts.append((spec_row, time, spec, newdp))
+
+                if updates:
+                    db_session.bulk_update_mappings(Datum, updates)
+
+                if inserts:
+                    db_session.add_all([newdp for _, _, _, newdp in inserts])
+                    db_session.flush()
+                    newspecs = [Datum(target_id=spec_row.targetid, data_product_id=newdp.id, timestamp=time, value=spec, data_type='spectroscopy', source_name='', source_location='')
+                                for spec_row, time, spec, newdp in inserts]
+                    db_session.add_all(newspecs)
+                    db_session.flush()
+
+                    extras = []
+                    perms = []
+                    mappings = []
+                    for (spec_row, _, _, newdp), newspec in zip(inserts, newspecs):
+                        extras.append({'target_id': spec_row.targetid, 'data_type': 'spectroscopy', 'key': 'snex_id',
+                                       'value': json.dumps({'snex_id': int(spec_row.id), 'snex2_id': int(newspec.id)})})
+                        extras.append({'target_id': spec_row.targetid, 'data_type': 'spectroscopy', 'key': 'spec_extras',
+                                       'value': json.dumps(spec_extras_value(spec_row))})
+                        if spec_row.groupidcode is not None:
+                            perms.extend(permission_rows(int(spec_row.groupidcode), 77, newspec.id, 19, snex2_group_ids)) #View reduceddatum
+                        mappings.append({'table': 'spec', 'snex1_id': int(spec_row.id), 'reduced_datum_id': int(newspec.id), 'data_product_id': int(newdp.id)})
+                        new_data_products.append(newdp.id)
+
+                    db_session.bulk_insert_mappings(Datum_Extra, extras)
+                    db_session.bulk_insert_mappings(Snex1_Mapping, mappings)
+                    if perms:
+                        db_session.bulk_insert_mappings(Group_Perm, perms)
+
+        # Finally update the newly created dataproducts using the Django path,
+        # since they were created with sqlalchemy
+        for snex2_dp in DataProduct.objects.filter(id__in=new_data_products):
+            snex2_dp.data = data_product_path(snex2_dp, snex2_dp.data)
+            snex2_dp.save()
+
+        delete_changes(page, 'spec', action)
+
+
+def run(*args):
     """
     Migrates all changes from the SNex1 db to the SNex2 db,
-    and afterwards deletes all the rows in the db_changes table
+    and afterwards deletes all the rows in the db_changes table.
+
+    Photometry and spectra are replicated in pages of changes,
+    unless the script is run with the per_row argument.
     """
     actions = ['delete', 'insert', 'update']
+    per_row = 'per_row' in args
+    summary_targets.clear()
+    if not per_row:
+        standard_ids = get_standard_ids()
+        snex2_group_ids = get_snex2_group_ids()
+
     for action in actions:
-        update_target(action, db_address=_SNEX2_DB)
+        update_target(action, db_address=_SNEX2_DB, standard_ids=None if per_row else standard_ids)
         update_target_extra(action, db_address=_SNEX2_DB)
-        update_phot(action, db_address=_SNEX2_DB)
-        update_spec(action, db_address=_SNEX2_DB)
\ No newline at end of file
+        if per_row:
+            update_phot(action, db_address=_SNEX2_DB)
+            update_spec(action, db_address=_SNEX2_DB)
+        else:
+            batch_update_phot(action, standard_ids, snex2_group_ids)
+            batch_update_spec(action, standard_ids, snex2_group_ids)
+
+    ### Refresh the summaries of every target touched by the sync
+    update_target_summaries(summary_targets)
@@ -0,0 +1,105 @@
+"""
+Shared SQLAlchemy access to the SNEx1 database (and the SNEx2 database for
+the sync scripts).
+
+Each process keeps one pooled engine per database address and reflects the
+schema the first time a table is requested, so hooks, views and sync
+commands reuse open connections and table classes instead of connecting and
+reflecting on every call. Engines are keyed by process id, so workers forked
+from a parent that already used the database open their own connections.
+The pool is configured with the SNEX1_DB_POOL_* settings.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.automap import automap_base
+
+logger = logging.getLogger(__name__)
+
+SNEX1_DB_POOL_SIZE = getattr(settings, 'SNEX1_DB_POOL_SIZE', 5)
+SNEX1_DB_MAX_OVERFLOW = getattr(settings, 'SNEX1_DB_MAX_OVERFLOW', 10)
+SNEX1_DB_POOL_TIMEOUT = getattr(settings, 'SNEX1_DB_POOL_TIMEOUT', 30) # seconds
+SNEX1_DB_POOL_RECYCLE = getattr(settings, 'SNEX1_DB_POOL_RECYCLE', 3600) # seconds
+SNEX1_DB_POOL_PRE_PING = getattr(settings, 'SNEX1_DB_POOL_PRE_PING', True)
+
+_lock = threading.Lock()
+_engines = {}
+_sessionmakers = {}
+_bases = {}
+
+
+def get_engine(db_address=settings.SNEX1_DB_URL):
+    """
+    Returns this process's pooled engine for db_address
+    """
+    key = (os.getpid(), db_address)
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+
+    with _lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                db_address,
+                pool_size=SNEX1_DB_POOL_SIZE,
+                max_overflow=SNEX1_DB_MAX_OVERFLOW,
+                pool_timeout=SNEX1_DB_POOL_TIMEOUT,
+                pool_recycle=SNEX1_DB_POOL_RECYCLE,
+                pool_pre_ping=SNEX1_DB_POOL_PRE_PING
+            )
+            _sessionmakers[key] = sessionmaker(bind=_engines[key], autoflush=False, expire_on_commit=False)
+        return _engines[key]
+
+
+def new_session(db_address=settings.SNEX1_DB_URL):
+    """
+    Returns a session on the pooled engine. It is not run within a with
+    block, so it must be closed manually to return its connection to the pool.
+    """
+    get_engine(db_address)
+    return _sessionmakers[(os.getpid(), db_address)]()
+
+
+@contextmanager
+def get_session(db_address=settings.SNEX1_DB_URL):
+    """
+    Session that is committed on success, rolled back on errors,
+    and always returned to the pool
+    """
+    session = new_session(db_address)
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _get_base(db_address):
+    base = _bases.get(db_address)
+    if base is not None:
+        return base
+
+    engine = get_engine(db_address)
+    with _lock:
+        if db_address not in _bases:
+            logger.info('Reflecting database schema for table classes')
+            base = automap_base()
+            base.prepare(autoload_with=engine)
+            _bases[db_address] = base
+        return _bases[db_address]
+
+
+def load_table(tablename, db_address=settings.SNEX1_DB_URL):
+    """
+    Returns the mapped class for a table, reflecting the
+    database schema the first time any table is requested
+    """
+    return getattr(_get_base(db_address).classes, tablename)
@@ -0,0 +1,72 @@
+"""
+Storage format for spectra ReducedDatum values.
+
+Spectra are stored as parallel wavelength and flux arrays,
+{'wavelength': [...], 'flux': [...]}, the same layout the TOM's
+SpectrumSerializer writes, with values rounded to float32 precision.
+Older rows from the SNEx1 sync use one dict per pixel,
+{'0': {'wavelength': ..., 'flux': ...}, ...}, which read_spectrum still
+decodes and which the convert_spectra command rewrites in place.
+"""
+import json
+
+import numpy as np
+
+SPECTRUM_DIGITS = 7 # significant digits kept, about float32 precision
+
+
+def _round_list(values):
+    fmt = '%.{}g'.format(SPECTRUM_DIGITS)
+    return [float(fmt % v) for v in np.asarray(values, dtype=float).tolist()]
+
+
+def encode_spectrum(wavelength, flux, **extras):
+    """
+    Builds the value of a spectrum ReducedDatum from wavelength and flux
+    arrays, dropping pixels with a non-finite wavelength or flux
+    """
+    wavelength = np.asarray(wavelength, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(wavelength) & np.isfinite(flux)
+    value = {'wavelength': _round_list(wavelength[good]),
+             'flux': _round_list(flux[good])}
+    value.update(extras)
+    return value
+
+
+def is_legacy_spectrum(value):
+    """
+    True for the per-pixel dict layout used by the SNEx1 sync
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    return bool(value) and 'wavelength' not in value and isinstance(next(iter(value.values())), dict)
+
+
+def read_spectrum(value):
+    """
+    Returns (wavelength, flux) float arrays for a spectrum ReducedDatum
+    value in any of the layouts stored in the database
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not value:
+        return np.empty(0), np.empty(0)
+
+    if value.get('photon_flux'):
+        return np.asarray(value['wavelength'], dtype=float), np.asarray(value['photon_flux'], dtype=float)
+    if 'wavelength' in value:
+        return np.asarray(value['wavelength'], dtype=float), np.asarray(value.get('flux', []), dtype=float)
+
+    pixels = [pixel for pixel in value.values() if isinstance(pixel, dict)]
+    wavelength = np.array([pixel['wavelength'] for pixel in pixels], dtype=float)
+    flux = np.array([pixel['flux'] for pixel in pixels], dtype=float)
+    return wavelength, flux
+
+
+def convert_legacy_spectrum(value):
+    """
+    Rewrites a legacy per-pixel spectrum value in the columnar layout
+    """
+    wavelength, flux = read_spectrum(value)
+    return encode_spectrum(wavelength, flux)
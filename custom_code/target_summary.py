@@ -0,0 +1,243 @@
+"""
+Bulk summaries of targets for the target list and the interesting targets page.
+
+with_target_summary annotates a Target queryset with the classification,
+redshift and description extras and whether the target has an active cadence,
+and prefetches the aliases and science tags, so a page of targets takes a
+fixed number of queries however many targets it shows. summarize_targets then
+sets the display attributes the templates use on each target.
+
+The same facts, plus the latest photometry, number of spectra and interest
+count, are also stored in the TargetSummary table so the target list can
+filter and sort on them. update_target_summaries recomputes the rows of a set
+of targets in a fixed number of queries; it is called from the target hooks,
+the data uploads and the SNEx1 sync, and from the signals below when
+photometry, spectra, cadences or interested persons change; those updates
+are collected and made once per target at the end of each request, command
+or transaction. The rebuild_target_summaries command recomputes all of them.
+"""
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Count, Exists, IntegerField, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from tom_dataproducts.models import ReducedDatum
+from tom_observations.models import DynamicCadence, ObservationGroup, ObservationRecord
+from tom_targets.models import Target, TargetExtra
+
+from custom_code.models import TargetTags, TargetSummary, InterestedPersons
+from custom_code.templatetags.custom_code_tags import get_best_name
+
+logger = logging.getLogger(__name__)
+
+_pending = threading.local()
+
+SUMMARY_FIELDS = ['best_name', 'classification', 'redshift', 'latest_magnitude', 'latest_filter',
+                  'last_photometry', 'num_spectra', 'active_cadence', 'interest_count']
+
+SUMMARY_EXTRAS = {
+    'classification': 'classification',
+    'redshift': 'redshift',
+    'description': 'target_description',
+}
+
+
+def _extra_value(key):
+    return Subquery(TargetExtra.objects.filter(target=OuterRef('pk'), key=key).values('value')[:1])
+
+
+def _active_cadence():
+    return Exists(ObservationRecord.objects.filter(
+        target=OuterRef('pk'), observationgroup__dynamiccadence__active=True
+    ))
+
+
+def _count(queryset):
+    counts = queryset.filter(target=OuterRef('pk')).order_by().values('target').annotate(n=Count('id')).values('n')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def with_target_summary(queryset):
+    """
+    Adds the summary annotations and prefetches to a Target queryset
+    """
+    annotations = {name: _extra_value(key) for name, key in SUMMARY_EXTRAS.items()}
+    annotations['has_active_cadence'] = _active_cadence()
+    return queryset.annotate(**annotations).prefetch_related(
+        'aliases',
+        Prefetch('targettags_set', queryset=TargetTags.objects.select_related('tag'))
+    )
+
+
+def summarize_targets(targets):
+    """
+    Sets best_name, science_tags and active_cadences on targets
+    from a with_target_summary queryset and returns them as a list
+    """
+    targets = list(targets)
+    for target in targets:
+        target.best_name = get_best_name(target)
+        target.science_tags = ', '.join(t.tag.tag for t in target.targettags_set.all())
+        target.active_cadences = 'Yes' if target.has_active_cadence else 'No'
+    return targets
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_target_summaries(target_ids, batch_size=500):
+    """
+    Recomputes the TargetSummary rows of the given targets, and
+    deletes the rows of targets that no longer exist
+    """
+    target_ids = sorted(set(int(t) for t in target_ids if t is not None))
+    for start in range(0, len(target_ids), batch_size):
+        ids = target_ids[start:start+batch_size]
+        latest = ReducedDatum.objects.filter(
+            target=OuterRef('pk'), data_type='photometry', value__has_key='magnitude'
+        ).order_by('-timestamp')
+        targets = with_target_summary(Target.objects.filter(id__in=ids)).annotate(
+            latest_timestamp=Subquery(latest.values('timestamp')[:1]),
+            latest_value=Subquery(latest.values('value')[:1]),
+            spectra_count=_count(ReducedDatum.objects.filter(data_type='spectroscopy')),
+            interested_count=_count(InterestedPersons.objects.all())
+        )
+
+        summaries = []
+        for target in targets:
+            value = target.latest_value or {}
+            if isinstance(value, str):
+                value = json.loads(value)
+            summaries.append(TargetSummary(
+                target=target,
+                best_name=get_best_name(target)[:100],
+                classification=(target.classification or '')[:100],
+                redshift=_float_or_none(target.redshift),
+                latest_magnitude=_float_or_none(value.get('magnitude')),
+                latest_filter=str(value.get('filter') or '')[:20],
+                last_photometry=target.latest_timestamp,
+                num_spectra=target.spectra_count,
+                active_cadence=target.has_active_cadence,
+                interest_count=target.interested_count
+            ))
+
+        TargetSummary.objects.bulk_create(summaries, update_conflicts=True, unique_fields=['target'],
+                                          update_fields=SUMMARY_FIELDS + ['modified'])
+        found = set(s.target_id for s in summaries)
+        TargetSummary.objects.filter(target_id__in=[t for t in ids if t not in found]).delete()
+
+
+def update_target_summary(target_id):
+    update_target_summaries([target_id])
+
+
+def rebuild_target_summaries(batch_size=500):
+    """
+    Recomputes the summary of every target and drops orphaned rows
+    """
+    target_ids = list(Target.objects.values_list('id', flat=True))
+    update_target_summaries(target_ids, batch_size=batch_size)
+    TargetSummary.objects.exclude(target_id__in=Target.objects.values('id')).delete()
+    logger.info('Rebuilt the summaries of {} targets'.format(len(target_ids)))
+    return len(target_ids)
+
+
+@contextmanager
+def deferred_target_summaries():
+    """
+    Collects the targets whose summaries the signals below would update
+    in the block, and updates each of them once when it ends. Used around
+    each request and by commands that save data point by point.
+    """
+    if getattr(_pending, 'deferred', None) is not None:
+        yield
+        return
+
+    _pending.deferred = set()
+    try:
+        yield
+    finally:
+        target_ids = _pending.deferred
+        _pending.deferred = None
+        _update_summaries(target_ids)
+
+
+def schedule_target_summaries(target_ids):
+    """
+    Updates the summaries of target_ids at the end of the current
+    deferred_target_summaries block, or else once the current transaction
+    commits, so a target whose data change one by one is updated once
+    """
+    target_ids = set(t for t in target_ids if t is not None)
+    deferred = getattr(_pending, 'deferred', None)
+    if deferred is not None:
+        deferred.update(target_ids)
+        return
+
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _update_summaries(target_ids)
+        return
+
+    ### One callback per transaction; a rollback drops it along with the changes
+    pending = getattr(_pending, 'committed', None)
+    if pending is None or not any(callback[1] is _update_committed_summaries for callback in connection.run_on_commit):
+        pending = _pending.committed = set()
+        transaction.on_commit(_update_committed_summaries)
+    pending.update(target_ids)
+
+
+def _update_committed_summaries():
+    target_ids = getattr(_pending, 'committed', None)
+    _pending.committed = None
+    _update_summaries(target_ids)
+
+
+def _update_summaries(target_ids):
+    if not target_ids:
+        return
+    try:
+        update_target_summaries(target_ids)
+    except Exception as e:
+        logger.error('Could not update the summaries of targets {}: {}'.format(sorted(target_ids), e))
+
+
+def _cadence_target_ids(observation_group_id):
+    return list(ObservationRecord.objects.filter(observationgroup=observation_group_id).values_list('target_id', flat=True))
+
+
+@receiver(post_save, sender=DynamicCadence)
+@receiver(post_delete, sender=DynamicCadence)
+def _cadence_changed(sender, instance, **kwargs):
+    schedule_target_summaries(_cadence_target_ids(instance.observation_group_id))
+
+
+@receiver(m2m_changed, sender=ObservationGroup.observation_records.through)
+def _cadence_records_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    ### Records are sometimes added to a group after its cadence is started
+    if action not in ('post_add', 'post_remove') or reverse or not pk_set:
+        return
+    if DynamicCadence.objects.filter(observation_group=instance).exists():
+        schedule_target_summaries(ObservationRecord.objects.filter(id__in=pk_set).values_list('target_id', flat=True))
+
+
+@receiver(post_save, sender=ReducedDatum)
+@receiver(post_delete, sender=ReducedDatum)
+def _reduced_datum_changed(sender, instance, **kwargs):
+    if instance.data_type in ('photometry', 'spectroscopy'):
+        schedule_target_summaries([instance.target_id])
+
+
+@receiver(post_save, sender=InterestedPersons)
+@receiver(post_delete, sender=InterestedPersons)
+def _interest_changed(sender, instance, **kwargs):
+    schedule_target_summaries([instance.target_id])
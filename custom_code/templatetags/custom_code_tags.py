@@ -32,8 +32,14 @@ from custom_code.forms import CustomDataProductUploadForm, PapersForm, PhotSched
 from urllib.parse import urlencode
 from tom_observations.utils import get_sidereal_visibility
 from custom_code.facilities.lco_facility import SnexPhotometricSequenceForm, SnexSpectroscopicSequenceForm
-from custom_code.thumbnails import make_thumb
-import base64
+from custom_code.thumbnail_cache import default_thumbnail_params, get_thumbnail, thumbnail_url
+from custom_code.visibility import get_airmass_series, get_24hr_airmass_series
+from custom_code.ephemeris import get_ephemeris
+from custom_code.plot_cache import get_or_build_plot
+from custom_code.photometry import get_photometry, FILTER_TRANSLATE
+from custom_code.binning import prepare_spectrum, pixel_budget
+from custom_code.spectra import read_spectrum
+from custom_code.observation_summary import load_observation_groups
 import logging
 
 logger = logging.getLogger(__name__)
@@ -45,29 +51,27 @@ def airmass_collapse(target):
     interval = 30 #min
     airmass_limit = 3.0
 
-    obj = Target
-    obj.ra = target.ra
-    obj.dec = target.dec
-    obj.epoch = 2000
-    obj.type = 'SIDEREAL' 
+    def build():
+        plot_data = get_24hr_airmass(target, interval, airmass_limit)
+        layout = go.Layout(
+            xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
+            yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
+            margin=dict(l=20,r=10,b=30,t=40),
+            hovermode='closest',
+            width=250,
+            height=200,
+            showlegend=False,
+            plot_bgcolor='white'
+        )
+        visibility_graph = offline.plot(
+                go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False, config={'staticPlot': True}, include_plotlyjs='cdn'
+        )
+        return _scatter_series(plot_data), visibility_graph
 
-    plot_data = get_24hr_airmass(obj, interval, airmass_limit)
-    layout = go.Layout(
-        xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
-        yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
-        margin=dict(l=20,r=10,b=30,t=40),
-        hovermode='closest',
-        width=250,
-        height=200,
-        showlegend=False,
-        plot_bgcolor='white'
-    )
-    visibility_graph = offline.plot(
-            go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False, config={'staticPlot': True}, include_plotlyjs='cdn'
-    )
+    cached = get_or_build_plot('airmass_collapse', target, (interval, airmass_limit), build)
     return {
         'target': target,
-        'figure': visibility_graph
+        'figure': cached['figure']
     }
 
 @register.inclusion_tag('custom_code/airmass.html', takes_context=True)
@@ -75,97 +79,87 @@ def airmass_plot(context):
     #request = context['request']
     interval = 15 #min
     airmass_limit = 3.0
-    plot_data = get_24hr_airmass(context['object'], interval, airmass_limit)
-
-    ### Get the amount of time each site is above airmass 1.6 and 2.0
-    for t in plot_data:
-        time_vals = t['x']
-        airmass_vals = np.asarray(t['y'])
-        vals_above_airmass_low = np.where(airmass_vals < 1.6)
-        vals_above_airmass_high = np.where(airmass_vals < 2.0)
+
+    def build():
+        plot_data = get_24hr_airmass(context['object'], interval, airmass_limit)
+
+        ### Get the amount of time each site is above airmass 1.6 and 2.0
+        for t in plot_data:
+            time_vals = t['x']
+            airmass_vals = np.asarray(t['y'])
+            vals_above_airmass_low = np.where(airmass_vals < 1.6)
+            vals_above_airmass_high = np.where(airmass_vals < 2.0)
         
-        ### Have to do this in a complex way to avoid nonsense answers when the
-        ### visibility plots wrap around to 24 hours from now
-        if len(vals_above_airmass_low[0]) > 0:
-            time_diffs = np.asarray(time_vals[vals_above_airmass_low]) - min(time_vals[vals_above_airmass_low])
-            valid_time_diffs = np.where(time_diffs < datetime.timedelta(hours=12))
-            ### Get the ones that are ~24 hours from now too
-            tomorrow_time_diffs = np.where(time_diffs > datetime.timedelta(hours=12))
-
-            if len(tomorrow_time_diffs[0]) > 0: # Visibility plot wrapped, so account for that
-                time_diff = max(time_diffs[valid_time_diffs]) + (max(time_diffs[tomorrow_time_diffs]) - min(time_diffs[tomorrow_time_diffs]))
+            ### Have to do this in a complex way to avoid nonsense answers when the
+            ### visibility plots wrap around to 24 hours from now
+            if len(vals_above_airmass_low[0]) > 0:
+                time_diffs = np.asarray(time_vals[vals_above_airmass_low]) - min(time_vals[vals_above_airmass_low])
+                valid_time_diffs = np.where(time_diffs < datetime.timedelta(hours=12))
+                ### Get the ones that are ~24 hours from now too
+                tomorrow_time_diffs = np.where(time_diffs > datetime.timedelta(hours=12))
+
+                if len(tomorrow_time_diffs[0]) > 0: # Visibility plot wrapped, so account for that
+                    time_diff = max(time_diffs[valid_time_diffs]) + (max(time_diffs[tomorrow_time_diffs]) - min(time_diffs[tomorrow_time_diffs]))
             
-            else:
-                time_diff = max(time_diffs[valid_time_diffs])
-            time_above_airmass_low = round(time_diff.total_seconds() / 3600, 1)
+                else:
+                    time_diff = max(time_diffs[valid_time_diffs])
+                time_above_airmass_low = round(time_diff.total_seconds() / 3600, 1)
         
-        else:
-            time_above_airmass_low = 0.0
+            else:
+                time_above_airmass_low = 0.0
 
-        if len(vals_above_airmass_high[0]) > 0:
-            time_diffs = np.asarray(time_vals[vals_above_airmass_high]) - min(time_vals[vals_above_airmass_high])
-            valid_time_diffs = np.where(time_diffs < datetime.timedelta(hours=12))
-            tomorrow_time_diffs = np.where(time_diffs > datetime.timedelta(hours=12))
+            if len(vals_above_airmass_high[0]) > 0:
+                time_diffs = np.asarray(time_vals[vals_above_airmass_high]) - min(time_vals[vals_above_airmass_high])
+                valid_time_diffs = np.where(time_diffs < datetime.timedelta(hours=12))
+                tomorrow_time_diffs = np.where(time_diffs > datetime.timedelta(hours=12))
             
-            if len(tomorrow_time_diffs[0]) > 0:
-                time_diff = max(time_diffs[valid_time_diffs]) + (max(time_diffs[tomorrow_time_diffs]) - min(time_diffs[tomorrow_time_diffs]))
+                if len(tomorrow_time_diffs[0]) > 0:
+                    time_diff = max(time_diffs[valid_time_diffs]) + (max(time_diffs[tomorrow_time_diffs]) - min(time_diffs[tomorrow_time_diffs]))
             
-            else:
-                time_diff = max(time_diffs[valid_time_diffs])
-            time_above_airmass_high = round(time_diff.total_seconds() / 3600, 1)
+                else:
+                    time_diff = max(time_diffs[valid_time_diffs])
+                time_above_airmass_high = round(time_diff.total_seconds() / 3600, 1)
         
-        else:
-            time_above_airmass_high = 0.0
+            else:
+                time_above_airmass_high = 0.0
         
-        text = 'Time Above Airmass 1.6: {} hr;Time Above Airmass 2.0: {} hr'.format(time_above_airmass_low, time_above_airmass_high) 
-        t['hovertemplate'] = '(%{customdata|%Y-%m-%d %H:%M:%S}, %{y:.2f})' + '<br>{}'.format(text.split(';')[0]) + '<br>{}'.format(text.split(';')[1])
-        t['customdata'] = time_vals
-        t['x'] = np.asarray([(time_val - datetime.datetime.utcnow()).total_seconds() / 3600 for time_val in time_vals])
+            text = 'Time Above Airmass 1.6: {} hr;Time Above Airmass 2.0: {} hr'.format(time_above_airmass_low, time_above_airmass_high) 
+            t['hovertemplate'] = '(%{customdata|%Y-%m-%d %H:%M:%S}, %{y:.2f})' + '<br>{}'.format(text.split(';')[0]) + '<br>{}'.format(text.split(';')[1])
+            t['customdata'] = time_vals
+            t['x'] = np.asarray([(time_val - datetime.datetime.utcnow()).total_seconds() / 3600 for time_val in time_vals])
+
+        layout = go.Layout(
+            xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title_text="Hours From Now"),
+            yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
+            margin=dict(l=20,r=10,b=30,t=40),
+            hovermode='closest',
+            width=600,
+            height=300,
+            plot_bgcolor='white'
+        )
+        visibility_graph = offline.plot(
+            go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
+        )
+        return _scatter_series(plot_data), visibility_graph
 
-    layout = go.Layout(
-        xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title_text="Hours From Now"),
-        yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True),
-        margin=dict(l=20,r=10,b=30,t=40),
-        hovermode='closest',
-        width=600,
-        height=300,
-        plot_bgcolor='white'
-    )
-    visibility_graph = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
+    cached = get_or_build_plot('airmass_plot', context['object'], (interval, airmass_limit), build)
     return {
         'target': context['object'],
-        'figure': visibility_graph
+        'figure': cached['figure']
     }
 
-def get_24hr_airmass(target, interval, airmass_limit, halimit=4.8):
+def _scatter_series(plot_data):
+    """
+    Numeric series behind a list of Plotly scatters, kept alongside
+    the rendered div in the plot cache
+    """
+    return [{'name': t['name'], 'x': t['x'], 'y': t['y']} for t in plot_data]
 
-    plot_data = []
-    
-    start = Time(datetime.datetime.utcnow())
-    end = Time(start.datetime + datetime.timedelta(days=1))
-    time_range = time_grid_from_range(
-        time_range = [start, end],
-        time_resolution = interval*u.minute)
-    time_plot = time_range.datetime
-    
-    fixed_target = FixedTarget(name = target.name, 
-        coord = SkyCoord(
-            target.ra,
-            target.dec,
-            unit = 'deg'
-        )
-    )
 
-    #Hack to speed calculation up by factor of ~3
-    sun_coords = get_sun(time_range[int(len(time_range)/2)])
-    fixed_sun = FixedTarget(name = 'sun',
-        coord = SkyCoord(
-            sun_coords.ra,
-            sun_coords.dec,
-            unit = 'deg'
-        )
+def get_24hr_airmass(target, interval, airmass_limit, halimit=4.8):
+
+    time_plot, labels, names, airmass = get_24hr_airmass_series(
+        target, interval, airmass_limit, sun_alt_limit=-12.0, halimit=halimit #between astro twilights
     )
 
     #Colors to match SNEx1
@@ -178,45 +172,10 @@ def get_24hr_airmass(target, interval, airmass_limit, halimit=4.8):
         'Haleakala': '#990099'
     }
 
-    for observing_facility in facility.get_service_classes():
-
-        if observing_facility != 'LCO':
-            continue
-
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-
-        for site, site_details in sites.items():
-
-            observer = Observer(
-                longitude = site_details.get('longitude')*u.deg,
-                latitude = site_details.get('latitude')*u.deg,
-                elevation = site_details.get('elevation')*u.m
-            )
-            
-            sun_alt = observer.altaz(time_range, fixed_sun).alt
-            obj_airmass = observer.altaz(time_range, fixed_target).secz
-
-            ha = observer.target_hour_angle(time_range, fixed_target).value
-            ha[ha > 12] = 24 - ha[ha > 12]
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -12*u.deg) | #between astro twilights
-                (ha > halimit)
-            )
-
-            obj_airmass = [np.nan if i in bad_indices else float(x)
-                for i, x in enumerate(obj_airmass)]
-
-            label = '({facility}) {site}'.format(
-                facility = observing_facility, site = site
-            )
-
-            plot_data.append(
-                go.Scatter(x=time_plot, y=obj_airmass, mode='lines', name=label, marker=dict(color=colors[site]))
-            )
+    plot_data = [
+        go.Scatter(x=time_plot, y=airmass[i], mode='lines', name=label, marker=dict(color=colors.get(names[i])))
+        for i, label in enumerate(labels)
+    ]
 
     return plot_data
 
@@ -248,35 +207,8 @@ def generic_lightcurve_plot(target, user):
     for the different light curve applications SNEx2 uses
     """
     
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2', 
-        'UVW1': 'UVW1'}
-    photometry_data = {}
-
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
-    
-    else:
-        datums = get_objects_for_user(user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(
-                                        target=target,
-                                        data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
-    for rd in datums:
-    #for rd in ReducedDatum.objects.filter(target=target, data_type='photometry'):
-        value = rd.value
-        if not value:  # empty
-            continue
-        if isinstance(value, str):
-            value = json.loads(value)
-
-        filt = filter_translate.get(value.get('filter', ''), '')
-   
-        photometry_data.setdefault(filt, {})
-        photometry_data[filt].setdefault('time', []).append(rd.timestamp)
-        photometry_data[filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[filt].setdefault('error', []).append(value.get('error', None))
+    filter_translate = FILTER_TRANSLATE
+    photometry_data = get_photometry(target, user).by_filter(filter_translate)
 
     plot_data = [
         go.Scatter(
@@ -363,74 +295,47 @@ def lightcurve_collapse(target, user):
 @register.inclusion_tag('custom_code/moon.html')
 def moon_vis(target):
 
-    day_range = 30
-    times = Time(
-        [str(datetime.datetime.utcnow() + datetime.timedelta(days=delta))
-            for delta in np.arange(0, day_range, 0.2)],
-        format = 'iso', scale = 'utc'
-    )
-    
-    obj_pos = SkyCoord(target.ra, target.dec, unit=u.deg)
-    moon_pos = get_moon(times)
-
-    separations = moon_pos.separation(obj_pos).deg
-    phases = moon_illumination(times)
-
-    distance_color = 'rgb(0, 0, 255)'
-    phase_color = 'rgb(255, 0, 0)'
-    plot_data = [
-        go.Scatter(x=times.mjd-times[0].mjd, y=separations, 
-            mode='lines',name='Moon distance (degrees)',
-            line=dict(color=distance_color)
-        ),
-        go.Scatter(x=times.mjd-times[0].mjd, y=phases, 
-            mode='lines', name='Moon phase', yaxis='y2',
-            line=dict(color=phase_color))
-    ]
-    layout = go.Layout(
-        xaxis=dict(gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True, title='Days from now'),
-        yaxis=dict(range=[0.,180.],tick0=0.,dtick=45.,
-            tickfont=dict(color=distance_color),
-            gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True
-        ),
-        yaxis2=dict(range=[0., 1.], tick0=0., dtick=0.25, overlaying='y', side='right',
-            tickfont=dict(color=phase_color),
-            gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True),
-        margin=dict(l=20,r=10,b=30,t=40),
-        width=600,
-        height=300,
-        plot_bgcolor='white'
-    )
-    figure = offline.plot(
-        go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
-    )
-   
-    return {'plot': figure}
-
+    def build():
+        day_range = 30
+        start = datetime.datetime.utcnow()
+        ephemeris = get_ephemeris(start, start + datetime.timedelta(days=day_range), 0.2*24*60, align=60)
+        times = ephemeris.times
+
+        separations = ephemeris.moon_separation(target.ra, target.dec)
+        phases = ephemeris.moon_illumination
+
+        distance_color = 'rgb(0, 0, 255)'
+        phase_color = 'rgb(255, 0, 0)'
+        plot_data = [
+            go.Scatter(x=times.mjd-times[0].mjd, y=separations, 
+                mode='lines',name='Moon distance (degrees)',
+                line=dict(color=distance_color)
+            ),
+            go.Scatter(x=times.mjd-times[0].mjd, y=phases, 
+                mode='lines', name='Moon phase', yaxis='y2',
+                line=dict(color=phase_color))
+        ]
+        layout = go.Layout(
+            xaxis=dict(gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True, title='Days from now'),
+            yaxis=dict(range=[0.,180.],tick0=0.,dtick=45.,
+                tickfont=dict(color=distance_color),
+                gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True
+            ),
+            yaxis2=dict(range=[0., 1.], tick0=0., dtick=0.25, overlaying='y', side='right',
+                tickfont=dict(color=phase_color),
+                gridcolor='#D3D3D3', showline=True, linecolor='#D3D3D3', mirror=True),
+            margin=dict(l=20,r=10,b=30,t=40),
+            width=600,
+            height=300,
+            plot_bgcolor='white'
+        )
+        figure = offline.plot(
+            go.Figure(data=plot_data, layout=layout), output_type='div', show_link=False
+        )
+        return {'days': times.mjd-times[0].mjd, 'separation': separations, 'phase': phases}, figure
 
-def bin_spectra(waves, fluxes, b):
-    """
-    Bins spectra given list of wavelengths, fluxes, and binning factor
-    """
-    binned_waves = []
-    binned_flux = []
-    newindex = 0
-    for index in range(0, len(fluxes), b):
-        if index + b - 1 <= len(fluxes) - 1:
-            sumx = 0
-            sumy = 0
-            for binindex in range(index, index+b, 1):
-                if binindex < len(fluxes):
-                    sumx += waves[binindex]
-                    sumy += fluxes[binindex]
-
-            sumx = sumx / b
-            sumy = sumy / b
-        if sumx > 0:
-            binned_waves.append(sumx)
-            binned_flux.append(sumy)
-
-    return binned_waves, binned_flux
+    cached = get_or_build_plot('moon_vis', target, (), build)
+    return {'plot': cached['figure']}
 
 
 @register.inclusion_tag('custom_code/spectra.html')
@@ -448,23 +353,12 @@ def spectra_plot(target, dataproduct=None):
         b=int(color[2]*255),
     ) for color in colors]
 
+    budget = pixel_budget(len(spectral_dataproducts))
     for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = read_spectrum(spectrum.value)
 
-        binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
+        binned_wavelength, binned_flux = prepare_spectrum(wavelength, flux, 5, npoints=budget)
         spectra.append((binned_wavelength, binned_flux, name))
     plot_data = [
         go.Scatter(
@@ -511,22 +405,11 @@ def spectra_plot(target, dataproduct=None):
 def spectra_collapse(target):
     spectra = []
     spectral_dataproducts = ReducedDatum.objects.filter(target=target, data_type='spectroscopy').order_by('-timestamp')
+    budget = pixel_budget(len(spectral_dataproducts))
     for spectrum in spectral_dataproducts:
-        datum = spectrum.value
-        wavelength = []
-        flux = []
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(float(value['wavelength']))
-                flux.append(float(value['flux']))
+        wavelength, flux = read_spectrum(spectrum.value)
         
-        binned_wavelength, binned_flux = bin_spectra(wavelength, flux, 5)
+        binned_wavelength, binned_flux = prepare_spectrum(wavelength, flux, 5, npoints=budget)
         spectra.append((binned_wavelength, binned_flux))
     plot_data = [
         go.Scatter(
@@ -678,14 +561,7 @@ def dash_lightcurve(context, target, width, height):
     final_reduction = False
     background_subtracted = False
 
-    datumquery = ReducedDatum.objects.filter(target=target, data_type='photometry')
-    for i in datumquery:
-        datum_value = i.value
-        if isinstance(datum_value, str):
-            datum_value = json.loads(datum_value)
-        if datum_value.get('background_subtracted', '') == True:
-            background_subtracted = True
-            break
+    background_subtracted = bool(get_photometry(target).background_subtracted.any())
 
     final_background_subtracted = False
     for de in ReducedDatumExtra.objects.filter(target=target, key='upload_extras', data_type='photometry'):
@@ -783,22 +659,10 @@ def dash_spectra(context, target):
     min_flux = 0
     for i in range(len(spectral_dataproducts)):
         spectrum = spectral_dataproducts[i]
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(value['wavelength'])
-                flux.append(float(value['flux']))
-        if max(flux) > max_flux: max_flux = max(flux)
-        if min(flux) < min_flux: min_flux = min(flux)
+        wavelength, flux = read_spectrum(spectrum.value)
+        if np.nanmax(flux) > max_flux: max_flux = float(np.nanmax(flux))
+        if np.nanmin(flux) < min_flux: min_flux = float(np.nanmin(flux))
 
     dash_context = {'target_id': {'value': target.id},
                     'target_redshift': {'value': z},
@@ -834,12 +698,13 @@ def custom_observation_plan(target, facility, length=1, interval=30, airmass_lim
     start_time = datetime.datetime.now()
     end_time = start_time + datetime.timedelta(days=length)
 
-    visibility_data = get_sidereal_visibility(target, start_time, end_time, interval, airmass_limit)
-    i = 0
-    plot_data = []
-    for site, data in visibility_data.items():
-        plot_data.append(go.Scatter(x=data[0], y=data[1], mode='markers+lines', marker={'symbol': i}, name=site))
-        i += 1
+    time_plot, labels, names, airmass = get_airmass_series(
+        target, start_time, end_time, interval, airmass_limit, sun_alt_limit=-18.0, facilities=None
+    )
+    plot_data = [
+        go.Scatter(x=time_plot, y=airmass[i], mode='markers+lines', marker={'symbol': i}, name=label)
+        for i, label in enumerate(labels)
+    ]
     layout = go.Layout(
         xaxis=dict(gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Date'),
         yaxis=dict(range=[airmass_limit,1.0],gridcolor='#D3D3D3',showline=True,linecolor='#D3D3D3',mirror=True,title='Airmass'),
@@ -876,29 +741,33 @@ def observation_summary(context, target=None, time='previous'):
 
     observations = observations.order_by('parameters__start')
 
-    if time == 'ongoing':
-        cadences = DynamicCadence.objects.filter(active=True, observation_group__in=ObservationGroup.objects.filter(name__in=[o.parameters.get('name', '') for o in observations]))
-    
-    else:
-        if time == 'pending':
-            observations = observations.filter(observation_id='template pending')
-        cadences = DynamicCadence.objects.filter(active=False, observation_group__in=ObservationGroup.objects.filter(name__in=[o.parameters.get('name', '') for o in observations]))
+    if time == 'pending':
+        observations = observations.filter(observation_id='template pending')
+    names = [p.get('name', '') for p in observations.values_list('parameters', flat=True) if isinstance(p, dict)]
+    cadences = DynamicCadence.objects.filter(active=(time == 'ongoing'), observation_group__name__in=names).select_related('observation_group')
+
+    ### Records and comments of all the groups at once
+    cadences = list(cadences)
+    groups = load_observation_groups([cadence.observation_group_id for cadence in cadences])
     
     parameters = []
     for cadence in cadences:
-        obsgroup = ObservationGroup.objects.get(id=cadence.observation_group_id)
+        obsgroup = cadence.observation_group
+        group = groups[obsgroup.id]
         #Check if the request is pending, and if so skip it
-        pending_obs = obsgroup.observation_records.all().filter(observation_id='template pending').first()
+        pending_obs = group['pending']
         if not pending_obs and time == 'pending':
             continue
         
         if time == 'pending':
             observation = pending_obs
         else:
-            observation = obsgroup.observation_records.all().filter(observation_id='template').first()
+            observation = group['template']
         if not observation:
-            observation = obsgroup.observation_records.all().order_by('-id').first()
-            first_observation = obsgroup.observation_records.all().order_by('id').first()
+            observation = group['latest']
+            first_observation = group['first']
+            if observation is None:
+                continue
             sequence_start = str(first_observation.parameters.get('start')).split('T')[0]
             requested_str = ''
         else:
@@ -965,9 +834,7 @@ def observation_summary(context, target=None, time='previous'):
             parameter_string += requested_str
 
             ### Get any comments associated with this observation group
-            content_type_id = ContentType.objects.get(model='observationgroup').id
-            comments = Comment.objects.filter(object_pk=obsgroup.id, content_type_id=content_type_id).order_by('id')
-            comment_list = ['{}: {}'.format(User.objects.get(username=comment.user_name).first_name, comment.comment) for comment in comments]
+            comment_list = group['comments']
 
             parameters.append({'title': 'LCO Sequence'+title_suffix,
                                'summary': parameter_string,
@@ -1310,26 +1177,13 @@ def dash_spectra_page(context, target):
         min_flux = 0
         
         spectrum = spectral_dataproducts[i]
-        datum = spectrum.value
-        wavelength = []
-        flux = []
         name = str(spectrum.timestamp).split(' ')[0]
-        if datum.get('photon_flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('photon_flux')
-        elif datum.get('flux'):
-            wavelength = datum.get('wavelength')
-            flux = datum.get('flux')
-        else:
-            for key, value in datum.items():
-                wavelength.append(value['wavelength'])
-                flux.append(float(value['flux']))
-        if max(flux) > max_flux: max_flux = max(flux)
-        if min(flux) < min_flux: min_flux = min(flux)
-
-        snex_id_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', target_id=target_id, key='snex_id', value__icontains='"snex2_id": {}'.format(spectrum.id)).first()
-        if snex_id_row:
-            snex1_id = json.loads(snex_id_row.value)['snex_id']
+        wavelength, flux = read_spectrum(spectrum.value)
+        if np.nanmax(flux) > max_flux: max_flux = float(np.nanmax(flux))
+        if np.nanmin(flux) < min_flux: min_flux = float(np.nanmin(flux))
+
+        snex1_id = SNEx1Mapping.objects.filter(table='spec', reduced_datum_id=spectrum.id).values_list('snex1_id', flat=True).first()
+        if snex1_id:
             spec_extras_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='spec_extras', value__icontains='"snex_id": {}'.format(snex1_id)).first()
             if spec_extras_row:
                 spec_extras = json.loads(spec_extras_row.value)
@@ -1646,19 +1500,12 @@ def image_slideshow(context, target):
     choices = {'filenames': thumbdict}
     thumbnailform = ThumbnailForm(initial=initial, choices=choices)
 
-    ### Make the initial thumbnail
-    if psfxs[0] < 9999 and psfys[0] < 9999:
-        f = make_thumb(['data/fits/'+filepaths[0]+filenames[0]+'.fits'], grow=1.0, x=psfxs[0], y=psfys[0], ticks=True)
-    else:
-        f = make_thumb(['data/fits/'+filepaths[0]+filenames[0]+'.fits'], grow=1.0, x=1024, y=1024, ticks=False)
-
-    with open('data/thumbs/'+f[0], 'rb') as imagefile:        
-        b64_image = base64.b64encode(imagefile.read())
-        thumb = b64_image
+    ### Make the initial thumbnail, or reuse the cached one
+    key = get_thumbnail('data/fits/'+filepaths[0]+filenames[0]+'.fits', **default_thumbnail_params(psfxs[0], psfys[0]))
 
     return {'target': target,
             'form': thumbnailform,
-            'thumb': b64_image.decode('utf-8'),
+            'thumb': thumbnail_url(key),
             'telescope': teles[0],
             'instrument': filenames[0].split('-')[1][:2],
             'filter': filters[0],
@@ -1668,35 +1515,9 @@ def image_slideshow(context, target):
 @register.inclusion_tag('custom_code/lightcurve_collapse.html')
 def lightcurve_fits(target, user, filt=False, days=None):
     
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2', 
-        'UVW1': 'UVW1'}
-    plot_data = generic_lightcurve_plot(target, user)     
-    photometry_data = {}
-
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
-    else:
-        datums = get_objects_for_user(user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(
-                                        target=target,
-                                        data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
-
-    for rd in datums:
-        value = rd.value
-        if not value:  # empty
-            continue
-        if isinstance(value, str):
-            value = json.loads(value)
-
-        current_filt = filter_translate.get(value.get('filter', ''), '')
-   
-        photometry_data.setdefault(current_filt, {})
-        photometry_data[current_filt].setdefault('time', []).append(rd.timestamp)
-        photometry_data[current_filt].setdefault('magnitude', []).append(value.get('magnitude',None))
-        photometry_data[current_filt].setdefault('error', []).append(value.get('error', None))        
+    filter_translate = FILTER_TRANSLATE
+    photometry = get_photometry(target, user)
+    photometry_data = photometry.by_filter(filter_translate)
 
     plot_data = [
         go.Scatter(
@@ -1743,31 +1564,21 @@ def lightcurve_fits(target, user, filt=False, days=None):
         }
     
     else:
-        filtlist = list(photometry_data.keys())
-        lens = []
-        for f in filtlist:
-            lens.append(len(photometry_data[f]['magnitude']))
-        filt = filtlist[lens.index(max(lens))]
+        filt = max(photometry_data, key=lambda f: len(photometry_data[f]['magnitude']))
         photometry_to_fit = photometry_data[filt]
 
-    start_date = min(photometry_to_fit['time'])
-    start_jd = Time(start_date, scale='utc').jd
-   
-    times = photometry_to_fit['time']
-    mags = []
-    errs = []
-    jds = []
+    all_jds = photometry.mjd[photometry_to_fit['index']] + 2400000.5
+    start_jd = all_jds.min()
 
     if not days:
         days_to_fit = 20
     else:
         days_to_fit = days
 
-    for date in times:
-        if Time(date, scale='utc').jd < start_jd + days_to_fit:
-            jds.append(float(Time(date, scale='utc').jd))
-            mags.append(photometry_to_fit['magnitude'][times.index(date)])
-            errs.append(photometry_to_fit['error'][times.index(date)])
+    to_fit = all_jds < start_jd + days_to_fit
+    jds = all_jds[to_fit]
+    mags = photometry_to_fit['magnitude'][to_fit]
+    errs = photometry_to_fit['error'][to_fit]
     try:
         A, B, C = np.polyfit(jds, mags, 2, w=1/(np.asarray(errs)))
         fit_jds = np.linspace(min(jds), max(jds), 100)
@@ -1800,6 +1611,7 @@ def lightcurve_fits(target, user, filt=False, days=None):
         logger.info(e)
         logger.info('Quadratic light curve fit failed for target {}'.format(target.id))
         maximum = ''
+        max_mag = ''
 
     return {
         'target': target,
@@ -1813,10 +1625,7 @@ def lightcurve_fits(target, user, filt=False, days=None):
 @register.inclusion_tag('custom_code/lightcurve_collapse.html')
 def lightcurve_with_extras(target, user):
     
-    filter_translate = {'U': 'U', 'B': 'B', 'V': 'V',
-        'g': 'g', 'gp': 'g', 'r': 'r', 'rp': 'r', 'i': 'i', 'ip': 'i',
-        'g_ZTF': 'g_ZTF', 'r_ZTF': 'r_ZTF', 'i_ZTF': 'i_ZTF', 'UVW2': 'UVW2', 'UVM2': 'UVM2', 
-        'UVW1': 'UVW1'}
+    filter_translate = FILTER_TRANSLATE
     plot_data = generic_lightcurve_plot(target, user)         
     spec = ReducedDatum.objects.filter(target=target, data_type='spectroscopy')
 
@@ -1875,9 +1684,6 @@ def lightcurve_with_extras(target, user):
 @register.inclusion_tag('custom_code/thumbnail.html', takes_context=True)
 def test_display_thumbnail(context, target):
     
-    from os import listdir
-    from os.path import isfile, join
-    
     if not settings.DEBUG:
         #NOTE: Production
         try:
@@ -1904,52 +1710,23 @@ def test_display_thumbnail(context, target):
         return {'top_images': [],
                 'bottom_images': []}
 
-    thumbs = [f for f in listdir('data/thumbs/') if isfile(join('data/thumbs/', f))]
-    top_images = []
-    bottom_images = [] 
     sites = [f[:3].upper() for f in filenames]
-    
-    thumbfiles = []
-    thumbdates = []
-    thumbteles = []
-    thumbsites = []
-    thumbfilters = []
-    thumbexptimes = []
 
+    thumbs = []
     for i in range(len(filenames)):
-        currentfile = filenames[i]
-        if any(currentfile in f and 'grow' not in f for f in thumbs):
-            matchingfiles = [f for f in thumbs if f.startswith(currentfile) and 'grow' not in f]
-            if matchingfiles:
-                thumbfiles.append(matchingfiles[0])
-        else:
-            # Generate the thumbnail and save the image
-            if psfxs[i] < 9999 and psfys[i] < 9999:
-                f = make_thumb(['data/fits/'+filepaths[i]+currentfile+'.fits'], grow=1.0, x=psfxs[i], y=psfys[i], ticks=True)
-            else:
-                f = make_thumb(['data/fits/'+filepaths[i]+currentfile+'.fits'], grow=1.0, x=1024, y=1024, ticks=False)
-            thumbfiles.append(f[0])
-        
-        thumbdates.append(dates[i])
-        thumbteles.append(teles[i])
-        thumbsites.append(sites[i])
-        thumbfilters.append(filters[i])
-        thumbexptimes.append(exptimes[i])
-    
-    halfway = round(len(thumbfiles)/2)
-    
-    for i in range(len(thumbfiles)):
-        with open('data/thumbs/'+thumbfiles[i], 'rb') as imagefile:        
-            b64_image = base64.b64encode(imagefile.read())
-            label = '{} {} {} {} {}'.format(thumbdates[i], thumbsites[i], thumbteles[i], thumbfilters[i], thumbexptimes[i])
-            if i < halfway:
-                top_images.append({'image': b64_image.decode('utf-8'),
-                                   'label': label,
-                                })
-            else:
-                bottom_images.append({'image': b64_image.decode('utf-8'),
-                                      'label': label
-                                      })
+        try:
+            key = get_thumbnail('data/fits/'+filepaths[i]+filenames[i]+'.fits', **default_thumbnail_params(psfxs[i], psfys[i]))
+        except Exception as e:
+            logger.warning('Could not make the thumbnail for {}: {}'.format(filenames[i], e))
+            continue
+        label = '{} {} {} {} {}'.format(dates[i], sites[i], teles[i], filters[i], exptimes[i])
+        thumbs.append({'image': thumbnail_url(key),
+                       'label': label
+                    })
+
+    halfway = round(len(thumbs)/2)
+    top_images = thumbs[:halfway]
+    bottom_images = thumbs[halfway:]
 
     return {'top_images': top_images,
             'bottom_images': bottom_images}
@@ -2045,36 +1822,38 @@ def broker_target_lightcurve(target):
 def snex2_get_photometry_data(context, target, target_share=False):
 
     user = context['request'].user
-    photometry = get_objects_for_user(user,
-                                  'tom_dataproducts.view_reduceddatum',
-                                  klass=ReducedDatum.objects.filter(
-                                    target=target,
-                                    data_type=settings.DATA_PRODUCT_TYPES['photometry'][0],
-                                    value__has_key='filter')).order_by('timestamp')
+    photometry = get_photometry(target, user)
+    photometry = photometry.select(photometry.has_filter)
+
+    ### Get the exchange messages for all of the data at once
+    messages = {}
+    message_rows = ReducedDatum.message.through.objects.filter(
+        reduceddatum_id__in=photometry.id.tolist()
+    ).values_list('reduceddatum_id', 'alertstreammessage__exchange_status', 'alertstreammessage__topic')
+    for reduced_datum_id, exchange_status, topic in message_rows:
+        if exchange_status == 'published':
+            messages.setdefault(reduced_datum_id, []).append(exchange_status + ' to ' + topic)
+        else:
+            messages.setdefault(reduced_datum_id, []).append(exchange_status + ' from ' + topic)
+
     data = []
-    for reduced_datum in photometry:
-        rd_data = {'id': reduced_datum.pk,
-                   'timestamp': reduced_datum.timestamp,
-                   'source': reduced_datum.source_name,
-                   'filter': reduced_datum.value.get('filter', ''),
-                   'telescope': reduced_datum.value.get('telescope', ''),
-                   'error': reduced_datum.value.get('error', reduced_datum.value.get('magnitude_error', ''))
+    for i in range(len(photometry)):
+        rd_data = {'id': int(photometry.id[i]),
+                   'timestamp': photometry.timestamp[i],
+                   'source': photometry.source_name[i],
+                   'filter': photometry.filter[i],
+                   'telescope': photometry.telescope[i],
+                   'error': '' if np.isnan(photometry.error[i]) else photometry.error[i]
                    }
 
-        if 'limit' in reduced_datum.value.keys():
-            rd_data['magnitude'] = reduced_datum.value['limit']
+        if not np.isnan(photometry.limit[i]):
+            rd_data['magnitude'] = photometry.limit[i]
             rd_data['limit'] = True
         else:
-            rd_data['magnitude'] = reduced_datum.value['magnitude']
+            rd_data['magnitude'] = photometry.magnitude[i]
             rd_data['limit'] = False
 
-        messages = []
-        for message in reduced_datum.message.all():
-            if message.exchange_status == 'published':
-                messages.append(message.exchange_status + ' to ' + message.topic)
-            else:
-                messages.append(message.exchange_status + ' from ' + message.topic)
-        rd_data['messages'] = messages
+        rd_data['messages'] = messages.get(rd_data['id'], [])
 
         data.append(rd_data)
 
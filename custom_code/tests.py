@@ -1,3 +1,197 @@
-from django.test import TestCase
+import datetime
+from io import StringIO
 
-# Create your tests here.
+from astropy import units as u
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord, get_body
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_comments.models import Comment
+from tom_dataproducts.models import ReducedDatum
+from tom_observations.models import ObservationGroup, ObservationRecord, DynamicCadence
+from tom_targets.models import Target
+
+from custom_code.ephemeris import EphemerisTable, get_ephemeris
+from custom_code.models import TargetSummary
+from custom_code.target_summary import deferred_target_summaries
+from custom_code.templatetags.custom_code_tags import observation_summary
+from custom_code.visibility import compute_visibility
+
+
+@override_settings(TARGET_PERMISSIONS_ONLY=True)
+class TestObservationSummary(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='observer', first_name='Obs')
+        self.target = Target.objects.create(name='2023abc', type='SIDEREAL', ra=10.0, dec=-20.0)
+        self.site, _ = Site.objects.get_or_create(id=settings.SITE_ID, defaults={'domain': 'example.com', 'name': 'example'})
+        self.content_type = ContentType.objects.get_for_model(ObservationGroup)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.context = {'request': request}
+
+    def add_sequences(self, n, active=True):
+        for i in range(n):
+            name = 'sequence {}'.format(ObservationGroup.objects.count())
+            group = ObservationGroup.objects.create(name=name)
+            for observation_id in ['template', 'latest']:
+                record = ObservationRecord.objects.create(
+                    target=self.target, facility='LCO', observation_id=observation_id, status='PENDING',
+                    parameters={'name': name, 'facility': 'LCO', 'observation_type': 'IMAGING', 'start': '2023-01-01T00:00:00',
+                                'cadence_strategy': 'SnexResumeCadenceAfterFailureStrategy', 'cadence_frequency': 3.0,
+                                'start_user': 'observer', 'ipp_value': 1.0, 'max_airmass': 1.6, 'gp': [120.0, 1]}
+                )
+                group.observation_records.add(record)
+            DynamicCadence.objects.create(observation_group=group, cadence_strategy='SnexResumeCadenceAfterFailureStrategy',
+                                          cadence_parameters={'cadence_frequency': 3.0}, active=active)
+            Comment.objects.create(content_type=self.content_type, object_pk=str(group.id), site=self.site,
+                                   user=self.user, user_name=self.user.username, comment='comment {}'.format(i))
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = observation_summary(self.context, target=self.target, time='ongoing')
+        return len(queries), result
+
+    def test_summary_contents(self):
+        self.add_sequences(1)
+        _, result = self.count_queries()
+        self.assertEqual(len(result['parameters']), 1)
+        parameter = result['parameters'][0]
+        self.assertEqual(parameter['title'], 'LCO Sequence')
+        self.assertIn('3.0-day imaging cadence of gp (120.0x1)', parameter['summary'])
+        self.assertIn('requested by observer', parameter['summary'])
+        self.assertEqual(parameter['comments'], ['Obs: comment 0'])
+
+    def test_query_count_does_not_grow_with_sequences(self):
+        self.add_sequences(1)
+        one_sequence, _ = self.count_queries()
+
+        self.add_sequences(9)
+        ten_sequences, result = self.count_queries()
+
+        self.assertEqual(len(result['parameters']), 10)
+        self.assertEqual(one_sequence, ten_sequences)
+        self.assertLessEqual(ten_sequences, 5)
+
+
+class TestRebuildTargetSummaries(TestCase):
+
+    def test_command(self):
+        target = Target.objects.create(name='2023ghi', type='SIDEREAL', ra=10.0, dec=-20.0)
+        ReducedDatum.objects.create(target=target, data_type='photometry', timestamp=timezone.now(),
+                                    value={'magnitude': 17.2, 'filter': 'g', 'error': 0.05})
+        TargetSummary.objects.all().delete()
+
+        call_command('rebuild_target_summaries', stdout=StringIO())
+        summary = TargetSummary.objects.get(target=target)
+        self.assertEqual(summary.latest_magnitude, 17.2)
+        self.assertEqual(summary.latest_filter, 'g')
+
+        ### Or only the given targets
+        TargetSummary.objects.filter(target=target).update(latest_magnitude=None)
+        call_command('rebuild_target_summaries', target_id=[target.id], stdout=StringIO())
+        self.assertEqual(TargetSummary.objects.get(target=target).latest_magnitude, 17.2)
+
+
+class TestTargetSummarySignals(TestCase):
+
+    def setUp(self):
+        self.target = Target.objects.create(name='2023def', type='SIDEREAL', ra=10.0, dec=-20.0)
+
+    def summary(self):
+        return TargetSummary.objects.get(target=self.target)
+
+    def test_cadence_start_and_stop(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            group = ObservationGroup.objects.create(name='sequence')
+            cadence = DynamicCadence.objects.create(observation_group=group, cadence_strategy='SnexResumeCadenceAfterFailureStrategy',
+                                                    cadence_parameters={'cadence_frequency': 3.0}, active=True)
+            ### The records are added after the cadence is started
+            record = ObservationRecord.objects.create(target=self.target, facility='LCO', observation_id='template',
+                                                      status='PENDING', parameters={})
+            group.observation_records.add(record)
+        self.assertTrue(self.summary().active_cadence)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cadence.active = False
+            cadence.save()
+        self.assertFalse(self.summary().active_cadence)
+
+    def test_new_photometry(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ReducedDatum.objects.create(target=self.target, data_type='photometry', timestamp=timezone.now(),
+                                        value={'magnitude': 18.5, 'filter': 'r', 'error': 0.05})
+        summary = self.summary()
+        self.assertEqual(summary.latest_magnitude, 18.5)
+        self.assertEqual(summary.latest_filter, 'r')
+        self.assertIsNotNone(summary.last_photometry)
+
+
+### Cerro Tololo, Haleakala and Siding Spring
+SITE_LATS = [-30.1674, 20.7075, -31.2733]
+SITE_LONS = [-70.8048, -156.2569, 149.0711]
+
+
+def reference_altitudes(coord, times, lat, lon):
+    location = EarthLocation(lat=lat*u.deg, lon=lon*u.deg, height=0*u.m)
+    return coord.transform_to(AltAz(obstime=times, location=location)).alt.deg
+
+
+class TestVisibility(SimpleTestCase):
+
+    def test_matches_astropy_altaz(self):
+        for start in [datetime.datetime(2024, 6, 21, 0, 0), datetime.datetime(2024, 12, 30, 6, 0)]:
+            ephemeris = get_ephemeris(start, start + datetime.timedelta(days=1), 20)
+            ra, dec = 150.0, -20.0
+            visibility = compute_visibility(ra, dec, ephemeris, SITE_LATS, SITE_LONS)
+
+            for i, (lat, lon) in enumerate(zip(SITE_LATS, SITE_LONS)):
+                alt = reference_altitudes(SkyCoord(ra, dec, unit='deg'), ephemeris.times, lat, lon)
+                up = alt > 10
+                self.assertTrue(up.any())
+                self.assertLess(abs(1 / np.sin(np.radians(alt[up])) - visibility['airmass'][i][up]).max(), 0.01)
+
+                sun_alt = reference_altitudes(get_body('sun', ephemeris.times), ephemeris.times, lat, lon)
+                self.assertLess(abs(sun_alt - visibility['sun_alt'][i]).max(), 0.05)
+
+
+class TestEphemerisTable(SimpleTestCase):
+
+    ### Half a day around the new moons of 2024 July and December,
+    ### with targets a few degrees from the moon
+    CASES = [
+        (datetime.datetime(2024, 7, 5, 17, 0), 108.0, 25.0),
+        (datetime.datetime(2024, 12, 30, 16, 30), 277.0, -26.0),
+    ]
+
+    def test_sun_alt_matches_astropy_altaz(self):
+        for start, _, _ in self.CASES:
+            table = EphemerisTable(start, 37, 20)
+            sun_alt = table.sun_alt(SITE_LATS, SITE_LONS)
+            for i, (lat, lon) in enumerate(zip(SITE_LATS, SITE_LONS)):
+                reference = reference_altitudes(get_body('sun', table.times), table.times, lat, lon)
+                self.assertLess(abs(reference - sun_alt[i]).max(), 0.05)
+
+    def test_moon_separation_matches_astropy(self):
+        for start, ra, dec in self.CASES:
+            table = EphemerisTable(start, 37, 20)
+            separation = table.moon_separation(ra, dec)
+            reference = get_body('moon', table.times).separation(SkyCoord(ra, dec, unit='deg')).deg
+            self.assertLess(reference.min(), 10)
+            self.assertLess(abs(reference - separation).max(), 0.05)
+
+    def test_deferred_updates(self):
+        with deferred_target_summaries():
+            for i in range(5):
+                ReducedDatum.objects.create(target=self.target, data_type='photometry',
+                                            timestamp=timezone.now() + datetime.timedelta(hours=i),
+                                            value={'magnitude': 18.0 + i, 'filter': 'r', 'error': 0.05})
+            self.assertFalse(TargetSummary.objects.filter(target=self.target).exists())
+        self.assertEqual(self.summary().latest_magnitude, 22.0)
@@ -0,0 +1,256 @@
+"""
+Content-addressed on-disk cache of image thumbnails.
+
+Each thumbnail is stored as <key>.webp in THUMBNAIL_CACHE_DIR, where the key
+hashes the image path, its size and modification time, and the rendering
+parameters (cutout region, zoom, sigma span and crosshair). A key therefore
+always names the same bytes, so thumbnails are served from a URL with the key
+as its ETag and can be cached by the browser indefinitely. Hits bump the file
+modification time and the least recently used thumbnails are removed once the
+cache grows past THUMBNAIL_CACHE_MAX_BYTES.
+
+Batches of thumbnails are rendered by iter_thumbnails on a shared pool of
+THUMBNAIL_BATCH_WORKERS threads, with at most THUMBNAIL_BATCH_QUEUE renders
+queued at a time, and yielded in the order they finish.
+
+With THUMBNAIL_IMAGE_SKY the stretch uses the sky level and noise of the whole
+image, estimated once per image file and kept in the Django cache, instead of
+those of each cutout, so the stretch doesn't change with the zoom.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import reverse
+
+from custom_code.thumbnails import find_image, image_sky, render_thumb, thumb_region
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_CACHE_DIR = getattr(settings, 'THUMBNAIL_CACHE_DIR', 'data/thumbs/cache/')
+THUMBNAIL_CACHE_MAX_BYTES = getattr(settings, 'THUMBNAIL_CACHE_MAX_BYTES', 2 * 1024**3)
+THUMBNAIL_IMAGE_SKY = getattr(settings, 'THUMBNAIL_IMAGE_SKY', True)
+IMAGE_SKY_CACHE_TIMEOUT = 7 * 24 * 3600 # seconds
+THUMBNAIL_CACHE_EVICT_INTERVAL = 300 # seconds between size checks in each process
+THUMBNAIL_TOUCH_INTERVAL = 3600 # only bump the LRU time of a hit this often
+
+THUMBNAIL_BATCH_WORKERS = getattr(settings, 'THUMBNAIL_BATCH_WORKERS', 4)
+THUMBNAIL_BATCH_QUEUE = getattr(settings, 'THUMBNAIL_BATCH_QUEUE', 8)
+THUMBNAIL_BATCH_MAX = getattr(settings, 'THUMBNAIL_BATCH_MAX', 100) # images per request
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+_lock = threading.Lock()
+_last_eviction = 0.0
+_executor = None
+
+
+def default_thumbnail_params(psfx, psfy, grow=1.0, spansig=4):
+    """
+    Thumbnail centered on the target if its position on the image
+    is known, otherwise on the middle of the chip
+    """
+    if psfx < 9999 and psfy < 9999:
+        return {'x': psfx, 'y': psfy, 'grow': grow, 'spansig': spansig, 'ticks': True}
+    return {'x': 1024, 'y': 1024, 'grow': grow, 'spansig': spansig, 'ticks': False}
+
+
+def _image_version(filename):
+    stat = os.stat(find_image(filename))
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+
+def thumbnail_key(filename, x, y, grow=1.0, spansig=4, ticks=False):
+    """
+    Hash of the image file and the rendering parameters
+    """
+    params = _image_version(filename) + [thumb_region(x, y, grow=grow), float(grow),
+                                         float(spansig), bool(ticks), THUMBNAIL_IMAGE_SKY]
+    return hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+
+
+def cached_image_sky(filename):
+    """
+    Sky level and noise of the whole image, computed once per image version
+    """
+    cache_key = 'image_sky_' + hashlib.sha1(json.dumps(_image_version(filename)).encode('utf-8')).hexdigest()
+    sky = cache.get(cache_key)
+    if sky is None:
+        sky = image_sky(find_image(filename))
+        cache.set(cache_key, sky, IMAGE_SKY_CACHE_TIMEOUT)
+    return sky
+
+
+def thumbnail_path(key):
+    """
+    Path of the cached thumbnail for key, or None for a malformed key
+    """
+    if not KEY_PATTERN.match(key or ''):
+        return None
+    return os.path.join(THUMBNAIL_CACHE_DIR, key + '.webp')
+
+
+def touch_thumbnail(path):
+    try:
+        if time.time() - os.path.getmtime(path) > THUMBNAIL_TOUCH_INTERVAL:
+            os.utime(path)
+    except OSError:
+        pass
+
+
+def get_thumbnail(filename, x, y, grow=1.0, spansig=4, ticks=False):
+    """
+    Returns the key of the thumbnail of filename, rendering it
+    if it is not in the cache yet
+    """
+    key = thumbnail_key(filename, x, y, grow=grow, spansig=spansig, ticks=ticks)
+    path = thumbnail_path(key)
+    if os.path.exists(path):
+        touch_thumbnail(path)
+        return key
+
+    sky, sig = None, None
+    if THUMBNAIL_IMAGE_SKY:
+        try:
+            sky, sig = cached_image_sky(filename)
+        except Exception as e:
+            logger.warning('Could not estimate the sky of {}, using the cutout: {}'.format(filename, e))
+
+    os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+    render_thumb(filename, path, grow=grow, x=x, y=y, ticks=ticks, spansig=spansig, sky=sky, sig=sig)
+    maybe_evict()
+    return key
+
+
+def thumbnail_url(key):
+    return reverse('thumbnail', kwargs={'key': key})
+
+
+def evict_thumbnails(max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+    """
+    Removes the least recently used thumbnails until the cache is
+    back under 90% of max_bytes. Returns the number removed.
+    """
+    try:
+        entries = []
+        with os.scandir(THUMBNAIL_CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.webp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    target = 0.9 * max_bytes
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    logger.info('Removed {} thumbnails from the cache'.format(removed))
+    return removed
+
+
+def maybe_evict():
+    """
+    Runs evict_thumbnails at most once every THUMBNAIL_CACHE_EVICT_INTERVAL
+    """
+    global _last_eviction
+    now = time.monotonic()
+    with _lock:
+        if now - _last_eviction < THUMBNAIL_CACHE_EVICT_INTERVAL:
+            return
+        _last_eviction = now
+    evict_thumbnails()
+
+
+def pregenerate_thumbnail(job):
+    """
+    Renders the default thumbnail for a (filename, psfx, psfy) job,
+    for use in a process pool. Returns (filename, key or None).
+    """
+    filename, psfx, psfy = job
+    try:
+        return filename, get_thumbnail(filename, **default_thumbnail_params(psfx, psfy))
+    except Exception as e:
+        logger.warning('Could not make the thumbnail for {}: {}'.format(filename, e))
+        return filename, None
+
+
+def _executor_class():
+    """
+    Thumbnails need native threads, even when gevent has patched
+    threading in the gunicorn workers
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor
+    except ImportError:
+        pass
+    return ThreadPoolExecutor
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = _executor_class()(max_workers=THUMBNAIL_BATCH_WORKERS)
+        return _executor
+
+
+def _render_job(job):
+    index, filename, params = job
+    try:
+        return index, get_thumbnail(filename, **params), None
+    except Exception as e:
+        logger.warning('Could not make the thumbnail for {}: {}'.format(filename, e))
+        return index, None, str(e)
+
+
+def iter_thumbnails(jobs, queue_size=THUMBNAIL_BATCH_QUEUE):
+    """
+    Renders (index, filename, params) jobs on the thread pool and yields
+    (index, key, error) as each one finishes. Only queue_size jobs are
+    submitted at a time, and the unstarted ones are cancelled if the
+    caller stops iterating.
+    """
+    executor = get_executor()
+    jobs = iter(jobs)
+    pending = set()
+
+    def submit_next():
+        job = next(jobs, None)
+        if job is not None:
+            pending.add(executor.submit(_render_job, job))
+
+    try:
+        for _ in range(max(queue_size, 1)):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                submit_next()
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -6,10 +6,10 @@ Modified from SNEx
 """
 import sys
 import os
+import tempfile
 import numpy as np
 from astropy.io import fits
 from PIL import Image, ImageDraw
-from struct import pack, unpack
 
 
 # ************************************************************
@@ -57,21 +57,13 @@ class ImageThumb:
         # normalize the sky background?
         self.fixscale = fixscale
 
-        # open the image
-        hlist = fits.open(imagepath)
+        # read only the header and the pixels that will be displayed
+        header = getheader(imagepath, ext=0)
+        data = getdata(imagepath, region=self.region, skip=self.skip, ext=0)
 
-        hdu = hlist[0]
-        if self.region:
-            data = getdata(imagepath, region=self.region, skip=self.skip, ext=0)
-
-        else:
-            data = hdu.data
-            
-        chip_id = int(hdu.header.get('CCDID', default=len(self.datacube)))
+        chip_id = int(header.get('CCDID', len(self.datacube)))
         self.datacube.append((chip_id, data))
 
-        hlist.close()
-
     # ***********
     def prepare_image(self, data):
         """
@@ -129,52 +121,64 @@ class ImageThumb:
 
 
 # ************************************************************
-def getsky(data):
-    """
-    Determine the sky parameters for a FITS data extension.
+# sky estimate parameters
+SKY_SAMPLE_SIZE = 10000 # maximum number of pixels to sample
+SKY_CLIP_SIGMA = 3.0
+SKY_CLIP_PASSES = 5 # maximum number of clipping passes
+MAD_TO_SIGMA = 1.4826 # median absolute deviation to gaussian sigma
 
-    data -- array holding the image data
+
+def sample_step(nx, ny, maxsample=SKY_SAMPLE_SIZE):
     """
+    Stride in both directions that samples at most about maxsample pixels
+    """
+    return max(int(np.ceil(np.sqrt(nx * ny / maxsample))), 1)
 
-    # maximum number of interations for mean,std loop
-    maxiter = 30
 
-    # maximum number of data points to sample
-    maxsample = 10000
+def getsky(data, maxsample=SKY_SAMPLE_SIZE, nsigma=SKY_CLIP_SIGMA, maxpasses=SKY_CLIP_PASSES):
+    """
+    Determine the sky parameters for a FITS data extension.
 
-    # size of the array
-    ny, nx = data.shape
+    data -- array holding the image data
 
-    # how many sampels should we take?
-    if data.size > maxsample:
-        nsample = maxsample
-    else:
-        nsample = data.size
-
-    # create sample indicies
-    xs = np.random.uniform(low=0, high=nx, size=nsample).astype('L')
-    ys = np.random.uniform(low=0, high=ny, size=nsample).astype('L')
-
-    # sample the data
-    sample = data[ys, xs].copy()
-    sample = sample.reshape(nsample)
-
-    # determine the clipped mean and standard deviation
-    mean = sample.mean()
-    std = sample.std()
-    oldsize = 0
-    niter = 0
-    while oldsize != sample.size and niter < maxiter:
-        niter += 1
-        oldsize = sample.size
-        wok = (sample < mean + 3 * std)
-        sample = sample[wok]
-        wok = (sample > mean - 3 * std)
-        sample = sample[wok]
-        mean = sample.mean()
-        std = sample.std()
-
-    return mean, std
+    Samples a regular grid of pixels, so the estimate is the same every
+    time, ignores NaNs and clips around the median using the median
+    absolute deviation for at most maxpasses passes.
+    """
+    ny, nx = data.shape
+    step = sample_step(nx, ny, maxsample)
+    sample = np.asarray(data[::step, ::step], dtype=np.float64).ravel()
+    sample = sample[np.isfinite(sample)]
+    if not sample.size:
+        return 0.0, 1.0
+
+    keep = np.ones(sample.size, dtype=bool)
+    for _ in range(maxpasses):
+        values = sample[keep]
+        sky = np.median(values)
+        sig = MAD_TO_SIGMA * np.median(np.abs(values - sky))
+        if sig <= 0:
+            sig = values.std()
+        if sig <= 0:
+            break
+        clipped = np.abs(sample - sky) < nsigma * sig
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+
+    if not sig > 0:
+        sig = 1.0
+    return float(sky), float(sig)
+
+
+def image_sky(imagepath, maxsample=SKY_SAMPLE_SIZE):
+    """
+    Sky parameters of a whole image, from a strided read of its pixels.
+    Using them for every cutout keeps the stretch the same at any zoom.
+    """
+    header = getheader(imagepath, ext=0)
+    step = sample_step(int(header['NAXIS1']), int(header['NAXIS2']), maxsample)
+    return getsky(getdata(imagepath, skip=step-1, ext=0), maxsample=maxsample)
 
 
 # ************************************************************
@@ -202,6 +206,9 @@ def make_depth_256(data, sky=None, sig=None, depth=256, zerosig=-1, spansig=6):
     zero = sky + zerosig * sig
     span = spansig * sig
 
+    # blank pixels are shown black
+    data[~np.isfinite(data)] = zero
+
     # scale the data to the requested display values
     # greys
     data -= zero
@@ -221,22 +228,8 @@ def make_depth_256(data, sky=None, sig=None, depth=256, zerosig=-1, spansig=6):
 
 
 # ************************************************************
-DATATYPES = {}
-class intdata:
-    type = 'i'
-    nbytes = 2
-    format = 'h'
-DATATYPES[16] = intdata
-class floatdata:
-    type = 'f'
-    nbytes = 4
-    format = 'f'
-DATATYPES[32] = floatdata
-class floatdata64:
-    type = 'f'
-    nbytes = 4
-    format = 'f'
-DATATYPES[64] = floatdata64
+# big-endian numpy dtypes for each FITS BITPIX
+DATATYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
 
 BLOCKSIZE = 2880 # FITS standard
 
@@ -285,7 +278,7 @@ def gethead(filename, fp=None, ext=0):
         else:
             ny = 0
         if 'BITPIX' in header.keys():
-            datasize = abs(int(header['BITPIX']))/8
+            datasize = abs(int(header['BITPIX']))//8
         else:
             datasize = 0
 
@@ -302,132 +295,172 @@ def gethead(filename, fp=None, ext=0):
     return (startpos, header)
 
 
+# ***************************************************************************
+def is_compressed(filename):
+    """
+    True for tile-compressed (fpacked) FITS files
+    """
+    return filename.endswith('.fz')
+
+
+# ***************************************************************************
+def getheader(filename, ext=0):
+    """
+    Read the header of a FITS image as a dictionary of strings. For
+    compressed files ext counts the image extensions after the empty
+    primary HDU, so ext=0 is the compressed image.
+    """
+    if is_compressed(filename):
+        return {key: str(val) for key, val in fits.getheader(filename, ext + 1).items()}
+    return gethead(filename, ext=ext)[1]
+
+
+# ***************************************************************************
+def _clip_region(region, nx, ny):
+    if region is None:
+        return 0, nx-1, 0, ny-1
+    x1, x2, y1, y2 = [int(round(r)) for r in region]
+    return max(x1, 0), min(x2, nx-1), max(y1, 0), min(y2, ny-1)
+
+
 # ***************************************************************************
 def getdata(filename, region=None, skip=0, ext=0):
     """
     Read out a sub section of data from a FITS file
 
-    filename  full path to the FITS file.
+    filename  full path to the FITS file, which may be tile-compressed (.fz)
     region    subsection to extract [x1, x2, y1, y2]
     skip      integer of rows, columns to skip between reads
+
+    Uncompressed data is memory-mapped, so only the pages holding the
+    region are read. Compressed data is read through astropy's section
+    access, which only decompresses the tiles that overlap the region.
+    Returns the scaled (BSCALE/BZERO) pixel values as float64.
     """
+    step = skip + 1
 
-    # get the file pointer
-    f=open(filename, 'rb')#,errors='ignore')
+    if is_compressed(filename):
+        with fits.open(filename, memmap=True) as hlist:
+            hdu = [h for h in hlist if isinstance(h, fits.CompImageHDU)][ext]
+            ny, nx = hdu.shape[-2:]
+            x1, x2, y1, y2 = _clip_region(region, nx, ny)
+            section = hdu.section[y1:y2+1, x1:x2+1][::step, ::step]
+            return np.asarray(section, dtype=np.float64)
 
     # read in the header
-    startpos, header = gethead(filename, fp=f, ext=ext)
+    startpos, header = gethead(filename, ext=ext)
 
     # grab the keywords necessary to parse the data
     nx = int(header['NAXIS1'])
     ny = int(header['NAXIS2'])
-    bitpix = abs(int(header['BITPIX']))
-    if 'BZERO' in header.keys():
-        bzero = float(header['BZERO'])
-    else:
-        bzero = None
-    if 'BSCALE' in header.keys():
-        bscale = float(header['BSCALE'])
-    else:
-        bscale = None
-
-    # set the data type to read
-    datatype = DATATYPES[bitpix]
-
-    # set the region to the full frame if not specified
-    if region == None:
-        region = [0, nx-1, 0, ny-1]
-
-    # initalize the subarray
-    x1, x2, y1, y2 = region
-    if x1 < 0: x1 = 0
-    if y1 < 0: y1 = 0
-    if x2 >= nx: x2 = nx-1
-    if y2 >= ny: y2 = ny-1
-    nx2 = int(round((x2 - x1) / (skip + 1) + 1))
-    ny2 = int(round((y2 - y1) / (skip + 1) + 1))
-    section = np.zeros((ny2, nx2), dtype=datatype.type)   #### fix! ####
-
-    # read in a continuous line and then throw away any skipped columns
-    fmt = "%s%dx" % (datatype.format, skip * datatype.nbytes)
-    fmt = '>' + (fmt * nx2)
-    buffsize = nx2 * (1 + skip) * datatype.nbytes
-    jumpsize = nx * (1 + skip) * datatype.nbytes
-    
-    # read in the sub array
-    f.seek(startpos)
-
-    # jump to the first section column
-    f.seek((nx * y1 + x1) * datatype.nbytes, 1)
-    for j in range(ny2):
-        pos = f.tell()
-
-        # read in the data
-        section[j, :] = unpack(fmt, f.read(buffsize))
+    bitpix = int(header['BITPIX'])
+    bzero = float(header['BZERO']) if 'BZERO' in header else 0.0
+    bscale = float(header['BSCALE']) if 'BSCALE' in header else 1.0
 
-        # jump to the next row
-        f.seek(pos + jumpsize, 0)
-
-    # we're done reading the file
-    f.close()
+    x1, x2, y1, y2 = _clip_region(region, nx, ny)
+    pixels = np.memmap(filename, dtype=DATATYPES[bitpix], mode='r', offset=startpos, shape=(ny, nx))
+    section = pixels[y1:y2+1:step, x1:x2+1:step].astype(np.float64)
+    del pixels
 
     # scale the data as necessary
-    if bscale: section *= bscale
-    if bzero: section += bzero
+    if bscale != 1.0:
+        section *= bscale
+    if bzero != 0.0:
+        section += bzero
 
     return section
 
 
+# ***************************************************************************
+def find_image(filename):
+    """
+    Path to read for filename: the file itself, or its
+    tile-compressed version if only that one exists
+    """
+    if os.path.exists(filename):
+        return filename
+    if os.path.exists(filename + '.fz'):
+        return filename + '.fz'
+    raise FileNotFoundError('No FITS image at {}(.fz)'.format(filename))
+
+
+# ***************************************************************************
+def save_atomic(im, outfile):
+    """
+    Write the thumbnail to a temporary file and rename it into place, so
+    concurrent requests for the same thumbnail never see a partial file
+    """
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(outfile) or '.', suffix='.webp.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, 'WEBP')
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, outfile)
+    except:
+        os.remove(tmpfile)
+        raise
+
+
+# ***************************************************************************
+def thumb_region(x, y, width=250, height=250, grow=1.0):
+    """
+    Cutout [x1, x2, y1, y2] shown in a thumbnail centered on x, y
+    """
+    return [round(x-(width/grow)), round(x+(width/grow)), round(y-(height/grow)), round(y+(height/grow))]
+
+
+# ***************************************************************************
+def render_thumb(filename, outfile, grow=1.0, x=900, y=900, width=250, height=250, ticks=False, spansig=4, skip=0, sky=None, sig=None):
+    """
+    Render one thumbnail of a FITS image to outfile. The sky and sig
+    stretch parameters are estimated from the cutout if not given.
+    """
+    region = thumb_region(x, y, width=width, height=height, grow=grow)
+
+    # read the compressed image in place if there is no fits file
+    imagepath = find_image(filename)
+
+    # load in the image data
+    thumb = ImageThumb(imagepath, skip=skip, grow=grow, verbose=True, region=region)
+    data = thumb.datacube[0][1].copy()
+    data = make_depth_256(data, sky=sky, sig=sig, zerosig=0, spansig=spansig)
+
+    im = thumb.prepare_image(data).convert('RGB')
+
+    ### Do rotations and reflections here
+
+    ### Add crosshair
+    if ticks:
+        x1, x2, y1, y2 = region
+        xoff = -0.5
+        yoff = 1.0
+
+        x_new = int(round((x + xoff - max([0, x1])) * grow))
+        y_new = int(round((min([y2, 4096]) - y + yoff) * grow))
+
+        draw = ImageDraw.Draw(im)
+        draw.line((x_new,y_new+7,x_new,y_new+25), fill='white')
+        draw.line((x_new-7,y_new,x_new-25,y_new), fill='white')
+
+    save_atomic(im, outfile)
+
+
 # ***************************************************************************
 def make_thumb(files, grow=1.0, sky=None, sig=None, x=900, y=900, width=250, height=250, ticks=False, spansig=4, skip=0, fixscale=None):
     """
     Make thumbnails from a FITS image
     """
-    region = [round(x-(width/grow)), round(x+(width/grow)), round(y-(height/grow)), round(y+(height/grow))]
     # make the thumbnails
     outfiles = []
     for filename in files:
-        # See if fits file needs to be funpacked
-        unpacked = False
-        if not os.path.exists(filename):
-            r = os.system('funpack -D '+filename+'.fz')
-            unpacked = True
-
-        # load in the image data
-        thumb = ImageThumb(filename, skip=skip, grow=grow, verbose=True, region=region)
-        data = thumb.datacube[0][1].copy()
-        data = make_depth_256(data, sky=thumb.sky, sig=thumb.sig, zerosig=0, spansig=spansig)
-
-        im = thumb.prepare_image(data).convert('RGB')
-
-        ### Do rotations and reflections here
-
-        ### Add crosshair
-        if ticks:
-            x1, x2, y1, y2 = region
-            xoff = -0.5
-            yoff = 1.0
-
-            x_new = int(round((x + xoff - max([0, x1])) * grow))
-            y_new = int(round((min([y2, 4096]) - y + yoff) * grow))
-            
-            draw = ImageDraw.Draw(im)
-            draw.line((x_new,y_new+7,x_new,y_new+25), fill='white')
-            draw.line((x_new-7,y_new,x_new-25,y_new), fill='white')
-
         # make the thumbs
         if grow == 1.0 and not sig:
             newfile = filename.split('/')[-1].replace('.fits', '.webp')
-            outfile = 'data/thumbs/'+newfile
         else:
             newfile = filename.split('/')[-1].replace('.fits', 'grow{}sig{}.webp'.format(grow, sig))
-            outfile = 'data/thumbs/'+newfile
-        f = open(outfile, 'wb')
-        im.save(f, 'WEBP')
-        f.close()
+        outfile = 'data/thumbs/'+newfile
 
-        if unpacked:
-            r = os.system('fpack -D -Y '+filename)
+        render_thumb(filename, outfile, grow=grow, x=x, y=y, width=width, height=height, ticks=ticks, spansig=spansig, skip=skip)
 
         outfiles.append(newfile)
 
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from custom_code.views import TNSTargets, PaperCreateView, scheduling_view, ReferenceStatusUpdateView, ObservationGroupDetailView, observation_sequence_cancel_view, approve_or_reject_observation_view, AuthorshipInformation, download_photometry_view, get_target_standards_view, SNEx2SpectroscopyTNSSharePassthrough
+from custom_code.views import TNSTargets, PaperCreateView, scheduling_view, ReferenceStatusUpdateView, ObservationGroupDetailView, observation_sequence_cancel_view, approve_or_reject_observation_view, AuthorshipInformation, download_photometry_view, get_target_standards_view, SNEx2SpectroscopyTNSSharePassthrough, instrumentation_view
 
 app_name = 'custom_code'
 
@@ -16,4 +16,5 @@ urlpatterns = [
     path('download-photometry/<int:targetid>/', download_photometry_view, name='download-photometry'),
     path('get-target-standards/', get_target_standards_view, name='get-target-standards'),
     path('tns-share-spectrum/<int:pk>/<int:datum_pk>', SNEx2SpectroscopyTNSSharePassthrough.as_view(), name='tns-share-spectrum'),
+    path('instrumentation/', instrumentation_view, name='instrumentation'),
 ]
@@ -4,7 +4,9 @@ from django.core.files.base import ContentFile
 from django.db import transaction
 from django.db.models import Q, DateTimeField, FloatField, F, ExpressionWrapper
 from django.db.models.functions import Cast
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, FileResponse, Http404, StreamingHttpResponse
+from django.views.decorators.http import etag
+from django.views.static import serve
 from django.views.generic.base import TemplateView, RedirectView
 from django.views.generic.list import ListView
 from django.views.generic.edit import FormView
@@ -15,9 +17,10 @@ from django.template.context import RequestContext
 from django_comments.models import Comment
 from django_comments.signals import comment_was_posted
 from django.dispatch import receiver
+from django.contrib.auth.decorators import user_passes_test
 
 from tom_targets.models import TargetList, Target, TargetExtra, TargetName
-from custom_code.models import TNSTarget, ScienceTags, TargetTags, ReducedDatumExtra, Papers, InterestedPersons, BrokerTarget
+from custom_code.models import TNSTarget, ScienceTags, TargetTags, ReducedDatumExtra, Papers, InterestedPersons, BrokerTarget, SNEx1Mapping
 from custom_code.filters import TNSTargetFilter, CustomTargetFilter, BrokerTargetFilter, BrokerTargetForm
 from tom_targets.templatetags.targets_extras import target_extra_field
 from guardian.mixins import PermissionListMixin
@@ -34,13 +37,19 @@ from astropy import units as u
 from astropy.time import Time
 from datetime import datetime, date, timedelta
 import json
+import numpy as np
 from io import StringIO
 
 import plotly.graph_objs as go
 from tom_dataproducts.models import ReducedDatum, DataProduct
 from custom_code.templatetags.custom_code_tags import airmass_collapse, lightcurve_collapse, spectra_collapse, lightcurve_fits, lightcurve_with_extras, get_best_name, dash_spectra_page, scheduling_list_with_form, smart_name_list
-from custom_code.hooks import _get_tns_params, _return_session, get_unreduced_spectra, get_standards_from_snex1
-from custom_code.thumbnails import make_thumb
+from custom_code.hooks import _get_tns_params, _return_session, get_standards_from_snex1
+from custom_code.instrumentation import get_stats, reset_stats
+from custom_code.floyds_inbox import get_floyds_inbox, FLOYDS_PREVIEW_ROOT
+from custom_code.target_summary import with_target_summary, summarize_targets, update_target_summary
+from custom_code.thumbnail_cache import default_thumbnail_params, get_thumbnail, iter_thumbnails, thumbnail_path, thumbnail_url, touch_thumbnail, THUMBNAIL_BATCH_MAX
+from custom_code.photometry import get_photometry, invalidate_lightcurve
+from custom_code.spectra import read_spectrum
 
 from .forms import CustomTargetCreateForm, CustomDataProductUploadForm, PapersForm, ReferenceStatusForm
 from tom_targets.views import TargetCreateView
@@ -55,7 +64,7 @@ from tom_observations.facility import get_service_class
 from tom_observations.cadence import get_cadence_strategy
 from tom_observations.facilities.lco import LCOSettings
 from tom_observations.views import ObservationCreateView, ObservationListView
-import base64
+import os
 
 import logging
 
@@ -131,6 +140,9 @@ class TargetListView(PermissionListMixin, FilterView):
     permission_required = 'tom_targets.view_target'
     ordering = ['-id']
 
+    def get_queryset(self):
+        return with_target_summary(super().get_queryset())
+
     def get_context_data(self, *args, **kwargs):
         """
         Adds the number of targets visible, the available ``TargetList`` objects if the user is a    uthenticated, and
@@ -140,6 +152,7 @@ class TargetListView(PermissionListMixin, FilterView):
         :rtype: dict
         """
         context = super().get_context_data(*args, **kwargs)
+        context['object_list'] = summarize_targets(context['object_list'])
         context['target_count'] = context['paginator'].count
         # hide target grouping list if user not logged in
         context['groupings'] = (TargetList.objects.all()
@@ -301,6 +314,7 @@ class CustomTargetCreateView(TargetCreateView):
                 db_session = _return_session()
                 run_hook('target_post_save', target=self.object, created=True, group_names=groups, wrapped_session=db_session)
                 db_session.commit()
+                db_session.close()
             else:
                 logger.info('Submitting target failed with errors {}'.format(form.errors))
                 return super().form_invalid(form)
@@ -394,6 +408,9 @@ class CustomDataProductUploadView(DataProductUploadView):
                         assign_perm('tom_dataproducts.view_dataproduct', group, dp)
                         assign_perm('tom_dataproducts.delete_dataproduct', group, dp)
                         assign_perm('tom_dataproducts.view_reduceddatum', group, reduced_data)
+                if dp_type == 'photometry':
+                    invalidate_lightcurve(target.id)
+                update_target_summary(target.id)
                 successful_uploads.append(str(dp))
             except InvalidFileFormatException as iffe:
                 ReducedDatum.objects.filter(data_product=dp).delete()
@@ -442,6 +459,8 @@ def save_dataproduct_groups_view(request):
         for datum in data:
             assign_perm('tom_dataproducts.view_reduceddatum', group, datum)
         successful_groups += i
+    if dp.data_product_type == 'photometry':
+        invalidate_lightcurve(dp.target_id)
     response_data = {'success': successful_groups}
     return HttpResponse(json.dumps(response_data), content_type='application/json')
 
@@ -520,9 +539,8 @@ def save_comments_view(request):
             ### Save comment in SNEx1 as well
             spec = ReducedDatum.objects.get(id=object_id)
             target_id = int(spec.target_id)
-            snex_id_row = ReducedDatumExtra.objects.filter(data_type='spectroscopy', key='snex_id', target_id=target_id, value__icontains='"snex2_id": {}'.format(object_id)).first()
-            if snex_id_row:
-                snex1_id = json.loads(snex_id_row.value)['snex_id']
+            snex1_id = SNEx1Mapping.objects.filter(table='spec', reduced_datum_id=object_id).values_list('snex1_id', flat=True).first()
+            if snex1_id:
                 run_hook('sync_comment_with_snex1', comment, 'spec', user_id, target_id, snex1_id)
         
         return HttpResponse(json.dumps({'success': 'Saved'}))
@@ -1628,26 +1646,63 @@ def make_thumbnail_view(request):
     zoom = float(request.GET['zoom'])
     sigma = float(request.GET['sigma'])
 
-    if filename_dict['psfx'] < 9999 and filename_dict['psfy'] < 9999:
-        f = make_thumb(['data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits'], grow=zoom, spansig=sigma, x=filename_dict['psfx'], y=filename_dict['psfy'], ticks=True)
-    else:
-        f = make_thumb(['data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits'], grow=zoom, spansig=sigma, x=1024, y=1024, ticks=False)
-
-    with open('data/thumbs/'+f[0], 'rb') as imagefile:
-        b64_image = base64.b64encode(imagefile.read())
-        thumb = b64_image.decode('utf-8')
-
-    content_response = {'success': 'Yes',
-                        'thumb': 'data:image/png;base64,{}'.format(thumb),
-                        'telescope': filename_dict['tele'],
-                        'instrument': filename_dict['filename'].split('-')[1][:2],
-                        'filter': filename_dict['filter'],
-                        'exptime': filename_dict['exptime']
-                    }
+    params = default_thumbnail_params(filename_dict['psfx'], filename_dict['psfy'], grow=zoom, spansig=sigma)
+    key = get_thumbnail('data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits', **params)
+
+    content_response = thumbnail_descriptor_response(filename_dict, key)
 
     return HttpResponse(json.dumps(content_response), content_type='application/json')
 
 
+def thumbnail_descriptor_response(filename_dict, key):
+    return {'success': 'Yes' if key else 'No',
+            'thumb': thumbnail_url(key) if key else '',
+            'telescope': filename_dict['tele'],
+            'instrument': filename_dict['filename'].split('-')[1][:2],
+            'filter': filename_dict['filter'],
+            'exptime': filename_dict['exptime']
+        }
+
+
+def make_thumbnails_view(request):
+    """
+    Renders the thumbnails of a list of images and streams them back as
+    NDJSON, one line per image in the order they finish
+    """
+    params = json.loads(request.body)
+    zoom = float(params.get('zoom', 1.0))
+    sigma = float(params.get('sigma', 4.0))
+    images = params.get('images', [])[:THUMBNAIL_BATCH_MAX]
+
+    jobs = [(i, 'data/fits/'+filename_dict['filepath']+filename_dict['filename']+'.fits',
+             default_thumbnail_params(filename_dict['psfx'], filename_dict['psfy'], grow=zoom, spansig=sigma))
+            for i, filename_dict in enumerate(images)]
+
+    def stream():
+        for index, key, error in iter_thumbnails(jobs):
+            content = thumbnail_descriptor_response(images[index], key)
+            content['index'] = index
+            yield json.dumps(content) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+
+@etag(lambda request, key: key)
+def thumbnail_view(request, key):
+    """
+    Serves a cached thumbnail. The key hashes the image and the
+    rendering parameters, so the response never changes.
+    """
+    path = thumbnail_path(key)
+    if not path or not os.path.exists(path):
+        raise Http404('Thumbnail not found')
+
+    touch_thumbnail(path)
+    response = FileResponse(open(path, 'rb'), content_type='image/webp')
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
 class InterestingTargetsView(ListView):
 
     template_name = 'custom_code/interesting_targets.html'
@@ -1657,7 +1712,7 @@ class InterestingTargetsView(ListView):
     def get_queryset(self):
         interesting_targets_list = TargetList.objects.filter(name='Interesting Targets').first()
         if interesting_targets_list:
-            global_interesting_targets = interesting_targets_list.targets.all()
+            global_interesting_targets = with_target_summary(interesting_targets_list.targets.all())
             logger.info('Got list of global interesting targets')
             return global_interesting_targets
         else:
@@ -1665,31 +1720,11 @@ class InterestingTargetsView(ListView):
 
     def get_context_data(self, **kwargs):
         context = super(InterestingTargetsView, self).get_context_data(**kwargs)
-        active_cadences = DynamicCadence.objects.filter(active=True)
-        active_target_ids = [c.observation_group.observation_records.first().target.id for c in active_cadences]
-        for target in context['global_interesting_targets']:
-            target.best_name = get_best_name(target)
-            target.classification = target_extra_field(target, 'classification')
-            target.redshift = target_extra_field(target, 'redshift')
-            target.description = target_extra_field(target, 'target_description')
-            target.science_tags = ', '.join([s.tag for s in ScienceTags.objects.filter(id__in=[t.tag_id for t in TargetTags.objects.filter(target_id=target.id)])])
-            if target.id in active_target_ids:
-                target.active_cadences = 'Yes'
-            else:
-                target.active_cadences = 'No'
+        context['global_interesting_targets'] = summarize_targets(context['global_interesting_targets'])
         logger.info('Finished getting context data for global interesting targets')
 
-        context['personal_interesting_targets'] = [q.target for q in InterestedPersons.objects.filter(user=self.request.user)] 
-        for target in context['personal_interesting_targets']:
-            target.best_name = get_best_name(target)
-            target.classification = target_extra_field(target, 'classification')
-            target.redshift = target_extra_field(target, 'redshift')
-            target.description = target_extra_field(target, 'target_description')
-            target.science_tags = ', '.join([s.tag for s in ScienceTags.objects.filter(id__in=[t.tag_id for t in TargetTags.objects.filter(target_id=target.id)])])
-            if target.id in active_target_ids:
-                target.active_cadences = 'Yes'
-            else:
-                target.active_cadences = 'No'
+        personal_targets = Target.objects.filter(interestedpersons__user=self.request.user).distinct()
+        context['personal_interesting_targets'] = summarize_targets(with_target_summary(personal_targets))
         logger.info('Finished getting context data for personal interesting targets')
         context['interesting_group_id'] = TargetList.objects.get(name='Interesting Targets').id
         return context
@@ -1751,9 +1786,8 @@ class SNEx2SpectroscopyTNSSharePassthrough(RedirectView):
         if not datum.data_product:
             print(f"Reduced datum {datum_id} does not have an associated data product - creating it now")
             target = Target.objects.get(pk=target_id)
-            data_str = ''
-            for datapoint in datum.value.values():
-                data_str += f"{datapoint.get('wavelength')}\t{datapoint.get('flux')}\n"
+            wavelength, flux = read_spectrum(datum.value)
+            data_str = ''.join(f"{w}\t{f}\n" for w, f in zip(wavelength, flux))
             dp_name = f"spectra_{datum_id}_{datum.timestamp.strftime('%Y_%m_%d_%H_%M_%S')}.txt"
             dp = DataProduct.objects.create(target=target, product_id=dp_name, data_product_type='spectroscopy')
             dp.data.save(dp_name, ContentFile(data_str))
@@ -1761,32 +1795,29 @@ class SNEx2SpectroscopyTNSSharePassthrough(RedirectView):
         return reverse('tns:report-tns', kwargs={'pk': target_id, 'datum_pk': datum_id})
 
 
-class FloydsInboxView(TemplateView):
+class FloydsInboxView(ListView):
 
     template_name = 'custom_code/floyds_inbox.html'
+    paginate_by = 50
+
+    def get_queryset(self):
+        return get_floyds_inbox()
 
     def get_context_data(self, **kwargs):
 
         context = super().get_context_data(**kwargs)
 
-        targetids, propids, dateobs, paths, filenames, imgpaths = get_unreduced_spectra()
+        ### Names for the targets on this page only, in one query
+        page_rows = context['page_obj'].object_list
+        targets = Target.objects.filter(id__in=set(row['targetid'] for row in page_rows)).prefetch_related('aliases')
+        names = {t.id: smart_name_list(t) for t in targets}
 
         inbox_rows = []
-        for i in range(len(targetids)):
-            current_dict = {}
-            t = Target.objects.get(id=targetids[i])
-            current_dict['targetid'] = targetids[i]
-            current_dict['targetnames'] = smart_name_list(t)
-            current_dict['propid'] = propids[i]
-            current_dict['dateobs'] = dateobs[i]
-            current_dict['path'] = paths[i]
-            current_dict['filename'] = filenames[i]
-            
-            with open(imgpaths[i], 'rb') as imagefile:
-                b64_image = base64.b64encode(imagefile.read())
-                thumb = b64_image.decode('utf-8')
-            current_dict['img'] = 'data:image/png;base64,{}'.format(thumb) 
-            
+        for row in page_rows:
+            current_dict = dict(row)
+            current_dict['targetnames'] = names.get(row['targetid'], [])
+            if row['img']:
+                current_dict['img'] = reverse('floyds-preview', kwargs={'path': row['img']})
             inbox_rows.append(current_dict)
 
         context['inbox_rows'] = inbox_rows
@@ -1794,6 +1825,35 @@ class FloydsInboxView(TemplateView):
         return context
 
 
+def floyds_preview_view(request, path):
+    """
+    Serves a FLOYDS preview plot, letting the browser revalidate
+    it with If-Modified-Since
+    """
+    response = serve(request, path, document_root=FLOYDS_PREVIEW_ROOT)
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+
+@user_passes_test(lambda user: user.is_staff)
+def instrumentation_view(request):
+    """
+    Staff page with this process's tag, hook and view timings,
+    also available as JSON with ?format=json. A POST resets them.
+    """
+    if request.method == 'POST':
+        reset_stats()
+        return redirect('custom_code:instrumentation')
+
+    stats = get_stats()
+    kind = request.GET.get('kind')
+    if kind:
+        stats['entries'] = [e for e in stats['entries'] if e['kind'] == kind]
+    if request.GET.get('format') == 'json':
+        return JsonResponse(stats)
+    return render(request, 'custom_code/instrumentation.html', {'stats': stats, 'kind': kind})
+
+
 class AuthorshipInformation(TemplateView):
 
     template_name = 'custom_code/authorship.html'
@@ -1808,24 +1868,16 @@ def download_photometry_view(request, targetid):
     user = request.user
     target = Target.objects.get(id=int(targetid))
 
-    if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(target=target, data_type=settings.DATA_PRODUCT_TYPES['photometry'][0])
-
-    else:
-        datums = get_objects_for_user(user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(
-                                        target=target,
-                                        data_type=settings.DATA_PRODUCT_TYPES['photometry'][0]))
+    photometry = get_photometry(target, user)
+    photometry = photometry.select(photometry.has_filter & ~np.isnan(photometry.magnitude) & ~np.isnan(photometry.error))
+    mjds = np.round(photometry.mjd, 2)
 
-    datums = datums.order_by('timestamp')
     newfile = StringIO()
 
     newfile.write('mjd mag err filter subtracted?\n')
 
-    for d in datums:
-        if all(k in d.value.keys() for k in ['magnitude', 'error', 'filter']):
-            newfile.write('{} {} {} {} {}\n'.format(round(Time(d.timestamp).mjd, 2), d.value['magnitude'], d.value['error'], d.value['filter'], d.value.get('background_subtracted', False)))
+    for i in range(len(photometry)):
+        newfile.write('{} {} {} {} {}\n'.format(mjds[i], photometry.magnitude[i], photometry.error[i], photometry.filter[i], photometry.background_subtracted[i]))
 
     response = HttpResponse(newfile.getvalue(), content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename={}.txt'.format(target.name.replace(' ',''))
@@ -0,0 +1,115 @@
+"""
+Vectorized visibility calculations for the airmass and observing plan plots.
+
+All sites are evaluated on one shared time grid in a single pass: the
+sidereal time and sun positions come from the shared ephemeris table and
+are broadcast against the site longitudes, so the target and sun altitudes
+come out as (site, time) arrays without building an astroplan Observer for
+each site.
+"""
+import datetime
+from functools import lru_cache
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from tom_observations import facility
+
+from custom_code.ephemeris import get_ephemeris, altitude
+
+
+@lru_cache(maxsize=None)
+def _get_sites(facility_names):
+    """
+    Returns (labels, site names, latitudes, longitudes) for the observing
+    sites of the given facilities. The site lists are static, so they are
+    only collected once per process.
+    """
+    labels = []
+    names = []
+    lats = []
+    lons = []
+    for observing_facility in facility.get_service_classes():
+        if facility_names and observing_facility not in facility_names:
+            continue
+
+        observing_facility_class = facility.get_service_class(observing_facility)
+        sites = observing_facility_class().get_observing_sites()
+
+        for site, site_details in sites.items():
+            labels.append('({facility}) {site}'.format(facility=observing_facility, site=site))
+            names.append(site)
+            lats.append(site_details.get('latitude'))
+            lons.append(site_details.get('longitude'))
+
+    return tuple(labels), tuple(names), np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+
+
+def get_sites(facilities=None):
+    """
+    Returns the observing sites for the given facility names,
+    or for every configured facility if facilities is None
+    """
+    if facilities is not None:
+        facilities = tuple(facilities)
+    return _get_sites(facilities)
+
+
+def compute_visibility(ra, dec, ephemeris, lats, lons):
+    """
+    Computes airmass, sun altitude and absolute hour angle for a target
+    at every site and every time of the ephemeris grid in one vectorized pass.
+
+    ra and dec are in degrees (J2000), lats and lons are arrays of site
+    coordinates in degrees. The sun altitudes come from the shared
+    ephemeris table. Returns a dict of (site, time) arrays.
+    """
+    obj_ra, obj_dec = ephemeris.to_date(SkyCoord(ra, dec, unit='deg'))
+    lst = ephemeris.lst(lons)
+
+    obj_alt = altitude(obj_ra, obj_dec, lst, lats)
+
+    with np.errstate(divide='ignore'):
+        airmass = 1.0 / np.sin(np.radians(obj_alt))
+
+    ha = np.mod(lst - obj_ra, 360.0) / 15.0
+    ha = np.where(ha > 12, 24 - ha, ha)
+
+    return {'airmass': airmass,
+            'sun_alt': ephemeris.sun_alt(lats, lons),
+            'hour_angle': ha}
+
+
+def visibility_mask(visibility, airmass_limit, sun_alt_limit=-12.0, halimit=None):
+    """
+    Boolean (site, time) mask of the samples that should not be plotted
+    """
+    airmass = visibility['airmass']
+    bad = (airmass >= airmass_limit) | (airmass <= 1) | (visibility['sun_alt'] > sun_alt_limit)
+    if halimit is not None:
+        bad |= visibility['hour_angle'] > halimit
+    return bad
+
+
+def get_airmass_series(target, start, end, interval, airmass_limit, sun_alt_limit=-12.0, halimit=None, facilities=('LCO',)):
+    """
+    Returns the plot times, the site labels and names, and a (site, time)
+    array of airmasses with the unobservable samples set to NaN
+    """
+    ephemeris = get_ephemeris(start, end, interval)
+    labels, names, lats, lons = get_sites(facilities)
+
+    visibility = compute_visibility(target.ra, target.dec, ephemeris, lats, lons)
+    bad = visibility_mask(visibility, airmass_limit, sun_alt_limit=sun_alt_limit, halimit=halimit)
+    airmass = np.where(bad, np.nan, visibility['airmass'])
+
+    return ephemeris.datetimes, labels, names, airmass
+
+
+def get_24hr_airmass_series(target, interval, airmass_limit, sun_alt_limit=-12.0, halimit=None, facilities=('LCO',)):
+    """
+    Airmass series for the next 24 hours, starting now
+    """
+    start = datetime.datetime.utcnow()
+    end = start + datetime.timedelta(days=1)
+    return get_airmass_series(target, start, end, interval, airmass_limit,
+                              sun_alt_limit=sun_alt_limit, halimit=halimit, facilities=facilities)
@@ -1,3 +1,13 @@
 from django.contrib import admin
 
+from gw.models import GWAlertJob
+
 # Register your models here.
+
+
+@admin.register(GWAlertJob)
+class GWAlertJobAdmin(admin.ModelAdmin):
+    list_display = ['superevent_id', 'alert_type', 'sequence', 'status', 'priority', 'received', 'finished', 'latency', 'attempts', 'not_before']
+    list_filter = ['status', 'alert_type']
+    search_fields = ['superevent_id']
+    exclude = ['payload']
@@ -0,0 +1,300 @@
+"""
+Queue of GW alerts, processed outside the alert stream consumer.
+
+The enqueue_* functions are the topic handlers in ALERT_STREAMS. They only
+record the alert as a GWAlertJob and return, so a slow sky map download or
+galaxy ranking never holds up the other topics the stream consumes. Jobs are
+unique per superevent, sequence and alert type, so redelivered alerts are
+dropped. Retractions are processed first and supersede the pending alerts of
+their event.
+
+With GW_ALERT_QUEUE_BACKEND = 'thread' (the default) a worker thread in the
+alert stream process runs the jobs. It is started when the stream starts
+listening, so jobs left over by the previous stream process are picked up
+straight away. With 'database' they are left for the process_gw_alerts
+command; with 'sync' they run straight away, as before. A failed job is
+retried after GW_ALERT_RETRY_DELAY, doubling each time, up to
+GW_ALERT_MAX_ATTEMPTS. Each job records when the alert was published, received, started and
+finished, and the latencies are logged as structured tags.
+"""
+import logging
+import pickle
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler import extract_all_fields
+
+from gw.models import GWAlertJob
+
+logger = logging.getLogger(__name__)
+
+GW_ALERT_QUEUE_BACKEND = getattr(settings, 'GW_ALERT_QUEUE_BACKEND', 'thread')
+GW_ALERT_POLL_INTERVAL = getattr(settings, 'GW_ALERT_POLL_INTERVAL', 5) # seconds
+GW_ALERT_JOB_TIMEOUT = getattr(settings, 'GW_ALERT_JOB_TIMEOUT', 3600) # seconds before a running job is retried
+GW_ALERT_MAX_ATTEMPTS = getattr(settings, 'GW_ALERT_MAX_ATTEMPTS', 3)
+GW_ALERT_RETRY_DELAY = getattr(settings, 'GW_ALERT_RETRY_DELAY', 60) # seconds before the first retry of a failed job
+
+RETRACTION_PRIORITY = 0
+DEFAULT_PRIORITY = 10
+
+IGWN_HANDLER = 'gw.gw_event_handler.handle_igwn_message_with_galaxies'
+GCN_HANDLER = 'gw.gw_event_handler.handle_message'
+GCN_RETRACTION_HANDLER = 'gw.gw_event_handler.handle_retraction_with_galaxies'
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_worker = None
+
+### The stream handlers are imported before the streams are started in their
+### own processes, so this is when the stream command started
+_booted = timezone.now()
+
+
+def _timestamp(ms):
+    if not ms:
+        return None
+    return datetime.fromtimestamp(ms / 1000.0, tz=dt_timezone.utc)
+
+
+def enqueue(handler, superevent_id, sequence, alert_type, args, alert_time=None):
+    """
+    Records an alert to be processed by handler(*args), unless the same
+    alert is already queued, and hands it to the worker
+    """
+    priority = RETRACTION_PRIORITY if alert_type == 'RETRACTION' else DEFAULT_PRIORITY
+    try:
+        with transaction.atomic():
+            job, created = GWAlertJob.objects.get_or_create(
+                superevent_id=superevent_id, sequence=str(sequence), alert_type=alert_type,
+                defaults={'handler': handler, 'priority': priority, 'payload': pickle.dumps(args),
+                          'alert_time': alert_time, 'received': timezone.now()}
+            )
+    except IntegrityError:
+        created = False
+    if not created:
+        logger.info('Already queued {} alert {} for {}'.format(alert_type, sequence, superevent_id))
+        return
+
+    if alert_type == 'RETRACTION':
+        superseded = GWAlertJob.objects.filter(
+            superevent_id=superevent_id, status=GWAlertJob.PENDING
+        ).exclude(alert_type='RETRACTION').update(status=GWAlertJob.SUPERSEDED, finished=timezone.now())
+        if superseded:
+            logger.info('Retraction of {} superseded {} queued alerts'.format(superevent_id, superseded))
+
+    logger.info('Queued {} alert {} for {}'.format(alert_type, sequence, superevent_id))
+    if GW_ALERT_QUEUE_BACKEND == 'sync':
+        run_pending_jobs()
+    elif GW_ALERT_QUEUE_BACKEND == 'thread':
+        start_worker_thread()
+
+
+def enqueue_igwn_message(message, metadata):
+    """
+    Topic handler for igwn.gwalert
+    """
+    alert = message.content[0]
+    superevent_id = alert.get('superevent_id', '')
+    if superevent_id.startswith('M') and not settings.SAVE_TEST_ALERTS:
+        return
+
+    ### The Kafka metadata can't be pickled, so keep a copy of its fields
+    metadata_copy = SimpleNamespace(**{key: getattr(metadata, key, None)
+                                       for key in ['topic', 'partition', 'offset', 'timestamp', 'key', 'headers']})
+    enqueue(IGWN_HANDLER, superevent_id, alert.get('time_created', ''), alert.get('alert_type', ''),
+            (message, metadata_copy), alert_time=_timestamp(getattr(metadata, 'timestamp', None)))
+
+
+def _gcn_fields(message):
+    if isinstance(message, bytes):
+        return message, extract_all_fields(message.decode('utf-8')), None
+    bytes_message = message.value()
+    alert_time = _timestamp(message.timestamp()[1])
+    return bytes_message, extract_all_fields(bytes_message.decode('utf-8')), alert_time
+
+
+def enqueue_gcn_message(message):
+    """
+    Topic handler for the GCN classic LVC notices
+    """
+    bytes_message, fields, alert_time = _gcn_fields(message)
+    if fields:
+        enqueue(GCN_HANDLER, fields['TRIGGER_NUM'], fields['SEQUENCE_NUM'], fields.get('NOTICE_TYPE', ''),
+                (bytes_message,), alert_time=alert_time)
+
+
+def enqueue_gcn_retraction(message):
+    """
+    Topic handler for the GCN classic LVC retractions
+    """
+    bytes_message, fields, alert_time = _gcn_fields(message)
+    if fields:
+        enqueue(GCN_RETRACTION_HANDLER, fields['TRIGGER_NUM'], fields.get('SEQUENCE_NUM', ''), 'RETRACTION',
+                (bytes_message,), alert_time=alert_time)
+
+
+def claim_next_job():
+    """
+    Marks the most urgent pending job as running and returns it,
+    or returns None if there are none
+    """
+    while True:
+        job = GWAlertJob.objects.filter(
+            Q(not_before__isnull=True) | Q(not_before__lte=timezone.now()), status=GWAlertJob.PENDING
+        ).order_by('priority', 'received', 'id').first()
+        if job is None:
+            return None
+
+        ### Only one worker gets to change the status
+        started = timezone.now()
+        claimed = GWAlertJob.objects.filter(id=job.id, status=GWAlertJob.PENDING).update(
+            status=GWAlertJob.RUNNING, started=started, attempts=job.attempts + 1
+        )
+        if claimed:
+            job.status = GWAlertJob.RUNNING
+            job.started = started
+            job.attempts += 1
+            return job
+
+
+def _log_metrics(job):
+    tags = {
+        'gw_alert_job': job.id,
+        'superevent_id': job.superevent_id,
+        'alert_type': job.alert_type,
+        'status': job.status,
+        'attempts': job.attempts,
+        'queue_wait_s': round((job.started - job.received).total_seconds(), 3),
+        'processing_s': round((job.finished - job.started).total_seconds(), 3),
+        'latency_s': round(job.latency, 3),
+    }
+    if job.alert_time:
+        tags['stream_delay_s'] = round((job.received - job.alert_time).total_seconds(), 3)
+    logger.info('Processed {} alert for {} in {:.1f} s after receipt'.format(job.alert_type, job.superevent_id, job.latency),
+                extra={'tags': tags})
+
+
+def run_job(job):
+    """
+    Runs the handler of a claimed job and records the outcome
+    """
+    try:
+        handler = import_string(job.handler)
+        handler(*pickle.loads(job.payload))
+    except Exception:
+        job.error = traceback.format_exc()
+        logger.error('GW alert job {} failed (attempt {}): {}'.format(job, job.attempts, job.error))
+        if job.attempts < GW_ALERT_MAX_ATTEMPTS:
+            job.status = GWAlertJob.PENDING
+            job.not_before = timezone.now() + timedelta(seconds=GW_ALERT_RETRY_DELAY * 2**(job.attempts - 1))
+        else:
+            job.status = GWAlertJob.FAILED
+    else:
+        job.error = ''
+        job.status = GWAlertJob.DONE
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished', 'not_before'])
+    if job.status != GWAlertJob.PENDING:
+        _log_metrics(job)
+
+
+def run_pending_jobs(max_jobs=None):
+    """
+    Runs pending jobs, most urgent first, until there are none left
+    or max_jobs have run. Returns the number run.
+    """
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def requeue_stale_jobs(started_before=None):
+    """
+    Puts back jobs left running since before started_before, by default
+    for longer than GW_ALERT_JOB_TIMEOUT, e.g. by a worker that was restarted
+    """
+    if started_before is None:
+        started_before = timezone.now() - timedelta(seconds=GW_ALERT_JOB_TIMEOUT)
+    stale = GWAlertJob.objects.filter(
+        status=GWAlertJob.RUNNING, started__lt=started_before
+    ).update(status=GWAlertJob.PENDING)
+    if stale:
+        logger.warning('Requeued {} stale GW alert jobs'.format(stale))
+    return stale
+
+
+def _worker_loop():
+    try:
+        ### Only the stream processes run jobs with this backend, so anything
+        ### still running from before the stream command started was left
+        ### behind by the previous one
+        requeue_stale_jobs(started_before=_booted)
+    except Exception as e:
+        logger.error('GW alert worker: {}'.format(e))
+    while True:
+        _wakeup.wait(GW_ALERT_POLL_INTERVAL)
+        _wakeup.clear()
+        try:
+            run_pending_jobs()
+        except Exception as e:
+            logger.error('GW alert worker: {}'.format(e))
+        finally:
+            close_old_connections()
+
+
+def start_worker_thread():
+    """
+    Starts this process's worker thread if it isn't running, and wakes it up
+    """
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name='gw-alert-worker', daemon=True)
+            _worker.start()
+    _wakeup.set()
+
+
+def start_stream_worker(handlers):
+    """
+    Starts the worker thread when an alert stream whose topic handlers
+    include the enqueue_* functions starts listening
+    """
+    if GW_ALERT_QUEUE_BACKEND == 'thread' and any(handler.startswith(__name__ + '.') for handler in handlers):
+        logger.info('Starting the GW alert worker thread')
+        start_worker_thread()
+
+
+def latency_summary(since=None):
+    """
+    Counts of jobs by status, and the median, 90th percentile and
+    maximum latency in seconds of the jobs finished since since
+    """
+    jobs = GWAlertJob.objects.all()
+    if since is not None:
+        jobs = jobs.filter(received__gte=since)
+
+    summary = {status: 0 for status, _ in GWAlertJob.STATUS_CHOICES}
+    latencies = []
+    for status, received, finished in jobs.values_list('status', 'received', 'finished'):
+        summary[status] += 1
+        if status == GWAlertJob.DONE and finished:
+            latencies.append((finished - received).total_seconds())
+
+    if latencies:
+        summary['median_latency_s'] = round(float(np.median(latencies)), 3)
+        summary['p90_latency_s'] = round(float(np.percentile(latencies, 90)), 3)
+        summary['max_latency_s'] = round(max(latencies), 3)
+    return summary
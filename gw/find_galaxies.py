@@ -9,22 +9,237 @@ from scipy.stats import norm
 #from scipy.special import gammaincinv
 #from scipy.special import gammaincc
 from ligo.skymap import distance
+from ligo.skymap.moc import uniq2nest, uniq2pixarea
 
+from gw.galaxy_catalog import load_galaxy_catalog, MOC_MAX_ORDER
 from gw.models import GWFollowupGalaxy
+from tom_targets.models import TargetExtra
 import os
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 import logging
 
 logger = logging.getLogger(__name__)
 BASE_DIR = settings.BASE_DIR
 
 
+def credible_region_cutoffs(prob, credzone, fallback_credzone=0.99995, area=None):
+    """
+    Probability of the least probable pixel in the smallest set of pixels
+    that holds credzone of the total probability, and the same for
+    fallback_credzone (used if no galaxies are found in the first).
+
+    For multi-order maps prob is the probability density of each tile and
+    area their areas, and the cutoffs are probability densities.
+    """
+    if area is None:
+        sortedprob = np.sort(prob, kind="mergesort")[::-1]
+        cumprob = np.cumsum(sortedprob)
+    else:
+        order = np.argsort(prob, kind="mergesort")[::-1]
+        sortedprob = prob[order]
+        cumprob = np.cumsum(sortedprob * area[order])
+    last = len(sortedprob) - 1
+
+    ### First pixel at which the running sum reaches each level
+    i = min(np.searchsorted(cumprob, credzone), last)
+    j = max(i, min(np.searchsorted(cumprob, fallback_credzone), last))
+    return sortedprob[i], sortedprob[j]
+
+
+def find_tiles(uniq, nest):
+    """
+    Index of the multi-order tile containing each of the NESTED pixels
+    nest at MOC_MAX_ORDER, or -1 for pixels the map doesn't cover
+    """
+    order, ipix = uniq2nest(np.asarray(uniq, dtype=np.int64))
+    shift = 2 * (MOC_MAX_ORDER - np.asarray(order, dtype=np.int64))
+    ipix = np.asarray(ipix, dtype=np.int64)
+
+    ### Each tile covers a range of pixels at the finest order,
+    ### so sorting the tiles by their first pixel makes this a binary search
+    first = ipix << shift
+    end = (ipix + 1) << shift
+    sort = np.argsort(first, kind="mergesort")
+    i = np.searchsorted(first[sort], nest, side='right') - 1
+    tile = sort[np.clip(i, 0, None)]
+    return np.where((i >= 0) & (nest < end[tile]), tile, -1)
+
+
+def rank_galaxies(p, distmu, distsigma, distnorm, d, mass, probcutoffs, nsigmas_in_d=3, sensitivity=22,
+                  minL=1e40, maxL=1e41, mindistFactor=0.01):
+    """
+    Ranks galaxies by their localization probability, distance probability,
+    stellar mass and chance of detection.
+
+    p, distmu, distsigma and distnorm are the map values at each galaxy, and d
+    and mass their distances and stellar masses. probcutoffs are the credible
+    region cutoffs from credible_region_cutoffs. Returns a dictionary with the
+    indices of the selected galaxies, most likely first, their scores and the
+    number of them that make up 50% of the probability, or None if no galaxies
+    are in the credible region.
+    """
+    probcutoff, fallbackcutoff = probcutoffs
+    p = np.asarray(p)
+    distmu = np.asarray(distmu)
+    distsigma = np.asarray(distsigma)
+    d = np.asarray(d)
+    offset = np.abs(d - distmu)
+
+    # Cuttoffs: credzone of probability by angles and nsigmas by distance:
+    selected = np.flatnonzero((p >= probcutoff) & (offset < nsigmas_in_d * distsigma))
+
+    # Increase credzone to 99.995% if no galaxies found:
+    # If no galaxies found in the credzone and within the right distance range
+    if len(selected) == 0:
+        selected = np.flatnonzero((p >= fallbackcutoff) & (offset < 5 * distsigma))
+    if len(selected) == 0:
+        return None
+
+    distp = norm(distmu[selected], distsigma[selected]).pdf(d[selected]) * np.asarray(distnorm)[selected]
+    p = p[selected] * distp  ##d**2?
+
+    ### Normalize by mass:
+    mass = np.asarray(mass)[selected]
+    massNorm = mass / np.sum(mass)
+    normalization = np.sum(p * massNorm)
+
+    # Accounting for distance
+    absolute_sensitivity = sensitivity - 5 * np.log10(d[selected] * (10 ** 5))
+
+    absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity)) # Check this?
+    distanceFactor = np.zeros(len(p))
+
+    distanceFactor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
+    distanceFactor[mindistFactor>(maxL - absolute_sensitivity_lum) / (maxL - minL)] = mindistFactor
+    distanceFactor[absolute_sensitivity_lum<minL] = 1
+    distanceFactor[absolute_sensitivity>maxL] = mindistFactor
+
+    # Sorting glaxies by probability
+    ii = np.argsort(p*massNorm*distanceFactor,kind="mergesort")[::-1]
+
+    ####counting galaxies that constitute 50% of the probability(~0.5*0.98)
+    cumprob = np.cumsum((p*massNorm)[ii]/float(normalization))
+    cumseen = np.cumsum((p*massNorm*distanceFactor)[ii]/float(normalization))
+    galaxies50per = int(np.searchsorted(cumprob, 0.5)) + 1
+    enough = galaxies50per <= len(ii)
+    galaxies50per = min(galaxies50per, len(ii))
+
+    return {'indices': selected[ii],
+            'scores': (p * massNorm / normalization)[ii],
+            'galaxies50per': galaxies50per,
+            'sum_seen': cumseen[galaxies50per-1],
+            'enough': enough}
+
+
+def _newer_than(eventlocalization):
+    """
+    Q for the galaxies of localizations issued after eventlocalization,
+    ordered by date and then id
+    """
+    later_id = Q(eventlocalization_id__gt=eventlocalization.id)
+    if eventlocalization.date is None:
+        return later_id
+    return Q(eventlocalization__date__gt=eventlocalization.date) | (Q(eventlocalization__date=eventlocalization.date) & later_id)
+
+
+def save_galaxy_list(eventlocalization, galaxies, scores, catalog='NEDLVSCatalog', ntop=10):
+    """
+    Saves the ranked galaxies for eventlocalization in one transaction.
+
+    If this localization or an earlier one of the same event already has a
+    ranked list, its rows are moved to this localization and rescored in
+    place, so their ids (and the targets linked to them) stay the same.
+    If a newer localization of the event already has the list, nothing is
+    saved.
+    Galaxies that drop out of the list are deleted, unless a target was
+    created for them, in which case they are kept with a score of 0 so
+    their observations can still be found and canceled.
+
+    Returns a summary of how the list changed.
+    """
+    names = [str(name) for name in galaxies['objname']]
+
+    with transaction.atomic():
+        previous = GWFollowupGalaxy.objects.filter(eventlocalization=eventlocalization)
+        if not previous.exists():
+            event_galaxies = GWFollowupGalaxy.objects.filter(
+                eventlocalization__nonlocalizedevent_id=eventlocalization.nonlocalizedevent_id
+            )
+            ### A newer localization already has the list, e.g. when this one
+            ### was retried or redelivered after it, so leave it there
+            newer = event_galaxies.filter(_newer_than(eventlocalization)).values_list('eventlocalization_id', flat=True).first()
+            if newer is not None:
+                logger.info('Not ranking galaxies for EventLocalization {}, the list belongs to newer localization {}'.format(
+                    eventlocalization, newer))
+                return {'galaxies': 0, 'skipped': True, 'newer_localization': newer}
+
+            ### Start from the most recent earlier localization of the event that has a list
+            previous_localization = event_galaxies.exclude(_newer_than(eventlocalization)).order_by(
+                '-eventlocalization__date', '-eventlocalization_id'
+            ).values_list('eventlocalization_id', flat=True).first()
+            previous = GWFollowupGalaxy.objects.filter(eventlocalization_id=previous_localization)
+        previous = list(previous.select_for_update().order_by('-score', 'id'))
+
+        previous_rank = {}
+        existing = {}
+        for rank, galaxy in enumerate(previous):
+            key = (galaxy.catalog, galaxy.catalog_objname)
+            if key not in existing:
+                existing[key] = galaxy
+                previous_rank[galaxy.catalog_objname] = rank
+
+        new_rows = []
+        rescored = []
+        for i, name in enumerate(names):
+            galaxy = existing.pop((catalog, name), None)
+            if galaxy is None:
+                new_rows.append(GWFollowupGalaxy(catalog=catalog,
+                                                 catalog_objname=name,
+                                                 ra=float(galaxies['ra'][i]),
+                                                 dec=float(galaxies['dec'][i]),
+                                                 dist=float(galaxies['DistMpc'][i]),
+                                                 score=float(scores[i]),
+                                                 eventlocalization=eventlocalization))
+            else:
+                galaxy.score = float(scores[i])
+                galaxy.eventlocalization = eventlocalization
+                rescored.append(galaxy)
+
+        ### Galaxies that are no longer in the list
+        matched = set(g.id for g in rescored)
+        dropped = [g for g in previous if g.id not in matched]
+        followed_up = set(TargetExtra.objects.filter(
+            key='gwfollowupgalaxy_id', value__in=[str(g.id) for g in dropped]
+        ).values_list('value', flat=True))
+        kept = [g for g in dropped if str(g.id) in followed_up]
+        removed = [g.id for g in dropped if str(g.id) not in followed_up]
+        for galaxy in kept:
+            galaxy.score = 0.0
+            galaxy.eventlocalization = eventlocalization
+
+        GWFollowupGalaxy.objects.bulk_update(rescored + kept, ['score', 'eventlocalization'], batch_size=1000)
+        GWFollowupGalaxy.objects.bulk_create(new_rows, batch_size=1000)
+        GWFollowupGalaxy.objects.filter(id__in=removed).delete()
+
+    return {'galaxies': len(names),
+            'added': len(new_rows),
+            'rescored': len(rescored),
+            'removed': len(removed),
+            'kept_for_followup': len(kept),
+            'top': [{'name': name, 'rank': rank, 'previous_rank': previous_rank.get(name)}
+                    for rank, name in enumerate(names[:ntop])]}
+
+
 def generate_galaxy_list(eventlocalization, completeness=None, credzone=None, skymap_filepath=None):
     """
     An adaptation of the galaxy ranking algorithm described in
     Arcavi et al. 2017 (doi:10.3847/2041-8213/aa910f)
     
     eventlocalization: an EventLocalization object
+    skymap_filepath: a multi-order sky map to use instead of the one at the
+        localization's skymap_moc_file_url
     """
 
     # Parameters:
@@ -32,6 +247,7 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None, sk
     config.read(os.path.join(BASE_DIR, 'gw/gw_config.ini'))
     
     catalog_path = config.get('GALAXIES', 'CATALOG_PATH') # Path to numpy file containing the galaxy catalog (faster than getting from the db)
+    preprocessed_path = config.get('GALAXIES', 'PREPROCESSED_CATALOG_PATH', fallback=None) # Directory for the memory-mapped copy of the catalog
     
     # Matching parameters:
     if not credzone:
@@ -52,183 +268,70 @@ def generate_galaxy_list(eventlocalization, completeness=None, credzone=None, sk
     #alpha = float(config.get('GALAXIES', 'ALPHA'))
     #MB_star = float(config.get('GALAXIES', 'MB_STAR'))
     
+    ### Work on the multi-order map directly, rather than the
+    ### flattened one, which can be hundreds of MB at high resolution
     try:
+        skymap = Table.read(skymap_filepath or eventlocalization.skymap_moc_file_url or eventlocalization.skymap_url)
+        uniq = np.asarray(skymap['UNIQ'], dtype=np.int64)
+        probdensity = np.asarray(skymap['PROBDENSITY'], dtype=np.float64)
         if not eventlocalization.distance_mean:
             ### This is a burst alert, so just read the probabilities from the map
             ### and fix the distance to only look at nearby galaxies
-            if skymap_filepath is not None:
-                prob = hp.read_map(skymap_filepath, field=0, verbose=False)
-            else:
-                prob = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=0, verbose=False)
-            ### Fix distance vectors:
-            distmu = np.ones(len(prob)) * 10.0 # Fix to 10 Mpc
-            distsigma = np.ones(len(prob)) * 10.0 # Fix to 10 Mpc
-            distnorm = np.ones(len(prob)) # Flat prior?
+            distmu = np.ones(len(uniq)) * 10.0 # Fix to 10 Mpc
+            distsigma = np.ones(len(uniq)) * 10.0 # Fix to 10 Mpc
+            distnorm = np.ones(len(uniq)) # Flat prior?
         else:
-            if skymap_filepath is not None:
-                prob, distmu, distsigma, distnorm = hp.read_map(skymap_filepath, field=[0,1,2,3], verbose=False)
-            else:
-                prob, distmu, distsigma, distnorm = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=[0,1,2,3], verbose=False)
+            distmu = np.asarray(skymap['DISTMU'], dtype=np.float64)
+            distsigma = np.asarray(skymap['DISTSIGMA'], dtype=np.float64)
+            distnorm = np.asarray(skymap['DISTNORM'], dtype=np.float64)
+        area = np.asarray(uniq2pixarea(uniq), dtype=np.float64)
 
     except Exception as e:
         logger.warning('Failed to read sky map for {}'.format(eventlocalization))
         logger.warning(e)
         return
 
-    # Get the map parameters:
-    npix = len(prob)
-    nside = hp.npix2nside(npix)
-
     # Load the galaxy catalog.
+    ### The preprocessed copy already has the cuts on DistMpc and Mstar
+    ### applied and the map pixels of the galaxies precomputed, see gw/galaxy_catalog.py
     logger.info('Loading Galaxy Catalog')
-    galaxies = Table.read(catalog_path)
-    
-    ### If using luminosity, remove galaxies with no Lum_X, like so:q
-    #galaxies = galaxies[~np.isnan(galaxies['Lum_W1'])]
-    ### If using mass, make cuts on DistMpc and Mstar
-    galaxies = galaxies[~np.isnan(galaxies['Mstar'])]
-    galaxies = galaxies[np.where(galaxies['DistMpc']>0)] # Remove galaxies with distance < 0
-
-    theta = 0.5 * np.pi - np.pi*(galaxies['dec'])/180
-    phi = np.deg2rad(galaxies['ra'])
-    d = np.array(galaxies['DistMpc'])
-    # Convert galaxy coordinates to map pixels:
-    logger.info('Converting Galaxy Coordinates to Map Pixels')
-    ipix = hp.ang2pix(nside, theta, phi)
-
-    maxprobcoord_tup = hp.pix2ang(nside, np.argmax(prob))
+    catalog = load_galaxy_catalog(catalog_path, preprocessed_path)
+
+    # Find the tile of the map each galaxy is in:
+    logger.info('Converting Galaxy Coordinates to Map Tiles')
+    tile = find_tiles(uniq, catalog.nested_ipix())
+    inmap = np.flatnonzero(tile >= 0)
+    tile = tile[inmap]
+
+    peak_order, peak_ipix = uniq2nest(uniq[np.argmax(probdensity)])
+    maxprobcoord_tup = hp.pix2ang(2**int(peak_order), int(peak_ipix), nest=True)
     maxprobcoord = [0, 0]
     maxprobcoord[0] = np.rad2deg(0.5*np.pi-maxprobcoord_tup[0])
     maxprobcoord[1] = np.rad2deg(maxprobcoord_tup[1])
     
-    #Find the zone with probability <= credzone:
+    # Find the zones with probability <= credzone and <= 99.995%:
     logger.info('Finding zone with credible probability')
-    probcutoff = 1
-    probsum = 0
-
-    sortedprob = np.sort(prob,kind="mergesort")
-    while probsum < credzone:
-        probsum = probsum + sortedprob[-1]
-        probcutoff = sortedprob[-1]
-        sortedprob = sortedprob[:-1]
+    probcutoffs = credible_region_cutoffs(probdensity, credzone, area=area)
 
     # Calculate the probability for galaxies according to the localization map:
     logger.info('Calculating galaxy probabilities')
-    p = prob[ipix]
-    distp = (norm(distmu[ipix], distsigma[ipix]).pdf(d) * distnorm[ipix])
-
-    # Cuttoffs: credzone of probability by angles and nsigmas by distance:
-    inddistance = np.where(np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix])
-    indcredzone = np.where(p>=probcutoff)
-
-    doMassCuttoff = True
-
-    # Increase credzone to 99.995% if no galaxies found:
-    # If no galaxies found in the credzone and within the right distance range
-    if len(galaxies[np.intersect1d(indcredzone,inddistance)]) == 0:
-        while probsum < 0.99995:
-            if sortedprob.size == 0:
-                break
-            probsum = probsum + sortedprob[-1]
-            probcutoff = sortedprob[-1]
-            sortedprob = sortedprob[:-1]
-        inddistance = np.where(np.abs(d - distmu[ipix]) < 5 * distsigma[ipix])
-        indcredzone = np.where(p >= probcutoff)
-        doMassCuttoff = False
-
-    ipix = ipix[np.intersect1d(indcredzone, inddistance)]
-    p = p[np.intersect1d(indcredzone, inddistance)]
-    p = (p * (distp[np.intersect1d(indcredzone, inddistance)]))  ##d**2?
-
-    galaxies = galaxies[np.intersect1d(indcredzone, inddistance)]
-    if len(galaxies) == 0:
+    ### Densities rather than pixel probabilities, which doesn't change the
+    ### ranking or the scores since they are normalized
+    ranking = rank_galaxies(probdensity[tile], distmu[tile], distsigma[tile], distnorm[tile],
+                            catalog['DistMpc'][inmap], catalog['Mstar'][inmap], probcutoffs,
+                            nsigmas_in_d=nsigmas_in_d, sensitivity=sensitivity, minL=minL, maxL=maxL, mindistFactor=mindistFactor)
+    if ranking is None:
         logger.warning("No galaxies found")
         logger.warning("Peak is at [RA,DEC](deg) = {}".format(maxprobcoord))
         return
 
-    ### Normalize by mass:
-    ### NOTE: Can also do this in using luminosity (commented out)
-
-    mass = galaxies['Mstar']
-    massNorm = mass / np.sum(mass)
-    massnormalization = np.sum(mass)
-    normalization = np.sum(p * massNorm)
-
-    #luminosity = mag.L_nu_from_magAB(galaxies['Bmag'] - 5 * np.log10(galaxies['Dist'] * (10 ** 5)))
-    #luminosityNorm = luminosity / np.sum(luminosity)
-    #luminositynormalization = np.sum(luminosity)
-    #normalization = np.sum(p * luminosityNorm)
-
-    #taking 50% of mass (missingpiece is the area under the schecter function between l=inf and the brightest galaxy in the field.
-    #if the brightest galaxy in the field is fainter than the schecter function cutoff- no cutoff is made.
-    #while the number of galaxies in the field is smaller than minGalaxies- we allow for fainter galaxies, until we take all of them.
-
-    ### NOTE: Can skip this block if using mass
-    #missingpiece = gammaincc(alpha + 2, 10 ** (-(min(galaxies['Bmag']-5*np.log10(galaxies['Dist']*(10**5))) - MB_star) / 2.5)) ##no galaxies brighter than this in the field- so don't count that part of the Schechter function
-
-    #while doMassCuttoff:
-    #    MB_max = MB_star + 2.5 * np.log10(gammaincinv(alpha + 2, completeness+missingpiece))
-
-    #    if (min(galaxies['Bmag']-5*np.log10(galaxies['Dist']*(10**5))) - MB_star)>0: #if the brightest galaxy in the field is fainter then cutoff brightness- don't cut by brightness
-    #        MB_max = 100
-
-    #    brightest = np.where(galaxies['Bmag']-5*np.log10(galaxies['Dist']*(10**5))<MB_max)
-    #    if len(brightest[0])<minGalaxies:
-    #        if completeness>=0.9: #tried hard enough. just take all of them
-    #            completeness = 1 # just to be consistent.
-    #            doMassCuttoff = False
-    #        else:
-    #            completeness = (completeness + (1. - completeness) / 2)
-    #    else: #got enough galaxies
-    #        galaxies = galaxies[brightest]
-    #        p = p[brightest]
-    #        luminosityNorm = luminosityNorm[brightest]
-    #        doMassCuttoff = False
-
-    # Accounting for distance
-    absolute_sensitivity = sensitivity - 5 * np.log10(galaxies['DistMpc'] * (10 ** 5))
-
-    #absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
-    absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity)) # Check this?
-    distanceFactor = np.zeros(len(galaxies))
-
-    distanceFactor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
-    distanceFactor[mindistFactor>(maxL - absolute_sensitivity_lum) / (maxL - minL)] = mindistFactor
-    distanceFactor[absolute_sensitivity_lum<minL] = 1
-    distanceFactor[absolute_sensitivity>maxL] = mindistFactor
-
-    # Sorting glaxies by probability
-    ii = np.argsort(p*massNorm*distanceFactor,kind="mergesort")[::-1]
-
-    ####counting galaxies that constitute 50% of the probability(~0.5*0.98)
-    summ = 0
-    galaxies50per = 0
-    sum_seen = 0
-    enough = True
-    while summ<0.5:
-        if galaxies50per>= len(ii):
-            enough = False
-            break
-        summ = summ + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]])/float(normalization)
-        sum_seen = sum_seen + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]]*distanceFactor[ii[galaxies50per]])/float(normalization)
-        galaxies50per = galaxies50per+1
-
-    if len(ii) > ngalaxtoshow:
-        n = ngalaxtoshow
-    else:
-        n = len(ii)
+    logger.info('{} galaxies make up 50% of the probability{}'.format(
+        ranking['galaxies50per'], '' if ranking['enough'] else ' (not enough galaxies)'))
+    ii = inmap[ranking['indices']]
+    galaxies = catalog.select(ii[:ngalaxtoshow])
+    scores = ranking['scores']
 
     ### Save the galaxies in the database
-    for i in range(ii.shape[0])[:n]:
-        ind = ii[i]
-        newgalaxyrow = GWFollowupGalaxy(catalog='NEDLVSCatalog', 
-                                        catalog_objname=galaxies[ind]['objname'],
-                                        ra=galaxies[ind]['ra'], 
-                                        dec=galaxies[ind]['dec'],
-                                        dist=galaxies[ind]['DistMpc'], 
-                                        score=(p * massNorm / normalization)[ind],
-                                        eventlocalization=eventlocalization
-                        )
-        newgalaxyrow.save()
-   
-    logger.info('Finished creating ranked galaxy list for EventLocalization {}'.format(eventlocalization))
+    summary = save_galaxy_list(eventlocalization, galaxies, scores[:ngalaxtoshow])
+    logger.info('Finished creating ranked galaxy list for EventLocalization {}: {}'.format(eventlocalization, summary))
+    return summary
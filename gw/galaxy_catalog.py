@@ -0,0 +1,174 @@
+"""
+Preprocessed, memory-mapped copy of the galaxy catalog used to rank galaxies.
+
+build_galaxy_catalog applies the cuts generate_galaxy_list makes (no stellar
+mass or a non-positive distance) to the catalog at CATALOG_PATH and writes
+each remaining column, plus the NESTED HEALPix pixel of every galaxy at
+MOC_MAX_ORDER (for looking galaxies up in multi-order sky maps), as a
+separate .npy file. The files go in a directory under
+PREPROCESSED_CATALOG_PATH named after the source catalog's path, size and
+modification time, so editing the catalog makes a new copy instead of
+changing one that is in use.
+
+load_galaxy_catalog memory-maps those files read-only once per process (and
+builds them the first time, if the preprocess_galaxy_catalog command hasn't),
+so ranking a localization reads only the pages it needs and all the workers
+on a machine share them through the page cache.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from configparser import ConfigParser
+
+import healpy as hp
+import numpy as np
+from astropy.table import Table
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION = 3
+COLUMNS = ['objname', 'ra', 'dec', 'DistMpc', 'Mstar']
+MOC_MAX_ORDER = 29 # the finest HEALPix order, and of multi-order tile indices
+
+_lock = threading.Lock()
+_catalogs = {}
+
+
+def catalog_paths():
+    """
+    Paths of the source catalog and of the directory for preprocessed copies,
+    from gw_config.ini
+    """
+    config = ConfigParser(inline_comment_prefixes=';')
+    config.read(os.path.join(settings.BASE_DIR, 'gw/gw_config.ini'))
+    catalog_path = config.get('GALAXIES', 'CATALOG_PATH')
+    preprocessed_path = config.get('GALAXIES', 'PREPROCESSED_CATALOG_PATH', fallback=None)
+    return catalog_path, preprocessed_path or default_preprocessed_path(catalog_path)
+
+
+def default_preprocessed_path(catalog_path):
+    return os.path.join(os.path.dirname(os.path.abspath(catalog_path)), 'preprocessed')
+
+
+def _catalog_dir(catalog_path, preprocessed_path):
+    stat = os.stat(catalog_path)
+    version = [os.path.abspath(catalog_path), stat.st_size, stat.st_mtime_ns, CATALOG_VERSION]
+    key = hashlib.sha1(json.dumps(version).encode('utf-8')).hexdigest()
+    return os.path.join(preprocessed_path, key)
+
+
+def galaxy_pixels(nside, ra, dec, nest=False):
+    """
+    HEALPix pixels of galaxies at ra and dec, in degrees
+    """
+    theta = 0.5 * np.pi - np.deg2rad(dec)
+    phi = np.deg2rad(ra)
+    return hp.ang2pix(nside, theta, phi, nest=nest).astype(np.int64)
+
+
+def build_galaxy_catalog(catalog_path, preprocessed_path):
+    """
+    Writes the preprocessed copy of the catalog, if it doesn't exist yet,
+    and returns its directory
+    """
+    outdir = _catalog_dir(catalog_path, preprocessed_path)
+    if os.path.exists(os.path.join(outdir, 'manifest.json')):
+        return outdir
+
+    logger.info('Preprocessing galaxy catalog {}'.format(catalog_path))
+    galaxies = Table.read(catalog_path)
+    mstar = np.asarray(galaxies['Mstar'], dtype=np.float64)
+    dist = np.asarray(galaxies['DistMpc'], dtype=np.float64)
+    keep = ~np.isnan(mstar) & (dist > 0)
+
+    os.makedirs(preprocessed_path, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=preprocessed_path)
+    try:
+        columns = {
+            'objname': np.asarray(galaxies['objname'][keep]).astype(str),
+            'ra': np.asarray(galaxies['ra'][keep], dtype=np.float64),
+            'dec': np.asarray(galaxies['dec'][keep], dtype=np.float64),
+            'DistMpc': dist[keep],
+            'Mstar': mstar[keep],
+        }
+        columns['nest_{}'.format(MOC_MAX_ORDER)] = galaxy_pixels(2**MOC_MAX_ORDER, columns['ra'], columns['dec'], nest=True)
+
+        for name, column in columns.items():
+            np.save(os.path.join(tmpdir, name + '.npy'), column)
+        with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+            json.dump({'source': os.path.abspath(catalog_path), 'version': CATALOG_VERSION,
+                       'count': int(keep.sum())}, f)
+        os.chmod(tmpdir, 0o755)
+
+        try:
+            os.rename(tmpdir, outdir)
+        except OSError:
+            ### Another process finished the same copy first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    logger.info('Wrote {} galaxies to {}'.format(int(keep.sum()), outdir))
+    return outdir
+
+
+class GalaxyCatalog:
+    """
+    Read-only columns of the preprocessed catalog
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+        self._nested_ipix = None
+
+    def __len__(self):
+        return self.manifest['count']
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def nested_ipix(self):
+        """
+        NESTED pixel of every galaxy at MOC_MAX_ORDER
+        """
+        if self._nested_ipix is None:
+            self._nested_ipix = np.load(os.path.join(self.path, 'nest_{}.npy'.format(MOC_MAX_ORDER)), mmap_mode='r')
+        return self._nested_ipix
+
+    def select(self, indices):
+        """
+        In-memory copy of the columns of the galaxies at indices
+        """
+        return {name: np.asarray(column[indices]) for name, column in self.columns.items()}
+
+
+def load_galaxy_catalog(catalog_path=None, preprocessed_path=None):
+    """
+    This process's shared copy of the preprocessed catalog,
+    building it the first time it's needed
+    """
+    if catalog_path is None:
+        catalog_path, preprocessed_path = catalog_paths()
+    elif preprocessed_path is None:
+        preprocessed_path = default_preprocessed_path(catalog_path)
+
+    outdir = _catalog_dir(catalog_path, preprocessed_path)
+    catalog = _catalogs.get(outdir)
+    if catalog is not None:
+        return catalog
+
+    with _lock:
+        if outdir not in _catalogs:
+            build_galaxy_catalog(catalog_path, preprocessed_path)
+            _catalogs.clear()
+            _catalogs[outdir] = GalaxyCatalog(outdir)
+        return _catalogs[outdir]
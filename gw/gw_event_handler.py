@@ -41,11 +41,11 @@ def handle_igwn_message_with_galaxies(message, metadata):
     nonlocalizedevent, event_sequence = handle_igwn_message(message, metadata)
 
     localization = event_sequence.localization
-    existing_galaxies_for_localization = GWFollowupGalaxy.objects.filter(eventlocalization=localization)
-    if len(existing_galaxies_for_localization) > 0:
+    if GWFollowupGalaxy.objects.filter(eventlocalization=localization).exists():
         ### Already found galaxies for this localization, so don't do it again
         return nonlocalizedevent, event_sequence
     try:
+        ### Reranks the list of an earlier localization in place, if there is one
         generate_galaxy_list(localization)
     except Exception as e:
         logger.error('Could not generate galaxy list with exception {}'.format(e))
@@ -5,7 +5,7 @@ from tom_targets.models import Target, TargetExtra
 from tom_observations.models import ObservationRecord
 from tom_nonlocalizedevents.models import EventSequence
 from custom_code.views import cancel_observation, Snex1ConnectionError
-from custom_code.hooks import _return_session, _load_table
+from custom_code.snex1_db import new_session, load_table
 import logging
 from django.conf import settings
 
@@ -38,7 +38,7 @@ def cancel_gw_obs(galaxy_ids=[], sequence_id=None, wrapped_session=None):
         db_session = wrapped_session
 
     else:
-        db_session = _return_session(settings.SNEX1_DB_URL)
+        db_session = new_session(settings.SNEX1_DB_URL)
     
     for target in targets:
         ### Cancel any observation requests for this target
@@ -77,9 +77,9 @@ def ingest_gw_galaxy_into_snex1(target_id, event_id, wrapped_session=None):
         db_session = wrapped_session
 
     else:
-        db_session = _return_session(settings.SNEX1_DB_URL)
+        db_session = new_session(settings.SNEX1_DB_URL)
 
-    o4_galaxies = _load_table('o4_galaxies', db_address=settings.SNEX1_DB_URL)
+    o4_galaxies = load_table('o4_galaxies', db_address=settings.SNEX1_DB_URL)
 
     existing_target = db_session.query(o4_galaxies).filter(o4_galaxies.targetid==target_id)
     if existing_target.count() > 0:
@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw', '0002_alter_gwfollowupgalaxy_catalog_objname'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GWAlertJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('handler', models.CharField(help_text='Dotted path of the function that processes this alert', max_length=100, verbose_name='Handler')),
+                ('superevent_id', models.CharField(help_text='ID of the GW event this alert is for', max_length=50, verbose_name='Superevent ID')),
+                ('sequence', models.CharField(help_text='Sequence number of the notice, or its creation time for IGWN alerts', max_length=50, verbose_name='Sequence')),
+                ('alert_type', models.CharField(blank=True, default='', help_text='Type of the notice, e.g. PRELIMINARY or RETRACTION', max_length=50, verbose_name='Alert Type')),
+                ('priority', models.IntegerField(default=10, help_text='Jobs with lower numbers are processed first', verbose_name='Priority')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('superseded', 'Superseded')], db_index=True, default='pending', max_length=20, verbose_name='Status')),
+                ('payload', models.BinaryField(help_text='Pickled arguments of the handler', verbose_name='Payload')),
+                ('alert_time', models.DateTimeField(blank=True, help_text='Time the alert was published to the stream', null=True, verbose_name='Alert Time')),
+                ('received', models.DateTimeField(help_text='Time the alert was received from the stream', verbose_name='Received')),
+                ('started', models.DateTimeField(blank=True, help_text='Time processing started', null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(blank=True, help_text='Time processing finished', null=True, verbose_name='Finished')),
+                ('attempts', models.IntegerField(default=0, help_text='Number of times processing was started', verbose_name='Attempts')),
+                ('error', models.TextField(blank=True, default='', help_text='Traceback of the last failure', verbose_name='Error')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'priority', 'received'], name='gw_alert_job_queue')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gwalertjob',
+            constraint=models.UniqueConstraint(fields=('superevent_id', 'sequence', 'alert_type'), name='unique_gw_alert_job'),
+        ),
+    ]
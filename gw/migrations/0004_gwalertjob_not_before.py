@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw', '0003_gwalertjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gwalertjob',
+            name='not_before',
+            field=models.DateTimeField(blank=True, help_text='Time a failed job can be retried', null=True, verbose_name='Not Before'),
+        ),
+    ]
@@ -36,3 +36,97 @@ class GWFollowupGalaxy(models.Model):
         EventLocalization, on_delete=models.CASCADE
     )
 
+
+
+class GWAlertJob(models.Model):
+    """
+    A GW alert waiting to be processed, see gw/alert_queue.py
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SUPERSEDED = 'superseded'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (SUPERSEDED, 'Superseded'),
+    ]
+
+    handler = models.CharField(
+        max_length=100, verbose_name='Handler', help_text='Dotted path of the function that processes this alert'
+    )
+
+    superevent_id = models.CharField(
+        max_length=50, verbose_name='Superevent ID', help_text='ID of the GW event this alert is for'
+    )
+
+    sequence = models.CharField(
+        max_length=50, verbose_name='Sequence', help_text='Sequence number of the notice, or its creation time for IGWN alerts'
+    )
+
+    alert_type = models.CharField(
+        max_length=50, default='', blank=True, verbose_name='Alert Type', help_text='Type of the notice, e.g. PRELIMINARY or RETRACTION'
+    )
+
+    priority = models.IntegerField(
+        default=10, verbose_name='Priority', help_text='Jobs with lower numbers are processed first'
+    )
+
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True, verbose_name='Status'
+    )
+
+    payload = models.BinaryField(
+        verbose_name='Payload', help_text='Pickled arguments of the handler'
+    )
+
+    alert_time = models.DateTimeField(
+        null=True, blank=True, verbose_name='Alert Time', help_text='Time the alert was published to the stream'
+    )
+
+    received = models.DateTimeField(
+        verbose_name='Received', help_text='Time the alert was received from the stream'
+    )
+
+    started = models.DateTimeField(
+        null=True, blank=True, verbose_name='Started', help_text='Time processing started'
+    )
+
+    finished = models.DateTimeField(
+        null=True, blank=True, verbose_name='Finished', help_text='Time processing finished'
+    )
+
+    attempts = models.IntegerField(
+        default=0, verbose_name='Attempts', help_text='Number of times processing was started'
+    )
+
+    not_before = models.DateTimeField(
+        null=True, blank=True, verbose_name='Not Before', help_text='Time a failed job can be retried'
+    )
+
+    error = models.TextField(
+        default='', blank=True, verbose_name='Error', help_text='Traceback of the last failure'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['superevent_id', 'sequence', 'alert_type'], name='unique_gw_alert_job')
+        ]
+        indexes = [
+            models.Index(fields=['status', 'priority', 'received'], name='gw_alert_job_queue')
+        ]
+
+    def __str__(self):
+        return '{} {} {} ({})'.format(self.superevent_id, self.alert_type, self.sequence, self.status)
+
+    @property
+    def latency(self):
+        """
+        Seconds from receiving the alert to finishing its galaxy list
+        """
+        if self.finished:
+            return (self.finished - self.received).total_seconds()
+        return None
@@ -1,3 +1,301 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from tom_nonlocalizedevents.models import EventLocalization, NonLocalizedEvent
+import numpy as np
+from scipy.stats import norm
+
+from gw.find_galaxies import credible_region_cutoffs, find_tiles, rank_galaxies, save_galaxy_list
+from gw.galaxy_catalog import MOC_MAX_ORDER
+from gw.alert_queue import enqueue, requeue_stale_jobs, run_pending_jobs
+from gw.models import GWAlertJob, GWFollowupGalaxy
+
+def to_uniq(order, ipix):
+    return 4 * 4**order + np.asarray(ipix, dtype=np.int64)
+
+
+def to_finest(order, ipix):
+    return np.asarray(ipix, dtype=np.int64) << (2 * (MOC_MAX_ORDER - order))
+
+
+PARAMS = {'nsigmas_in_d': 3, 'sensitivity': 22, 'minL': 1e40, 'maxL': 1e41, 'mindistFactor': 0.01}
+
+
+def legacy_rank_galaxies(prob, distmu, distsigma, distnorm, ipix, d, mass, credzone,
+                         nsigmas_in_d, sensitivity, minL, maxL, mindistFactor):
+    """
+    The ranking from generate_galaxy_list before it was vectorized,
+    returning the catalog indices, scores and 50% galaxy count
+    """
+    probcutoff = 1
+    probsum = 0
+
+    sortedprob = np.sort(prob,kind="mergesort")
+    while probsum < credzone:
+        probsum = probsum + sortedprob[-1]
+        probcutoff = sortedprob[-1]
+        sortedprob = sortedprob[:-1]
+
+    p = prob[ipix]
+    distp = (norm(distmu[ipix], distsigma[ipix]).pdf(d) * distnorm[ipix])
+
+    inddistance = np.where(np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix])
+    indcredzone = np.where(p>=probcutoff)
+
+    if len(np.intersect1d(indcredzone,inddistance)) == 0:
+        while probsum < 0.99995:
+            if sortedprob.size == 0:
+                break
+            probsum = probsum + sortedprob[-1]
+            probcutoff = sortedprob[-1]
+            sortedprob = sortedprob[:-1]
+        inddistance = np.where(np.abs(d - distmu[ipix]) < 5 * distsigma[ipix])
+        indcredzone = np.where(p >= probcutoff)
+
+    selected = np.intersect1d(indcredzone, inddistance)
+    p = p[selected]
+    p = (p * (distp[selected]))
+    if len(p) == 0:
+        return None
+
+    mass = mass[selected]
+    massNorm = mass / np.sum(mass)
+    normalization = np.sum(p * massNorm)
+
+    absolute_sensitivity = sensitivity - 5 * np.log10(d[selected] * (10 ** 5))
+    absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity))
+    distanceFactor = np.zeros(len(p))
+    distanceFactor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
+    distanceFactor[mindistFactor>(maxL - absolute_sensitivity_lum) / (maxL - minL)] = mindistFactor
+    distanceFactor[absolute_sensitivity_lum<minL] = 1
+    distanceFactor[absolute_sensitivity>maxL] = mindistFactor
+
+    ii = np.argsort(p*massNorm*distanceFactor,kind="mergesort")[::-1]
+
+    summ = 0
+    galaxies50per = 0
+    while summ<0.5:
+        if galaxies50per>= len(ii):
+            break
+        summ = summ + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]])/float(normalization)
+        galaxies50per = galaxies50per+1
+
+    return selected[ii], (p * massNorm / normalization)[ii], galaxies50per
+
+
+class TestGalaxyRanking(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+
+        ### A synthetic nside 64 map: a blob of probability around one pixel
+        ### with a distance of 80 +/- 20 Mpc, plus a faint floor
+        npix = 12 * 64**2
+        pixels = np.arange(npix)
+        prob = np.exp(-0.5 * ((pixels - 20000) / 300.0)**2) + 1e-9
+        self.prob = prob / prob.sum()
+        self.distmu = np.full(npix, 80.0)
+        self.distsigma = np.full(npix, 20.0)
+        self.distnorm = np.full(npix, 1e-4)
+
+        ### Galaxies spread over the sky, more of them around the blob
+        ngal = 20000
+        self.ipix = np.concatenate([rng.integers(0, npix, ngal // 2),
+                                    np.clip(rng.normal(20000, 600, ngal // 2).astype(int), 0, npix - 1)])
+        self.d = rng.uniform(1.0, 300.0, ngal)
+        self.mass = 10**rng.uniform(8.0, 11.5, ngal)
+
+    def rank(self, credzone, **kwargs):
+        params = dict(PARAMS, **kwargs)
+        cutoffs = credible_region_cutoffs(self.prob, credzone)
+        new = rank_galaxies(self.prob[self.ipix], self.distmu[self.ipix], self.distsigma[self.ipix], self.distnorm[self.ipix],
+                            self.d, self.mass, cutoffs, **params)
+        old = legacy_rank_galaxies(self.prob, self.distmu, self.distsigma, self.distnorm, self.ipix,
+                                   self.d, self.mass, credzone, **params)
+        return new, old
+
+    def assertSameRanking(self, new, old):
+        indices, scores, galaxies50per = old
+        np.testing.assert_array_equal(new['indices'], indices)
+        np.testing.assert_allclose(new['scores'], scores, rtol=1e-12)
+        self.assertEqual(new['galaxies50per'], galaxies50per)
+
+    def test_credible_region_cutoffs(self):
+        prob = np.array([0.05, 0.4, 0.1, 0.3, 0.15])
+        self.assertEqual(credible_region_cutoffs(prob, 0.5), (0.3, 0.05))
+        self.assertEqual(credible_region_cutoffs(prob, 0.7), (0.3, 0.05))
+        self.assertEqual(credible_region_cutoffs(prob, 0.9), (0.1, 0.05))
+        self.assertEqual(credible_region_cutoffs(prob, 0.4, fallback_credzone=0.5), (0.4, 0.3))
+
+    def test_matches_legacy_ranking(self):
+        for credzone in [0.5, 0.9, 0.99]:
+            new, old = self.rank(credzone)
+            self.assertGreater(len(new['indices']), 0)
+            self.assertSameRanking(new, old)
+
+    def test_matches_legacy_fallback(self):
+        ### No galaxy can be within zero sigmas of the mean distance,
+        ### so the ranking falls back to the 99.995% region and 5 sigma
+        new, old = self.rank(0.5, nsigmas_in_d=0.0)
+        self.assertGreater(len(new['indices']), 0)
+        self.assertSameRanking(new, old)
+
+    def test_no_galaxies(self):
+        self.d = np.full(len(self.d), 1000.0)
+        new, old = self.rank(0.9)
+        self.assertIsNone(new)
+        self.assertIsNone(old)
+
+
+class TestMultiOrderRanking(SimpleTestCase):
+
+    def test_find_tiles(self):
+        ### Pixel 0 at order 0 split into its four children, pixels 1-10
+        ### at order 0, and pixel 11 left out of the map
+        uniq = np.concatenate([to_uniq(0, np.arange(10, 0, -1)), to_uniq(1, [3, 1, 2, 0])])
+        nest = np.concatenate([to_finest(1, [0, 2, 3]) + 5, to_finest(0, [1, 10]), to_finest(0, [2]) - 1, to_finest(0, [11])])
+        tiles = find_tiles(uniq, nest)
+        np.testing.assert_array_equal(tiles, [13, 12, 10, 9, 0, 9, -1])
+
+    def test_matches_flattened_ranking(self):
+        rng = np.random.default_rng(7)
+
+        ### An order 3 map, and the same map with every other pixel
+        ### split into its four children at order 4
+        order = 3
+        npix = 12 * 4**order
+        pixels = np.arange(npix)
+        density = np.exp(-0.5 * ((pixels - 300) / 40.0)**2) + 1e-6
+        prob = density / density.sum()
+        distmu = rng.uniform(50.0, 150.0, npix)
+        distsigma = distmu / 4
+        distnorm = 1 / distmu**2
+
+        split = pixels[::2]
+        kept = pixels[1::2]
+        children = (split[:, None] * 4 + np.arange(4)).ravel()
+        parents = np.concatenate([kept, children // 4])
+        uniq = np.concatenate([to_uniq(order, kept), to_uniq(order + 1, children)])
+        area = np.concatenate([np.full(len(kept), 4.0), np.full(len(children), 1.0)])
+
+        ngal = 5000
+        nest = rng.integers(0, to_finest(0, 12), ngal)
+        d = rng.uniform(1.0, 250.0, ngal)
+        mass = 10**rng.uniform(8.0, 11.5, ngal)
+
+        ### Galaxy pixels in the flattened map
+        ipix = nest >> (2 * (MOC_MAX_ORDER - order))
+        flat = rank_galaxies(prob[ipix], distmu[ipix], distsigma[ipix], distnorm[ipix], d, mass,
+                             credible_region_cutoffs(prob, 0.9), **PARAMS)
+
+        tile = find_tiles(uniq, nest)
+        self.assertTrue(np.all(tile >= 0))
+        self.assertTrue(np.all(parents[tile] == ipix))
+        moc_density = density[parents]
+        moc = rank_galaxies(moc_density[tile], distmu[parents][tile], distsigma[parents][tile], distnorm[parents][tile], d, mass,
+                            credible_region_cutoffs(moc_density, 0.9, area=area / (4 * density.sum())), **PARAMS)
+
+        np.testing.assert_array_equal(moc['indices'], flat['indices'])
+        np.testing.assert_allclose(moc['scores'], flat['scores'], rtol=1e-10)
+        self.assertEqual(moc['galaxies50per'], flat['galaxies50per'])
+
+
+def galaxy_table(names):
+    n = len(names)
+    return {'objname': np.array(names), 'ra': np.arange(n, dtype=float), 'dec': np.zeros(n), 'DistMpc': np.full(n, 50.0)}
+
+
+class TestSaveGalaxyList(TestCase):
+
+    def setUp(self):
+        event = NonLocalizedEvent.objects.create(event_id='S240101a', event_type=NonLocalizedEvent.NonLocalizedEventType.GRAVITATIONAL_WAVE)
+        now = timezone.now()
+        self.earlier = EventLocalization.objects.create(nonlocalizedevent=event, distance_mean=50.0, distance_std=10.0,
+                                                        skymap_moc_file_url='early.fits', date=now - timedelta(hours=1))
+        self.later = EventLocalization.objects.create(nonlocalizedevent=event, distance_mean=50.0, distance_std=10.0,
+                                                      skymap_moc_file_url='late.fits', date=now)
+
+    def test_reranks_earlier_list_in_place(self):
+        save_galaxy_list(self.earlier, galaxy_table(['A', 'B']), [0.6, 0.4])
+        b = GWFollowupGalaxy.objects.get(catalog_objname='B')
+
+        summary = save_galaxy_list(self.later, galaxy_table(['B', 'C']), [0.7, 0.3])
+        self.assertEqual((summary['added'], summary['rescored'], summary['removed']), (1, 1, 1))
+        self.assertEqual(GWFollowupGalaxy.objects.get(catalog_objname='B').id, b.id)
+        self.assertEqual(set(GWFollowupGalaxy.objects.values_list('eventlocalization', flat=True)), {self.later.id})
+
+    def test_out_of_order_localization_is_skipped(self):
+        save_galaxy_list(self.later, galaxy_table(['B', 'C']), [0.7, 0.3])
+
+        ### The earlier localization is processed after the later one,
+        ### e.g. on a retry, and must not take its list back
+        summary = save_galaxy_list(self.earlier, galaxy_table(['A', 'B']), [0.6, 0.4])
+        self.assertTrue(summary['skipped'])
+        galaxies = GWFollowupGalaxy.objects.order_by('-score')
+        self.assertEqual([g.catalog_objname for g in galaxies], ['B', 'C'])
+        self.assertEqual(set(g.eventlocalization_id for g in galaxies), {self.later.id})
+
+
+PROCESSED_ALERTS = []
+
+
+def record_alert(name):
+    PROCESSED_ALERTS.append(name)
+
+
+def fail_alert(name):
+    raise ValueError(name)
+
+
+@mock.patch('gw.alert_queue.GW_ALERT_QUEUE_BACKEND', 'database')
+class TestAlertQueue(TestCase):
+
+    def setUp(self):
+        PROCESSED_ALERTS.clear()
+
+    def test_deduplication_and_retraction_priority(self):
+        enqueue('gw.tests.record_alert', 'S1', '1', 'PRELIMINARY', ('S1 preliminary',))
+        enqueue('gw.tests.record_alert', 'S1', '1', 'PRELIMINARY', ('S1 redelivered',))
+        enqueue('gw.tests.record_alert', 'S2', '1', 'PRELIMINARY', ('S2 preliminary',))
+        enqueue('gw.tests.record_alert', 'S2', '2', 'RETRACTION', ('S2 retraction',))
+        self.assertEqual(GWAlertJob.objects.count(), 3)
+
+        self.assertEqual(run_pending_jobs(), 2)
+        self.assertEqual(PROCESSED_ALERTS, ['S2 retraction', 'S1 preliminary'])
+        self.assertEqual(GWAlertJob.objects.get(superevent_id='S2', alert_type='PRELIMINARY').status, GWAlertJob.SUPERSEDED)
+
+        job = GWAlertJob.objects.get(superevent_id='S1')
+        self.assertEqual(job.status, GWAlertJob.DONE)
+        self.assertGreaterEqual(job.latency, 0)
+
+    def test_failed_jobs_are_retried(self):
+        enqueue('gw.tests.fail_alert', 'S3', '1', 'PRELIMINARY', ('S3 preliminary',))
+        with mock.patch('gw.alert_queue.GW_ALERT_MAX_ATTEMPTS', 2):
+            self.assertEqual(run_pending_jobs(), 1)
+
+            ### The retry waits for its backoff
+            job = GWAlertJob.objects.get(superevent_id='S3')
+            self.assertEqual(job.status, GWAlertJob.PENDING)
+            self.assertGreater(job.not_before, timezone.now())
+            self.assertEqual(run_pending_jobs(), 0)
+
+            GWAlertJob.objects.filter(id=job.id).update(not_before=timezone.now() - timedelta(seconds=1))
+            self.assertEqual(run_pending_jobs(), 1)
+
+        job = GWAlertJob.objects.get(superevent_id='S3')
+        self.assertEqual(job.status, GWAlertJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('ValueError', job.error)
+
+    def test_jobs_left_running_are_requeued(self):
+        enqueue('gw.tests.record_alert', 'S4', '1', 'PRELIMINARY', ('S4 preliminary',))
+        booted = timezone.now()
+        GWAlertJob.objects.update(status=GWAlertJob.RUNNING, started=booted - timedelta(minutes=5))
+
+        ### Not yet past the timeout, but started before the stream process
+        self.assertEqual(requeue_stale_jobs(), 0)
+        self.assertEqual(requeue_stale_jobs(started_before=booted), 1)
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(PROCESSED_ALERTS, ['S4 preliminary'])
@@ -21,7 +21,7 @@ from tom_common.hooks import run_hook
 from tom_targets.models import Target, TargetExtra
 from tom_observations.facility import get_service_class
 from tom_observations.models import ObservationRecord, ObservationGroup, DynamicCadence
-from custom_code.hooks import _return_session, _load_table
+from custom_code.snex1_db import new_session, load_table
 from gw.hooks import ingest_gw_galaxy_into_snex1
 from custom_code.views import Snex1ConnectionError
 import logging
@@ -74,10 +74,10 @@ class EventSequenceGalaxiesTripletView(ListView, LoginRequiredMixin):
     
     def get_context_data(self, **kwargs):
 
-        db_session = _return_session(settings.SNEX1_DB_URL)
+        db_session = new_session(settings.SNEX1_DB_URL)
 
-        o4_galaxies = _load_table('o4_galaxies', db_address = settings.SNEX1_DB_URL)
-        photlco = _load_table('photlco', db_address = settings.SNEX1_DB_URL)
+        o4_galaxies = load_table('o4_galaxies', db_address = settings.SNEX1_DB_URL)
+        photlco = load_table('photlco', db_address = settings.SNEX1_DB_URL)
 
 
         context = super().get_context_data(**kwargs)
@@ -159,6 +159,7 @@ class EventSequenceGalaxiesTripletView(ListView, LoginRequiredMixin):
 
 
         context['rows'] = rows
+        db_session.close()
 
         return context
 
@@ -212,7 +213,7 @@ def submit_galaxy_observations_view(request):
     galaxies = GWFollowupGalaxy.objects.filter(id__in=galaxy_ids)
 
     try:
-        db_session = _return_session()
+        db_session = new_session()
         failed_obs = []
         all_pointings = []
         with transaction.atomic():
@@ -393,7 +394,7 @@ def cancel_galaxy_observations_view(request):
 
     ### Get list of GWFollowupGalaxy ids from the request and create Targets
     try:
-        db_session = _return_session()
+        db_session = new_session()
 
         galaxy_ids = json.loads(request.GET['galaxy_ids'])
         with transaction.atomic():
@@ -78,6 +78,7 @@ if DEBUG:
 SITE_ID = 2
 
 MIDDLEWARE = [
+    'custom_code.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,6 +90,8 @@ MIDDLEWARE = [
     'tom_common.middleware.ExternalServiceMiddleware',
     'tom_common.middleware.AuthStrategyMiddleware',
     'tom_registration.middleware.RedirectAuthenticatedUsersFromRegisterMiddleware',
+    'custom_code.middleware.RequestCacheMiddleware',
+    'custom_code.middleware.TargetSummaryMiddleware',
 
 ]
 
@@ -253,6 +256,11 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
 MEDIA_URL = '/data/'
 
+# The FLOYDS inbox previews are the .png files next to the raw spectra under
+# FLOYDS_SNEX1_ROOT, mirrored with the same layout in FLOYDS_PREVIEW_ROOT
+FLOYDS_SNEX1_ROOT = '/supernova/data/floyds'
+FLOYDS_PREVIEW_ROOT = os.getenv('FLOYDS_PREVIEW_ROOT', os.path.join(MEDIA_ROOT, 'floyds'))
+
 # Using AWS
 
 if not DEBUG:
@@ -517,6 +525,20 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 7000000
 SNEX1_DB_URL = 'mysql://{}:{}@supernova.science.lco.global:3306/supernova?charset=utf8&use_unicode=1'
 SNEX1_DB_URL = SNEX1_DB_URL.format(os.getenv('SNEX1_DB_USER', ''), os.getenv('SNEX1_DB_PASSWORD', ''))
 
+# Connection pool for the SNEx1 database, see custom_code/snex1_db.py
+SNEX1_DB_POOL_SIZE = int(os.getenv('SNEX1_DB_POOL_SIZE', 5))
+SNEX1_DB_MAX_OVERFLOW = int(os.getenv('SNEX1_DB_MAX_OVERFLOW', 10))
+SNEX1_DB_POOL_RECYCLE = int(os.getenv('SNEX1_DB_POOL_RECYCLE', 3600))
+SNEX1_DB_POOL_PRE_PING = True
+
+# Rendered image thumbnails, see custom_code/thumbnail_cache.py
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_DIR, 'data/thumbs/cache/')
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', 2 * 1024**3))
+
+# Timing of template tags, hooks and views, see custom_code/instrumentation.py
+INSTRUMENTATION_ENABLED = os.getenv('SNEX2_INSTRUMENTATION', 'False') == 'True'
+INSTRUMENTATION_LOG_MS = int(os.getenv('SNEX2_INSTRUMENTATION_LOG_MS', 250))
+
 
 PLOTLY_DASH = {
     'cache_arguments': False,
@@ -541,6 +563,11 @@ HERMES_API_URL = os.getenv('HERMES_API_URL', 'https://hermes.lco.global')
 
 SAVE_TEST_ALERTS = False
 
+# GW alerts are processed off the alert stream consumer, see gw/alert_queue.py
+# 'thread' runs them in the stream process, 'database' leaves them for the
+# process_gw_alerts command and 'sync' runs them in the stream callback
+GW_ALERT_QUEUE_BACKEND = os.getenv('GW_ALERT_QUEUE_BACKEND', 'thread')
+
 ALERT_STREAMS = [
     {
         'ACTIVE': True,
@@ -555,7 +582,8 @@ ALERT_STREAMS = [
                 'hermes.*': 'custom_code.alertstreams.hopskotch.alert_logger',
                 'tomtoolkit.test': 'custom_code.alertstreams.hopskotch.alert_logger',
                 #'igwn.gwalert': 'tom_nonlocalizedevents.alertstream_handlers.igwn_event_handler.handle_igwn_message',
-                'igwn.gwalert': 'gw.gw_event_handler.handle_igwn_message_with_galaxies',
+                #'igwn.gwalert': 'gw.gw_event_handler.handle_igwn_message_with_galaxies',
+                'igwn.gwalert': 'gw.alert_queue.enqueue_igwn_message',
             },
         },
     },
@@ -574,9 +602,9 @@ ALERT_STREAMS = [
                 # 'enable.auto.commit': False
             },
             'TOPIC_HANDLERS': {
-                'gcn.classic.text.LVC_INITIAL': 'gw.gw_event_handler.handle_message',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_message',
-                'gcn.classic.text.LVC_PRELIMINARY': 'gw.gw_event_handler.handle_message',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_message',
-                'gcn.classic.text.LVC_RETRACTION': 'gw.gw_event_handler.handle_retraction_with_galaxies',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_retraction',
+                'gcn.classic.text.LVC_INITIAL': 'gw.alert_queue.enqueue_gcn_message',#'gw.gw_event_handler.handle_message',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_message',
+                'gcn.classic.text.LVC_PRELIMINARY': 'gw.alert_queue.enqueue_gcn_message',#'gw.gw_event_handler.handle_message',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_message',
+                'gcn.classic.text.LVC_RETRACTION': 'gw.alert_queue.enqueue_gcn_retraction',#'gw.gw_event_handler.handle_retraction_with_galaxies',#'tom_nonlocalizedevents.alertstream_handlers.gcn_event_handler.handle_retraction',
             },
         },
     }
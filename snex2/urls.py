@@ -54,6 +54,8 @@ urlpatterns = [
     path('query-swift-observations/', query_swift_observations_view, name='query-swift-observations'),
     path('load-lc/', load_lightcurve_view, name='load-lc'),
     path('make-thumbnail/', make_thumbnail_view, name='make-thumbnail'),
+    path('make-thumbnails/', make_thumbnails_view, name='make-thumbnails'),
+    path('thumbnails/<slug:key>.webp', thumbnail_view, name='thumbnail'),
     path('interesting-targets/', InterestingTargetsView.as_view(), name='interesting-targets'),
     path('load-spectra-page/', async_spectra_page_view, name='load-spectra-page'),
     path('load-upcoming-reminders/', async_scheduling_page_view, name='load-upcoming-reminders'),
@@ -66,6 +68,7 @@ urlpatterns = [
     path('submit-gw-obs/', submit_galaxy_observations_view, name='submit-gw-obs'),
     path('cancel-gw-obs/', cancel_galaxy_observations_view, name='cancel-gw-obs'),
     path('floyds-inbox/', FloydsInboxView.as_view(), name='floyds-inbox'),
+    path('floyds-inbox/previews/<path:path>', floyds_preview_view, name='floyds-preview'),
     path('nonlocalizedevents/sequence/<int:id>/obs/', EventSequenceGalaxiesTripletView.as_view(), name='nonlocalizedevents-sequence-triplets'),
     path('nonlocalizedevents/galaxies/<int:id>/obs/', GWFollowupGalaxyTripletView.as_view(), name='nonlocalizedevents-galaxies-triplets'),
     path('', include('tom_registration.registration_flows.approval_required.urls', namespace='registration')),